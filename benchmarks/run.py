@@ -0,0 +1,351 @@
+"""
+Микробенчмарки горячих путей обработки текста.
+
+Корпус — benchmarks/corpus/: реальные по форме ответы модели (длинный код,
+таблицы, LaTeX, обычный markdown и ответ, оборванный посреди ``` и **,
+как на промежуточном flush'е стрима) и ответы анализатора с тегом
+намерения (intents.json).
+
+Что меряется (время на одну операцию, лучшее и медиана из --repeat):
+
+- markdown.render[файл]    — markdown_to_telegram_html;
+- markdown.rich[файл]      — contains_rich_markup;
+- html.fix[файл]           — _validate_and_fix_html на готовом HTML
+                             и на HTML, обрезанном посередине;
+- split_text[...]          — _split_text под лимиты обычного и rich-сообщения;
+- intent.parse / .fallback — UniversalAnalyzer._parse_intent и _fallback_intent
+                             (на один ответ / один запрос корпуса);
+- stream.flush[файл]       — CPU одного flush'а в _stream_via_edit_text:
+                             дельты по несколько символов идут в
+                             StreamingMarkdownRenderer, каждые --flush-chars
+                             символов — render() и сравнение с показанным,
+                             в конце — финальный finish() и contains_rich_markup.
+                             Время делится на число flush'ей;
+- stream.flush_full[файл]  — то же с полным markdown_to_telegram_html на каждом
+                             flush'е (как было до инкрементального рендера) —
+                             точка отсчёта для изменений рендерера. Если
+                             stream.flush не быстрее stream.flush_full на том
+                             же файле — это ошибка, код выхода 1 и без базы.
+
+split_text и intent.* импортируют telegram_helpers и universal_analyzer, а с
+ними config (aiogram, openai) — без них эти бенчмарки пропускаются с
+пометкой в "skipped". Токены для config подставляются фиктивные.
+
+Сравнение с базой: время на машине и базы, и текущего прогона
+нормируется на калибровочный цикл чистого Python, регрессия — если
+нормированное лучшее время выросло больше, чем на --threshold. Код выхода 1
+при регрессии — можно ставить в CI.
+
+    python -m benchmarks.run
+    python -m benchmarks.run -k markdown --out results.json
+    python -m benchmarks.run --compare benchmarks/baseline.json --threshold 0.15
+    python -m benchmarks.run --save-baseline
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from typing import Any, Callable, Optional
+
+from utils.markdown import (
+    StreamingMarkdownRenderer,
+    _validate_and_fix_html,
+    contains_rich_markup,
+    markdown_to_telegram_html,
+)
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(_HERE, "corpus")
+BASELINE_PATH = os.path.join(_HERE, "baseline.json")
+
+# Один замер должен длиться хотя бы столько — иначе шум таймера
+_MIN_TIME = 0.02
+# Дельта стрима — «токен» в несколько символов, как у реальных моделей
+_DELTA_RE = re.compile(r"\s*\S{1,5}|\s+")
+# Обрезка HTML для html.fix — посреди тегов, как у недописанного ответа
+_TRUNCATE_AT = 0.6
+
+
+class Case:
+    __slots__ = ("name", "fn", "ops")
+
+    def __init__(self, name: str, fn: Callable[[], Any], ops: int = 1) -> None:
+        self.name = name
+        self.fn = fn
+        self.ops = ops
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Корпус
+# ────────────────────────────────────────────────────────────────────────────
+def load_corpus() -> dict[str, str]:
+    corpus = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith(".md"):
+            with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+                corpus[name[:-3]] = f.read()
+    # Длинный ответ — здесь стоимость flush'а и split растёт заметнее всего
+    corpus["all"] = "\n\n".join(corpus.values())
+    return corpus
+
+
+def load_intents() -> dict[str, list[str]]:
+    with open(os.path.join(CORPUS_DIR, "intents.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Бенчмарки
+# ────────────────────────────────────────────────────────────────────────────
+def _simulate_stream(deltas: list[str], flush_chars: int, incremental: bool) -> int:
+    """Цикл отрисовки _stream_via_edit_text без сети; возвращает число flush'ей."""
+    renderer = StreamingMarkdownRenderer()
+    parts: list[str] = []
+    last_shown = ""
+    pending = 0
+    flushes = 0
+    for delta in deltas:
+        renderer.feed(delta)
+        parts.append(delta)
+        pending += len(delta)
+        if pending < flush_chars:
+            continue
+        pending = 0
+        html = renderer.render() if incremental else markdown_to_telegram_html("".join(parts))
+        if html.strip() and html != last_shown:
+            last_shown = html
+            flushes += 1
+    final = renderer.finish() if incremental else markdown_to_telegram_html("".join(parts))
+    contains_rich_markup(renderer.text)
+    return flushes + (final != last_shown)
+
+
+def markdown_cases(corpus: dict[str, str], flush_chars: int) -> list[Case]:
+    cases = []
+    for name, text in corpus.items():
+        html = markdown_to_telegram_html(text)
+        cases.append(Case(f"markdown.render[{name}]", lambda t=text: markdown_to_telegram_html(t)))
+        cases.append(Case(f"markdown.rich[{name}]", lambda t=text: contains_rich_markup(t)))
+        cases.append(Case(f"html.fix[{name}]", lambda h=html: _validate_and_fix_html(h)))
+        cut = html[: int(len(html) * _TRUNCATE_AT)]
+        cases.append(Case(f"html.fix[{name}.truncated]", lambda h=cut: _validate_and_fix_html(h)))
+
+    for name in ("code_long", "mixed", "all"):
+        deltas = _DELTA_RE.findall(corpus[name])
+        for label, incremental in (("stream.flush", True), ("stream.flush_full", False)):
+            flushes = _simulate_stream(deltas, flush_chars, incremental)
+            cases.append(Case(
+                f"{label}[{name}]",
+                lambda d=deltas, inc=incremental: _simulate_stream(d, flush_chars, inc),
+                ops=flushes,
+            ))
+    return cases
+
+
+def _config_env() -> None:
+    """config требует токены — для импорта хватает фиктивных."""
+    for key in ("BOT_TOKEN", "NEURO_API_KEY", "GROQ_API_KEY"):
+        os.environ.setdefault(key, "123456:BENCH")
+
+
+def split_cases(corpus: dict[str, str]) -> list[Case]:
+    _config_env()
+    from config.config import MAX_RICH_MESSAGE_LENGTH, MAX_TELEGRAM_MESSAGE_LENGTH
+    from utils.telegram_helpers import _split_text
+
+    html = markdown_to_telegram_html(corpus["all"])
+    rich = corpus["all"] * 4
+    return [
+        Case(f"split_text[html,{MAX_TELEGRAM_MESSAGE_LENGTH}]",
+             lambda: _split_text(html, MAX_TELEGRAM_MESSAGE_LENGTH)),
+        Case(f"split_text[rich,{MAX_RICH_MESSAGE_LENGTH}]",
+             lambda: _split_text(rich, MAX_RICH_MESSAGE_LENGTH)),
+    ]
+
+
+def intent_cases(intents: dict[str, list[str]]) -> list[Case]:
+    _config_env()
+    from utils.universal_analyzer import UniversalAnalyzer
+
+    # Без __init__: клиент Groq и модель намерения этим методам не нужны
+    analyzer = UniversalAnalyzer.__new__(UniversalAnalyzer)
+    responses = intents["responses"]
+    user_texts = intents["user_texts"]
+
+    def parse() -> None:
+        for r in responses:
+            analyzer._parse_intent(r)
+
+    def fallback() -> None:
+        for t in user_texts:
+            analyzer._fallback_intent(t)
+
+    return [
+        Case("intent.parse", parse, ops=len(responses)),
+        Case("intent.fallback", fallback, ops=len(user_texts)),
+    ]
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Замеры
+# ────────────────────────────────────────────────────────────────────────────
+def _timeit(fn: Callable[[], Any], loops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn()
+    return time.perf_counter() - start
+
+
+def measure(fn: Callable[[], Any], ops: int, repeat: int) -> dict[str, Any]:
+    """Как timeit.autorange: loops подбирается до _MIN_TIME, потом repeat замеров."""
+    loops = 1
+    while True:
+        if _timeit(fn, loops) >= _MIN_TIME:
+            break
+        loops *= 2
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        per_op_us = [_timeit(fn, loops) / loops / max(1, ops) * 1e6 for _ in range(repeat)]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {
+        "best_us": round(min(per_op_us), 3),
+        "median_us": round(statistics.median(per_op_us), 3),
+        "ops": ops,
+        "loops": loops,
+    }
+
+
+def _calibration_loop() -> None:
+    # Строки, dict и срезы — из того же, из чего состоят бенчмарки
+    counts: dict[str, int] = {}
+    text = "абв где жзи клм " * 64
+    for i in range(0, len(text), 7):
+        word = text[i:i + 5]
+        counts[word] = counts.get(word, 0) + 1
+    "".join(sorted(counts))
+
+
+def calibrate(repeat: int) -> float:
+    """Скорость машины: время калибровочного цикла, мкс."""
+    return measure(_calibration_loop, 1, max(repeat, 5))["best_us"]
+
+
+def run(filter_: Optional[str], repeat: int, flush_chars: int) -> dict[str, Any]:
+    # Калибровка до и после: после долгого прогона машина бывает медленнее
+    calibration = calibrate(repeat)
+    corpus = load_corpus()
+    cases = markdown_cases(corpus, flush_chars)
+    skipped: dict[str, str] = {}
+    for group, build in (
+        ("split_text", lambda: split_cases(corpus)),
+        ("intent", lambda: intent_cases(load_intents())),
+    ):
+        try:
+            cases += build()
+        except ImportError as e:
+            skipped[group] = f"{type(e).__name__}: {e}"
+
+    results = {}
+    for case in cases:
+        if filter_ and filter_ not in case.name:
+            continue
+        results[case.name] = measure(case.fn, case.ops, repeat)
+        print(f"  {case.name:<40} {results[case.name]['best_us']:>12.2f} µs", file=sys.stderr)
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "flush_chars": flush_chars,
+        "calibration_us": min(calibration, calibrate(repeat)),
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def check_streaming(results: dict[str, Any]) -> list[str]:
+    """Файлы, где инкрементальный stream.flush не обогнал полный рендер."""
+    slow = []
+    for name, result in results.items():
+        if not name.startswith("stream.flush["):
+            continue
+        full = results.get(name.replace("stream.flush[", "stream.flush_full[", 1))
+        if full is not None and result["best_us"] >= full["best_us"]:
+            slow.append(name)
+    return slow
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[dict[str, Any]]:
+    """Строки сравнения; ratio — нормированное время относительно базы."""
+    scale = current["calibration_us"] / baseline["calibration_us"]
+    rows = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append({"name": name, "status": "new"})
+            continue
+        ratio = result["best_us"] / (base["best_us"] * scale)
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append({"name": name, "ratio": round(ratio, 3), "status": status})
+    return rows
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("-k", dest="filter", help="только бенчмарки с этой подстрокой в имени")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--flush-chars", type=int, default=200, help="символов между flush'ами в stream.*")
+    parser.add_argument("--out", help="записать результаты в JSON")
+    parser.add_argument("--compare", metavar="BASELINE", help="сравнить с базой (JSON прошлого прогона)")
+    parser.add_argument("--threshold", type=float, default=0.15, help="допустимый рост времени, доля")
+    parser.add_argument("--save-baseline", action="store_true", help=f"перезаписать {BASELINE_PATH}")
+    args = parser.parse_args(argv)
+
+    current = run(args.filter, args.repeat, args.flush_chars)
+    if current["skipped"]:
+        for group, reason in current["skipped"].items():
+            print(f"skipped {group}: {reason}", file=sys.stderr)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(current, baseline, args.threshold)
+        current["comparison"] = {"baseline": args.compare, "threshold": args.threshold, "rows": rows}
+        regressions = [r for r in rows if r["status"] == "regression"]
+        for row in rows:
+            ratio = f"{row['ratio']:.2f}×" if "ratio" in row else "—"
+            print(f"  {row['name']:<40} {ratio:>8}  {row['status']}", file=sys.stderr)
+
+    text = json.dumps(current, indent=2, ensure_ascii=False)
+    for path in filter(None, (args.out, BASELINE_PATH if args.save_baseline else None)):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    slow = check_streaming(current["results"])
+    for name in slow:
+        print(f"{name} is not faster than a full re-render", file=sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+    if regressions or slow:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from environs import Env
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.redis import RedisStorage
 from redis.asyncio import Redis
@@ -23,9 +24,20 @@ NEURO_API_KEY: str = env("NEURO_API_KEY")
 GROQ_API_KEY: str = env("GROQ_API_KEY")
 PROXY: str = env("PROXY", default="")  # формат host:port или user:pass@host:port
 
+# Свои адреса Bot API и LLM-провайдеров: локальный Bot API сервер или
+# фейковые серверы нагрузочного теста (loadtest/). Пусто — стандартные.
+TELEGRAM_API_URL: str = env("TELEGRAM_API_URL", default="")
+NEURO_BASE_URL: str = env("NEURO_BASE_URL", default="")
+GROQ_BASE_URL: str = env("GROQ_BASE_URL", default="https://api.groq.com/openai/v1")
+
 # Опционально — секретный токен для верификации webhook (Telegram присылает его в заголовке)
 WEBHOOK_SECRET: str = env("WEBHOOK_SECRET", default="")
 
+# Запасные OpenAI-совместимые эндпоинты для hedged-запросов (utils/llm_pool.py),
+# JSON-список: [{"name": "azure", "base_url": "https://...", "api_key": "...",
+#               "model": "имя модели у провайдера (необяз.)", "proxy": false}]
+LLM_FALLBACK_ENDPOINTS: list = env.json("LLM_FALLBACK_ENDPOINTS", default=[])
+
 REDIS_HOST: str = env("REDIS_HOST", default="redis")
 REDIS_PORT: int = env.int("REDIS_PORT", default=6379)
 REDIS_DB: int = env.int("REDIS_DB", default=0)
@@ -35,7 +47,9 @@ REDIS_DB: int = env.int("REDIS_DB", default=0)
 # AIOGRAM
 # ────────────────────────────────────────────────────────────────────────────
 # AiohttpSession — явная сессия, чтобы корректно закрыть на shutdown
-session = AiohttpSession()
+session = AiohttpSession(
+    api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION
+)
 
 bot: Bot = Bot(
     token=BOT_TOKEN,
@@ -69,8 +83,25 @@ SUPPORT_USERNAME = "@boompi_ai_support"
 # ────────────────────────────────────────────────────────────────────────────
 # Лимиты и режимы
 # ────────────────────────────────────────────────────────────────────────────
-MAX_WORD_COUNT = 3000
+# Лимит входа (текст, транскрипт, документ) — в токенах модели, не в словах
+# (utils/tokens.py). 6000 ≈ прежние 3000 слов русского текста.
+MAX_INPUT_TOKENS = 6000
 MAX_CONTEXT_MESSAGES = 7
+
+# Контекст в промпте: самые новые пары в пределах бюджета токенов + пересказ
+# более старых. Пересказ обновляется в фоне после ответа (utils/functions.py),
+# моделью SUMMARY_MODEL через Groq.
+CONTEXT_TOKEN_BUDGET = 2500
+CONTEXT_SUMMARY_MAX_TOKENS = 400
+SUMMARY_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+# Пересказ одного пользователя делает одна реплика: SET NX на столько секунд
+# (с запасом на очередь Groq и сам вызов; по завершении лок снимается)
+SUMMARY_LOCK_TTL = 120
+
+# Формат записей контекста — msgpack + zstd со словарём (utils/context_codec.py).
+# Нет файла словаря — zstd без словаря; старые JSON-записи читаются всегда.
+CONTEXT_DICT_PATH = env("CONTEXT_DICT_PATH", default="data/context.zdict")
+CONTEXT_ZSTD_LEVEL = 3
 MAX_TELEGRAM_MESSAGE_LENGTH = 4096  # лимит Telegram для обычных sendMessage
 
 # Bot API 10.1 (июнь 2026): rich-сообщения (таблицы, LaTeX-формулы и т.п.)
@@ -91,6 +122,18 @@ MAX_OUTPUT_TOKENS_CODE = 1000
 
 # Streaming
 USE_STREAM = True
+# Когда обновлять стрим-сообщение (utils/stream_flush.py): "adaptive" — первый
+# текст сразу, дальше интервал по задержке edit'ов, 429 в чате, скорости
+# токенов и длине сообщения; "fixed" — прежнее правило по TIME_STREAM_UPDATE.
+STREAM_FLUSH_POLICY = env("STREAM_FLUSH_POLICY", default="adaptive")
+# A/B: доля чатов (0..1, по хэшу chat_id), которые получают STREAM_FLUSH_POLICY_B
+STREAM_FLUSH_POLICY_B = env("STREAM_FLUSH_POLICY_B", default="fixed")
+STREAM_FLUSH_B_SHARE = env.float("STREAM_FLUSH_B_SHARE", default=0.0)
+STREAM_FLUSH_MIN_INTERVAL = 0.3  # сек — чаще не обновляем даже в быстром чате
+STREAM_FLUSH_MAX_INTERVAL = 4.0  # сек — реже не обновляем даже после 429
+STREAM_FLUSH_TARGET_CHARS = 40  # меньше нового текста за обновление показывать незачем
+STREAM_FLUSH_SEC_PER_KCHAR = 0.3  # + к интервалу за каждые 1000 символов сообщения
+# Политика "fixed"
 TIME_STREAM_UPDATE = 1.2  # сек между edit_text — щадящий темп для Telegram
 STREAM_MIN_CHUNK_SIZE = 50
 STREAM_MAX_CHUNK_SIZE = 350
@@ -99,17 +142,149 @@ STREAM_MAX_CHUNK_SIZE = 350
 # т.к. требует свежего сервера Bot API. При проблемах сразу падает в fallback edit_text.
 USE_NATIVE_DRAFT_STREAM = env.bool("USE_NATIVE_DRAFT_STREAM", default=False)
 
+# Исходящие лимиты Telegram — проактивный троттлинг (utils/rate_limiter.py)
+TG_GLOBAL_RATE = 30.0  # сообщений/сек на бота суммарно
+TG_CHAT_RATE = 1.0  # сообщений/сек в личный чат (edit'ы тоже считаются)
+TG_GROUP_RATE = 20 / 60  # в группы Telegram пускает ~20 сообщений в минуту
+TG_CHAT_BURST = 3  # короткий всплеск, который Telegram прощает
+
+# Текст без картинок: стрим основной модели стартует параллельно с Groq-анализом
+# по локальной догадке о намерении; при промахе — перезапуск до первого токена.
+USE_SPECULATIVE_DISPATCH = env.bool("USE_SPECULATIVE_DISPATCH", default=True)
+
+# Локальный классификатор намерения (utils/intent_classifier.py) перед Groq.
+# Нет файла модели — все запросы идут в Groq. Обучение:
+#   python -m utils.intent_classifier export decisions.jsonl
+#   python -m utils.intent_classifier train decisions.jsonl
+INTENT_MODEL_PATH = env("INTENT_MODEL_PATH", default="data/intent_model.json")
+INTENT_CONFIDENCE = 0.9  # ниже — классификатор не уверен, спрашиваем Groq
+INTENT_AUDIT_RATE = 0.05  # доля уверенных запросов, которые всё равно размечает Groq
+INTENT_DECISIONS_MAX = 50_000  # сколько решений Groq хранить в Redis для обучения
+
 # Изображения
 MAX_IMAGES_PER_REQUEST = 5
 MAX_IMAGE_SIZE_MB = 4
 MAX_IMAGE_RESOLUTION_MP = 33
 
+# Перед vision-моделью картинка уменьшается и пережимается (utils/images.py).
+# Большая сторона больше VISION_MAX_SIDE модели не нужна — тайлы всё равно мельче.
+VISION_MAX_SIDE = 1280
+VISION_IMAGE_FORMAT = env("VISION_IMAGE_FORMAT", default="WEBP")  # WEBP или JPEG
+VISION_IMAGE_QUALITY = 85
+IMAGE_POOL_WORKERS = env.int("IMAGE_POOL_WORKERS", default=2)
+
+# Кэш статуса подписки на канал (utils/subscription_cache.py).
+# Сброс по chat_member-апдейтам канала — бот должен быть админом канала.
+SUBSCRIPTION_CACHE_TTL_POSITIVE = 3600  # сек
+SUBSCRIPTION_CACHE_TTL_NEGATIVE = 60  # сек — только что подписавшийся не должен ждать
+SUBSCRIPTION_CACHE_LOCAL_TTL = 30  # сек — окно рассинхрона между репликами
+SUBSCRIPTION_CACHE_LOCAL_SIZE = 50_000
+
+# Медиа держим в памяти (utils/media.py); на диск — только то, что больше порога
+MEDIA_SPILL_BYTES = 8 * 1024 * 1024
+MEDIA_SPILL_DIR = "documents"
+
+# Голосовые: OGG/Opus от Telegram отправляем на транскрипцию как есть;
+# ffmpeg (stdin → stdout) — только если эндпоинт OGG не принимает.
+WHISPER_ACCEPTS_OGG = env.bool("WHISPER_ACCEPTS_OGG", default=True)
+FFMPEG_MAX_PROCS = env.int("FFMPEG_MAX_PROCS", default=4)
+
+# Документы (utils/documents.py): текст извлекается в пуле процессов,
+# постранично, с остановкой на MAX_INPUT_TOKENS. Больше DOCUMENT_MAX_MB
+# не скачиваем вовсе, PDF длиннее DOCUMENT_MAX_PAGES не парсим.
+DOCUMENT_MAX_MB = 20
+DOCUMENT_MAX_PAGES = 300
+DOCUMENT_POOL_WORKERS = env.int("DOCUMENT_POOL_WORKERS", default=2)
+
+# Кэш текста документов и транскрипций (utils/media_cache.py): по
+# file_unique_id и хэшу содержимого, zlib в Redis. Бюджет — в сжатых байтах,
+# сверх него вытесняются давно не читанные записи; TTL продлевается на чтении.
+USE_MEDIA_CACHE = env.bool("USE_MEDIA_CACHE", default=True)
+MEDIA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+MEDIA_CACHE_TTL = 7 * 24 * 3600
+
+# Кэш ответов на запросы без контекста (utils/response_cache.py): ключ —
+# хэш (промпт, модель, текст). Одинаковые запросы в полёте делят один стрим.
+USE_RESPONSE_CACHE = env.bool("USE_RESPONSE_CACHE", default=True)
+RESPONSE_CACHE_TTL = 6 * 3600
+
 # Per-user lock — сколько ждать перед тем как сказать «уже обрабатываю»
 USER_LOCK_TTL = 120  # сек
 
+# Отмена запросов между репликами (utils/cancellation.py): задача пишет в
+# Redis, какая реплика её ведёт; [Отменить], пришедший на другую реплику,
+# уходит владельцу через pub/sub. REPLICA_ID пустой — hostname:pid:случайное.
+REPLICA_ID: str = env("REPLICA_ID", default="")
+CANCEL_OWNER_TTL = 15 * 60  # сек, с запасом на очередь admission и длинный стрим
+CANCEL_DONE_TTL = 10 * 60  # сколько помним, что запрос уже завершён
+CANCEL_REPLY_TIMEOUT = 2  # сек ждём ответа реплики-владельца
+
+# Graceful shutdown (main.on_shutdown): столько ждём начатые апдейты и
+# стримы, прежде чем отменить их и закрыть клиенты. Меньше, чем
+# WORKER_STOP_TIMEOUT супервизора и stop_grace_period в docker-compose.
+DRAIN_TIMEOUT = env.float("DRAIN_TIMEOUT", default=45.0)
+
 # Модель основного провайдера
 MODEL_NAME = "gpt-5.6-sol"
 
+# Hedged-запросы к основной модели (utils/llm_pool.py): если первый токен не
+# пришёл за HEDGE_PERCENTILE недавних TTFT эндпоинта, тот же запрос уходит на
+# запасной; побеждает первый. Хеджей — не больше HEDGE_MAX_RATIO от запросов.
+USE_HEDGING = env.bool("USE_HEDGING", default=True)
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 1.0  # сек
+HEDGE_MAX_DELAY = 8.0
+HEDGE_DEFAULT_DELAY = 3.0  # пока статистики меньше 20 запросов
+HEDGE_WINDOW = 200  # сколько последних TTFT держим на эндпоинт
+HEDGE_MAX_RATIO = 0.1
+
+# Admission control (utils/admission.py): сколько запросов одновременно идёт в
+# каждый upstream и сколько ждёт в очереди (FIFO). Лимиты ниже max_connections
+# пулов httpx (100): основная модель и Whisper делят http_client_main.
+# Очередь полна — запрос сразу получает «сервер перегружен».
+ADMISSION_MAIN_CONCURRENCY = env.int("ADMISSION_MAIN_CONCURRENCY", default=80)
+ADMISSION_MAIN_QUEUE = env.int("ADMISSION_MAIN_QUEUE", default=300)
+ADMISSION_GROQ_CONCURRENCY = env.int("ADMISSION_GROQ_CONCURRENCY", default=40)
+ADMISSION_GROQ_QUEUE = env.int("ADMISSION_GROQ_QUEUE", default=200)
+ADMISSION_WHISPER_CONCURRENCY = env.int("ADMISSION_WHISPER_CONCURRENCY", default=15)
+ADMISSION_WHISPER_QUEUE = env.int("ADMISSION_WHISPER_QUEUE", default=100)
+ADMISSION_MAX_WAIT = 90.0  # сек в очереди, дальше — отказ
+ADMISSION_POSITION_INTERVAL = 3.0  # как часто обновлять позицию в loader'е, сек
+
+# Квоты (utils/quotas.py): скользящие окна в Redis — запросы, токены основной
+# модели (prompt + completion по usage) и секунды голосовых. Лимиты на
+# пользователя зависят от tier'а: ресурс → {окно в сек: лимит}; пустой набор —
+# без ограничений. Tier задаётся списками id в QUOTA_TIER_USERS
+# ({"pro": [123, 456]}), остальные — "free". QUOTA_TIER_TOTALS — общие окна на
+# весь tier (сколько могут забрать все бесплатные вместе), в том же формате.
+USE_QUOTAS = env.bool("USE_QUOTAS", default=True)
+QUOTA_TIERS: dict = {
+    "free": {
+        "requests": {60: 10, 3600: 120, 86400: 400},
+        "tokens": {3600: 400_000, 86400: 2_000_000},
+        "media_seconds": {3600: 900, 86400: 3600},
+    },
+    "pro": {
+        "requests": {60: 30, 3600: 600, 86400: 3000},
+        "tokens": {3600: 2_000_000, 86400: 10_000_000},
+        "media_seconds": {3600: 3600, 86400: 14_400},
+    },
+    "staff": {},
+}
+QUOTA_TIER_USERS: dict = env.json("QUOTA_TIER_USERS", default={})
+QUOTA_TIER_TOTALS: dict = env.json("QUOTA_TIER_TOTALS", default={})
+# Токены списываются сразу — текст запроса + этот запас на контекст и ответ;
+# после стрима разница досписывается (или возвращается) по usage
+QUOTA_TOKEN_RESERVE = 1500
+
+# Трейсинг (utils/tracing.py): span'ы из log_timing, JSON-строкой в логгер
+# "trace" (в TRACE_JSON_PATH или stdout) и, если задан OTLP_ENDPOINT, в
+# коллектор по OTLP/HTTP (например http://otel-collector:4318).
+TRACE_SAMPLE_RATE = env.float("TRACE_SAMPLE_RATE", default=0.05)  # доля апдейтов с полным трейсом
+TRACE_SLOW_MS = env.int("TRACE_SLOW_MS", default=10_000)  # span'ы дольше — выводятся всегда
+TRACE_JSON_PATH = env("TRACE_JSON_PATH", default="")
+OTLP_ENDPOINT = env("OTLP_ENDPOINT", default="")
+
 
 # ────────────────────────────────────────────────────────────────────────────
 # Промпты
@@ -153,6 +328,17 @@ CODE_GENERATION_PROMPT = r"""
 """
 
 
+SUMMARY_PROMPT = """Ты сжимаешь историю диалога пользователя с ассистентом.
+Тебе дают текущий пересказ (если есть) и новые реплики. Верни обновлённый пересказ:
+- кто пользователь и чем занимается, если это видно;
+- о чём спрашивал и какие ответы/решения получил — кратко, по сути;
+- договорённости, исходные данные и требования, на которые он может сослаться дальше;
+- код не переписывай целиком — только язык, назначение и ключевые имена.
+Пиши по-русски, сплошным текстом или короткими пунктами, не больше 250 слов.
+Без вступлений — только сам пересказ."""
+
+
+
 # ────────────────────────────────────────────────────────────────────────────
 # HTTP клиенты
 # ────────────────────────────────────────────────────────────────────────────
@@ -168,13 +354,27 @@ _timeout = httpx.Timeout(connect=10.0, read=180.0, write=30.0, pool=10.0)
 http_client_main = httpx.AsyncClient(proxy=_proxy_url, limits=_limits, timeout=_timeout)
 http_client_groq = httpx.AsyncClient(limits=_limits, timeout=_timeout)
 
-client = AsyncOpenAI(api_key=NEURO_API_KEY, http_client=http_client_main)
+client = AsyncOpenAI(api_key=NEURO_API_KEY, base_url=NEURO_BASE_URL or None, http_client=http_client_main)
 groq_client = AsyncOpenAI(
-    base_url="https://api.groq.com/openai/v1",
+    base_url=GROQ_BASE_URL,
     api_key=GROQ_API_KEY,
     http_client=http_client_groq,
 )
 
+# Запасные эндпоинты основной модели: (name, client, model | None)
+http_clients_fallback: list[httpx.AsyncClient] = []
+fallback_llm_clients: list[tuple[str, AsyncOpenAI, str | None]] = []
+for _ep in LLM_FALLBACK_ENDPOINTS:
+    _http = httpx.AsyncClient(
+        proxy=_proxy_url if _ep.get("proxy") else None, limits=_limits, timeout=_timeout
+    )
+    http_clients_fallback.append(_http)
+    fallback_llm_clients.append((
+        _ep.get("name") or _ep["base_url"],
+        AsyncOpenAI(base_url=_ep["base_url"], api_key=_ep["api_key"], http_client=_http),
+        _ep.get("model"),
+    ))
+
 
 async def shutdown_clients() -> None:
     """Корректно закрывает все ресурсы. Вызывается из main.on_shutdown."""
@@ -187,6 +387,11 @@ async def shutdown_clients() -> None:
         await http_client_groq.aclose()
     except Exception as e:
         logging.warning(f"Error closing groq http client: {e}")
+    for http in http_clients_fallback:
+        try:
+            await http.aclose()
+        except Exception as e:
+            logging.warning(f"Error closing fallback http client: {e}")
     try:
         await session.close()
     except Exception as e:
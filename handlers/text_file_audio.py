@@ -11,19 +11,16 @@ from __future__ import annotations
 import asyncio
 import json
 import logging
-import os
 import random
 import time
-from contextlib import asynccontextmanager, suppress
-from pathlib import Path
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
 
-import aiofiles
 from aiogram import F, Router
 from aiogram.enums.chat_action import ChatAction
 from aiogram.enums.chat_member_status import ChatMemberStatus
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     CallbackQuery,
+    ChatMemberUpdated,
     InlineKeyboardMarkup,
     Message,
     ReactionTypeEmoji,
@@ -35,45 +32,56 @@ from config.config import (
     redis,
     groq_client,
     CHANNEL_USERNAME,
-    MAX_WORD_COUNT,
+    DOCUMENT_MAX_MB,
+    MAX_INPUT_TOKENS,
     MAX_IMAGES_PER_REQUEST,
     USE_STREAM,
     USE_NATIVE_DRAFT_STREAM,
     USE_RICH_MESSAGES,
-    TIME_STREAM_UPDATE,
-    STREAM_MIN_CHUNK_SIZE,
-    STREAM_MAX_CHUNK_SIZE,
+    USE_SPECULATIVE_DISPATCH,
     USER_LOCK_TTL,
+    VISION_MAX_SIDE,
 )
 from keyboards.keyboards import channel_subscription_keyboard
 from lexicon.lexicon import LEXICON_RU as lexicon
+from utils.admission import Overloaded, admission
 from utils.cancellation import (
     CANCEL_CB_PREFIX,
+    CANCELLED,
+    UNKNOWN,
     cancel_task,
     make_cancel_keyboard,
     parse_cancel_data,
     register_task,
 )
+from utils.documents import DocumentText, DocumentTooLarge, extract_text, extractor_for
 from utils.functions import (
-    contains_rich_markup,
     generate_code,
-    markdown_to_telegram_html,
     process_audio_with_whisper,
     process_request,
-    read_docx,
-    read_pdf,
-    read_txt,
     save_context,
 )
+from utils.images import pick_photo_size
 from utils.logging_helpers import log_event, log_timing
+from utils.media import MediaBuffer, download_media, download_media_group
+from utils.media_cache import content_digest, media_cache
+from utils.markdown import StreamingMarkdownRenderer, contains_rich_markup
+from utils.quotas import Charge, MeteredStream, QuotaExceeded, quotas
+from utils.stream_flush import make_flush_policy
+from utils.stream_pump import StreamPump
+from utils.subscription_cache import subscription_cache
+from utils.tracing import set_stage
 from utils.telegram_helpers import (
     safe_answer,
+    safe_delete,
+    safe_edit_reply_markup,
     safe_edit_text,
     safe_edit_text_rich,
     send_long_rich_text,
     send_long_text,
     send_message_draft,
 )
+from utils.tokens import exceeds
 from utils.universal_analyzer import UniversalAnalyzer
 
 logger = logging.getLogger(__name__)
@@ -81,8 +89,10 @@ rt = Router()
 
 POPULAR_EMOJIS = ["👍", "❤️", "🔥", "😍", "🎉", "😢", "🤔", "😡", "😭", "😴", "🤯"]
 
-DOCUMENTS_DIR = Path("documents")
-DOCUMENTS_DIR.mkdir(exist_ok=True)
+# Тексты loader'а по стадиям
+_LOADER_THINKING = "💭 <b>Думаю...</b>"
+_LOADER_IMAGE = "🖼 <b>Распознаю изображение...</b>"
+_LOADER_ANSWERING = "✍️ <b>Готовлю ответ...</b>"
 
 analyzer = UniversalAnalyzer(groq_client)
 
@@ -108,22 +118,79 @@ async def user_lock(user_id: int):
         log_event("user_lock.released", user=user_id)
 
 
+# ────────────────────────────────────────────────────────────────────────────
+# Квоты
+# ────────────────────────────────────────────────────────────────────────────
+_QUOTA_RESOURCES = {
+    "requests": "запросов",
+    "tokens": "объёма ответов",
+    "media_seconds": "голосовых",
+}
+
+
+def _format_wait(seconds: float) -> str:
+    if seconds < 60:
+        return f"через {max(1, int(seconds))} сек"
+    if seconds < 3600:
+        return f"через {-(-int(seconds) // 60)} мин"
+    return f"через {-(-int(seconds) // 3600)} ч"
+
+
+def _quota_message(e: QuotaExceeded) -> str:
+    if e.scope == "tier":
+        # Общий лимит tier'а — для пользователя это просто перегрузка
+        return lexicon["overloaded"]
+    if e.retry_after is None:
+        return lexicon["quota_too_large"]
+    return lexicon["quota_exceeded"].format(
+        what=_QUOTA_RESOURCES[e.resource], wait=_format_wait(e.retry_after)
+    )
+
+
 # ────────────────────────────────────────────────────────────────────────────
 # Подписка на канал
 # ────────────────────────────────────────────────────────────────────────────
-async def is_subscribed(user_id: int) -> bool:
+_MEMBER_STATUSES = (
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.CREATOR,
+)
+
+
+async def is_subscribed(user_id: int, *, refresh: bool = False) -> bool:
+    """
+    Сначала кэш (utils/subscription_cache.py), getChatMember — только на
+    промахе или при refresh=True (кнопка «Проверить подписку»).
+    """
+    if not refresh:
+        cached = await subscription_cache.get(user_id)
+        if cached is not None:
+            log_event("subscription.cache_hit", user=user_id, subscribed=cached)
+            return cached
+
+    start = time.monotonic()
     try:
         async with log_timing("telegram.get_chat_member", user=user_id, channel=CHANNEL_USERNAME):
             member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return member.status in (
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.CREATOR,
-        )
     except Exception as e:
+        # Ошибку не кэшируем — следующий запрос проверит заново
         logger.error(f"Subscription check failed for {user_id}: {e}")
         return False
 
+    subscribed = member.status in _MEMBER_STATUSES
+    subscription_cache.record_check((time.monotonic() - start) * 1000)
+    await subscription_cache.set(user_id, subscribed)
+    stats = subscription_cache.stats()
+    log_event(
+        "subscription.checked",
+        user=user_id,
+        subscribed=subscribed,
+        refresh=refresh,
+        hit_rate=f"{stats['hit_rate']:.2f}",
+        check_ms_avg=f"{stats['check_ms_avg']:.0f}",
+    )
+    return subscribed
+
 
 async def check_subscription(msg: Message) -> bool:
     if await is_subscribed(msg.from_user.id):
@@ -136,6 +203,15 @@ async def check_subscription(msg: Message) -> bool:
     return False
 
 
+@rt.chat_member(F.chat.username == CHANNEL_USERNAME.lstrip("@"))
+async def channel_member_updated(event: ChatMemberUpdated) -> None:
+    """Подписка/отписка в канале — сразу обновляем кэш, не дожидаясь TTL."""
+    user_id = event.new_chat_member.user.id
+    subscribed = event.new_chat_member.status in _MEMBER_STATUSES
+    await subscription_cache.set(user_id, subscribed)
+    log_event("subscription.updated", user=user_id, subscribed=subscribed)
+
+
 # ────────────────────────────────────────────────────────────────────────────
 # Streaming
 # ────────────────────────────────────────────────────────────────────────────
@@ -150,86 +226,80 @@ async def _stream_via_edit_text(
 
     cancel_markup передаётся на КАЖДОМ edit, иначе Telegram удаляет кнопку.
     На финальном edit передаётся reply_markup=None — кнопка снимается.
+    HTML считается инкрементально (StreamingMarkdownRenderer) — на каждом
+    flush рендерится только незакоммиченный хвост ответа, финал — finish().
     """
-    full_response = ""
-    buffer = ""
+    renderer = StreamingMarkdownRenderer()
+    flush = make_flush_policy(msg.chat.id)
     sent_message: Message | None = None
     last_shown_html = ""
-    last_update = time.monotonic() - TIME_STREAM_UPDATE
     stream_error: Exception | None = None
-    chunks_received = 0
     edits_done = 0
 
     if initial_message is not None:
         sent_message = initial_message
 
     stream_start = time.monotonic()
+    pump = StreamPump(stream_response, renderer, flush)
 
     try:
-        async for chunk in stream_response:
-            if not chunk.choices:
-                continue
-            delta = chunk.choices[0].delta.content
-            if not delta:
-                continue
-
-            chunks_received += 1
-            buffer += delta
-            full_response += delta
-
-            elapsed = time.monotonic() - last_update
-            ready_to_show = (
-                len(buffer) >= STREAM_MAX_CHUNK_SIZE
-                or (elapsed >= TIME_STREAM_UPDATE and len(buffer) >= STREAM_MIN_CHUNK_SIZE)
-            )
-            if not ready_to_show:
+        while not pump.done:
+            # Edit'ы не тормозят чтение стрима: показываем самый свежий снимок
+            await pump.wait(flush.delay())
+            if not flush.ready():
                 continue
 
-            html_now = markdown_to_telegram_html(full_response)
+            html_now = renderer.render()
             if not html_now.strip() or html_now == last_shown_html:
-                buffer = ""
+                flush.on_skip()
                 continue
 
+            flush_start = time.monotonic()
             if sent_message is None:
                 sent_message = await safe_answer(
                     msg, html_now, parse_mode="HTML", reply_markup=cancel_markup
                 )
-                if sent_message is not None:
-                    last_shown_html = html_now
-                    last_update = time.monotonic()
-                    edits_done += 1
+                ok = sent_message is not None
             else:
                 ok = await safe_edit_text(
                     sent_message, html_now, parse_mode="HTML", reply_markup=cancel_markup
                 )
-                if ok:
-                    last_shown_html = html_now
-                    last_update = time.monotonic()
-                    edits_done += 1
-
-            buffer = ""
+            flush.on_flush(time.monotonic() - flush_start, ok)
+            if ok:
+                last_shown_html = html_now
+                edits_done += 1
+                if edits_done == 1:
+                    log_event(
+                        "stream.first_visible",
+                        policy=flush.name,
+                        ttfvt_ms=int((time.monotonic() - stream_start) * 1000),
+                    )
 
     except asyncio.CancelledError:
         # Не глотаем — это сигнал отмены пользователем или shutdown'а
         log_event(
             "stream.cancelled",
-            chunks=chunks_received,
+            chunks=pump.chunks,
             edits=edits_done,
-            chars=len(full_response),
+            chars=len(renderer),
             took_ms=int((time.monotonic() - stream_start) * 1000),
         )
         raise
     except Exception as e:
-        logger.warning(f"Stream interrupted mid-flight: {e}")
+        logger.warning(f"Stream rendering interrupted: {e}")
         stream_error = e
+    finally:
+        await pump.aclose()
+    stream_error = stream_error or pump.error
 
     # ── Финал: всегда выводим то, что успели накопить (без cancel-кнопки) ──
+    full_response = renderer.text
     if not full_response.strip():
         if stream_error:
             raise stream_error
         return full_response
 
-    final_html = markdown_to_telegram_html(full_response)
+    final_html = renderer.finish()
     use_rich = USE_RICH_MESSAGES and contains_rich_markup(full_response)
 
     if use_rich:
@@ -252,12 +322,12 @@ async def _stream_via_edit_text(
             await send_long_text(msg, final_html, parse_mode="HTML")
     else:
         # Текст не изменился, но кнопку убрать всё равно надо
-        with suppress(Exception):
-            await sent_message.edit_reply_markup(reply_markup=None)
+        await safe_edit_reply_markup(sent_message)
 
     log_event(
         "stream.done",
-        chunks=chunks_received,
+        policy=flush.name,
+        chunks=pump.chunks,
         edits=edits_done,
         chars=len(full_response),
         took_ms=int((time.monotonic() - stream_start) * 1000),
@@ -273,9 +343,8 @@ async def _stream_via_native_draft(
     cancel_markup: InlineKeyboardMarkup | None = None,
 ) -> str:
     """Native draft streaming через sendMessageDraft (Bot API 9.5+)."""
-    full_response = ""
-    buffer = ""
-    last_update = time.monotonic() - TIME_STREAM_UPDATE
+    renderer = StreamingMarkdownRenderer()
+    flush = make_flush_policy(msg.chat.id, draft=True)
     draft_id = random.randint(1, 2**31 - 1)
     chat_id = msg.chat.id
     drafts_supported = True
@@ -283,57 +352,44 @@ async def _stream_via_native_draft(
 
     # В native режиме loader не нужен (drafts отображаются в отдельном bubble)
     if initial_message is not None:
-        with suppress(Exception):
-            await initial_message.delete()
+        await safe_delete(initial_message)
 
+    pump = StreamPump(stream_response, renderer, flush)
     try:
-        async for chunk in stream_response:
-            if not chunk.choices:
-                continue
-            delta = chunk.choices[0].delta.content
-            if not delta:
-                continue
-
-            buffer += delta
-            full_response += delta
-
-            elapsed = time.monotonic() - last_update
-            ready = (
-                len(buffer) >= STREAM_MAX_CHUNK_SIZE
-                or (elapsed >= 0.5 and len(buffer) >= STREAM_MIN_CHUNK_SIZE)
-            )
-            if not ready or not drafts_supported:
+        while not pump.done:
+            # Без drafts просто дожидаемся конца стрима
+            await pump.wait(flush.delay() if drafts_supported else None)
+            if not drafts_supported or not flush.ready():
                 continue
 
-            html_now = markdown_to_telegram_html(full_response)
+            html_now = renderer.render()
             if not html_now.strip():
-                buffer = ""
+                flush.on_skip()
                 continue
 
+            flush_start = time.monotonic()
             ok = await send_message_draft(bot, chat_id, draft_id, html_now, parse_mode="HTML")
             if not ok:
                 drafts_supported = False
-                break
-            last_update = time.monotonic()
-            buffer = ""
-
-        if not drafts_supported:
-            async for chunk in stream_response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    full_response += chunk.choices[0].delta.content
+                continue
+            flush.on_flush(time.monotonic() - flush_start, ok)
 
     except asyncio.CancelledError:
         raise
     except Exception as e:
         logger.warning(f"Native draft stream interrupted: {e}")
         stream_error = e
+    finally:
+        await pump.aclose()
+    stream_error = stream_error or pump.error
 
+    full_response = renderer.text
     if full_response.strip():
         # Финальное сообщение без cancel-кнопки (запрос завершён)
         if USE_RICH_MESSAGES and contains_rich_markup(full_response):
             await send_long_rich_text(msg, full_response)
         else:
-            final_html = markdown_to_telegram_html(full_response)
+            final_html = renderer.finish()
             await send_long_text(msg, final_html, parse_mode="HTML")
     elif stream_error:
         raise stream_error
@@ -375,6 +431,7 @@ async def handle_streaming_response(
             await safe_answer(msg, "Произошла ошибка: ответ нейросети пустой.")
         return
 
+    set_stage("save")
     try:
         await save_context(msg.from_user.id, save_as_question, full_response)
     except Exception as e:
@@ -384,65 +441,176 @@ async def handle_streaming_response(
 # ────────────────────────────────────────────────────────────────────────────
 # Основной пайплайн
 # ────────────────────────────────────────────────────────────────────────────
+async def _open_stream(user_id: int, request_content: str, wants_code: bool):
+    """Открывает стрим основной модели с промптом под намерение."""
+    if wants_code:
+        return await generate_code(telegram_id=user_id, request=request_content, stream=True)
+    return await process_request(telegram_id=user_id, content=request_content, stream=True)
+
+
+async def _close_stream(task: asyncio.Task) -> None:
+    """Гасит ненужный спекулятивный стрим: отменяет открытие или закрывает ответ."""
+    if not task.done():
+        task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    with suppress(Exception):
+        await task.result().close()
+
+
+class _QueueStatus:
+    """
+    Позиция в очереди к основной модели — в тексте loader'а, пока запрос
+    ждёт слот (utils/admission.py). После допуска прежний текст возвращается.
+    """
+
+    def __init__(self, loader: Message, cancel_markup: InlineKeyboardMarkup, text: str) -> None:
+        self.loader = loader
+        self.cancel_markup = cancel_markup
+        self.text = text
+        self.shown = False
+
+    async def show(self, position: int) -> None:
+        self.shown = True
+        await safe_edit_text(
+            self.loader,
+            f"⏳ <b>Место в очереди: {position}...</b>",
+            parse_mode="HTML",
+            reply_markup=self.cancel_markup,
+        )
+
+    async def restore(self) -> None:
+        if self.shown:
+            self.shown = False
+            await safe_edit_text(
+                self.loader, self.text, parse_mode="HTML", reply_markup=self.cancel_markup
+            )
+
+
+async def _enter_main_slot(slots: AsyncExitStack, status: _QueueStatus) -> None:
+    """Слот основной модели держится до конца стрима — выходит вместе со slots."""
+    await slots.enter_async_context(admission.slot("main", on_queue=status.show))
+    await status.restore()
+
+
+async def _analyze_speculatively(user_id: int, content: str):
+    """
+    Текст без картинок: Groq-анализ и стрим основной модели стартуют
+    одновременно. Стрим открывается с промптом по локальной догадке
+    (analyzer.guess_intent); если Groq с ней согласен — стрим уже в пути
+    и TTFT не включает Groq round-trip. Если нет — стрим закрывается до
+    того, как из него прочитан хоть один токен, и открывается заново.
+
+    processed_content для текста всё равно не нужен (идёт исходный content),
+    поэтому от анализа берём только намерение. Возвращает (wants_code, stream).
+    """
+    guess = analyzer.guess_intent(content)
+    analysis = asyncio.create_task(analyzer.analyze(content))
+    speculative = asyncio.create_task(_open_stream(user_id, content, guess))
+    handed_over = False
+    try:
+        async with log_timing("pipeline.analyze", user=user_id, has_images=False, speculative=True):
+            wants_code, _ = await analysis
+
+        log_event(
+            "pipeline.speculation",
+            user=user_id,
+            guess="CODE" if guess else "TEXT",
+            intent="CODE" if wants_code else "TEXT",
+            hit=wants_code == guess,
+        )
+        if wants_code == guess:
+            stream = await speculative
+            handed_over = True
+            return wants_code, stream
+    finally:
+        # Отмена пользователем, ошибка анализа или промах — спекулятивный стрим
+        # закрываем, даже если он уже открыт (основная модель часто отвечает
+        # раньше Groq): иначе он держит соединение, жжёт токены и подписку
+        # на singleflight-полёт. Вызывающему отдан — закрывать ему.
+        if not analysis.done():
+            analysis.cancel()
+        if not handed_over:
+            await _close_stream(speculative)
+
+    return wants_code, await _open_stream(user_id, content, wants_code)
+
+
 async def _do_processing(
     msg: Message,
     content: str,
-    image_paths: list[str] | None,
+    images: list[MediaBuffer] | None,
     loader: Message,
     cancel_markup: InlineKeyboardMarkup,
+    charge: Charge | None = None,
 ) -> None:
     """
     Та самая работа, которая может быть отменена. Запускается как Task,
     регистрируется в реестре отмены по (chat_id, loader.message_id).
     """
-    has_images = bool(image_paths)
+    has_images = bool(images)
     user_id = msg.from_user.id
+    set_stage("analyze")
+    status = _QueueStatus(loader, cancel_markup, _LOADER_IMAGE if has_images else _LOADER_THINKING)
 
     try:
-        async with log_timing("pipeline.analyze", user=user_id, has_images=has_images):
-            wants_code, processed_content = await analyzer.analyze(content, image_paths)
-
-        log_event(
-            "pipeline.intent",
-            user=user_id,
-            intent="CODE" if wants_code else "TEXT",
-            processed_chars=len(processed_content),
-        )
+        async with AsyncExitStack() as slots:
+            stream = None
+            if USE_SPECULATIVE_DISPATCH and not has_images:
+                # Спекулятивный стрим открывается вместе с анализом — слот нужен сразу
+                await _enter_main_slot(slots, status)
+                wants_code, stream = await _analyze_speculatively(user_id, content)
+                request_content = content
+            else:
+                async with log_timing("pipeline.analyze", user=user_id, has_images=has_images):
+                    wants_code, processed_content = await analyzer.analyze(content, images)
+
+                log_event(
+                    "pipeline.intent",
+                    user=user_id,
+                    intent="CODE" if wants_code else "TEXT",
+                    processed_chars=len(processed_content),
+                )
 
-        request_content = processed_content if has_images else content
+                request_content = processed_content if has_images else content
 
-        # Loader — переключаем на «готовлю ответ» (если был «распознаю»)
-        if has_images:
-            await safe_edit_text(
-                loader,
-                "✍️ <b>Готовлю ответ...</b>",
-                parse_mode="HTML",
-                reply_markup=cancel_markup,
-            )
+            # Loader — переключаем на «готовлю ответ» (если был «распознаю»)
+            if has_images:
+                status.text = _LOADER_ANSWERING
+                await safe_edit_text(
+                    loader,
+                    status.text,
+                    parse_mode="HTML",
+                    reply_markup=cancel_markup,
+                )
 
-        if wants_code:
-            with suppress(Exception):
-                await msg.react([ReactionTypeEmoji(emoji=random.choice(POPULAR_EMOJIS))])
+            if wants_code:
+                with suppress(Exception):
+                    await msg.react([ReactionTypeEmoji(emoji=random.choice(POPULAR_EMOJIS))])
 
-            stream = await generate_code(
-                telegram_id=user_id,
-                request=request_content,
-                stream=True,
-            )
-        else:
-            stream = await process_request(
-                telegram_id=user_id,
-                content=request_content,
-                stream=True,
-            )
+            set_stage("stream")
+            if stream is None:
+                await _enter_main_slot(slots, status)
+                stream = await _open_stream(user_id, request_content, wants_code)
 
-        await handle_streaming_response(
-            msg,
-            stream,
-            save_as_question=content,
-            initial_message=loader,
-            cancel_markup=cancel_markup,
-        )
+            # usage из финального чанка — досписать токены квоты по факту
+            stream = MeteredStream(stream)
+            try:
+                await handle_streaming_response(
+                    msg,
+                    stream,
+                    save_as_question=content,
+                    initial_message=loader,
+                    cancel_markup=cancel_markup,
+                )
+            finally:
+                if stream.billable:
+                    await quotas.settle(charge, stream.usage)
+                else:
+                    await quotas.release(charge)
 
     except asyncio.CancelledError:
         # Обрабатываем здесь, чтобы пользователь увидел понятное сообщение.
@@ -455,6 +623,9 @@ async def _do_processing(
                 parse_mode="HTML",
                 reply_markup=None,
             )
+    except Overloaded:
+        # Очередь полна — честный отказ сразу, а не PoolTimeout через минуту
+        await safe_edit_text(loader, lexicon["overloaded"], parse_mode="HTML", reply_markup=None)
     except ValueError as e:
         # Бизнес-ошибки (валидация изображений и т.п.)
         await safe_edit_text(loader, f"❌ {e}", parse_mode="HTML", reply_markup=None)
@@ -466,18 +637,24 @@ async def _do_processing(
             parse_mode="HTML",
             reply_markup=None,
         )
+    finally:
+        # Стрим модели так и не открылся (анализ упал, Overloaded, ValueError,
+        # отмена до стрима) — оценку токенов возвращаем. После стрима
+        # квота уже сведена settle() и это no-op.
+        with suppress(Exception):
+            await quotas.release(charge)
 
 
 async def process_content(
     msg: Message,
     content: str,
-    image_paths: list[str] | None = None,
+    images: list[MediaBuffer] | None = None,
 ) -> None:
     """Точка входа: проверки, lock, loader с кнопкой отмены, запуск задачи."""
     if not await check_subscription(msg):
         return
 
-    if len(content.split()) > MAX_WORD_COUNT:
+    if exceeds(content, MAX_INPUT_TOKENS):
         await safe_answer(
             msg,
             "К сожалению, текст вашего сообщения слишком длинный. "
@@ -486,14 +663,14 @@ async def process_content(
         return
 
     user_id = msg.from_user.id
-    has_images = bool(image_paths)
+    has_images = bool(images)
 
     log_event(
         "msg.received",
         user=user_id,
         chat=msg.chat.id,
         has_images=has_images,
-        n_images=len(image_paths or []),
+        n_images=len(images or []),
         chars=len(content),
     )
 
@@ -506,40 +683,126 @@ async def process_content(
             )
             return
 
-        # ─── Loader с кнопкой [Отменить] ───
-        # Текст подбираем под тип входа.
-        if has_images:
-            initial_text = "🖼 <b>Распознаю изображение...</b>"
-        else:
-            initial_text = "💭 <b>Думаю...</b>"
-
-        # Сначала отправляем БЕЗ кнопки, чтобы получить message_id;
-        # потом вешаем кнопку с этим id в callback_data.
-        loader = await safe_answer(msg, initial_text, parse_mode="HTML")
-        if loader is None:
-            logger.error(f"Could not send loader for user {user_id}")
+        try:
+            charge = await quotas.charge(user_id, content=content)
+        except QuotaExceeded as e:
+            await safe_answer(msg, _quota_message(e), parse_mode="HTML")
             return
 
-        cancel_markup = make_cancel_keyboard(loader.chat.id, loader.message_id)
-        # Прицепляем кнопку
-        await safe_edit_text(
-            loader, initial_text, parse_mode="HTML", reply_markup=cancel_markup
-        )
+        task: asyncio.Task | None = None
+        try:
+            # ─── Loader с кнопкой [Отменить] ───
+            # Текст подбираем под тип входа.
+            initial_text = _LOADER_IMAGE if has_images else _LOADER_THINKING
+
+            # Сначала отправляем БЕЗ кнопки, чтобы получить message_id;
+            # потом вешаем кнопку с этим id в callback_data.
+            loader = await safe_answer(msg, initial_text, parse_mode="HTML")
+            if loader is None:
+                logger.error(f"Could not send loader for user {user_id}")
+                return
 
-        # ─── Запускаем работу как Task, чтобы её можно было cancel() ───
-        task = asyncio.create_task(
-            _do_processing(msg, content, image_paths, loader, cancel_markup),
-            name=f"process-{user_id}-{loader.message_id}",
-        )
-        register_task(loader.chat.id, loader.message_id, task)
+            cancel_markup = make_cancel_keyboard(loader.chat.id, loader.message_id)
+            # Прицепляем кнопку
+            await safe_edit_text(
+                loader, initial_text, parse_mode="HTML", reply_markup=cancel_markup
+            )
+
+            # ─── Запускаем работу как Task, чтобы её можно было cancel() ───
+            # create_task копирует contextvars — задача продолжает trace апдейта
+            task = asyncio.create_task(
+                _do_processing(msg, content, images, loader, cancel_markup, charge),
+                name=f"process-{user_id}-{loader.message_id}",
+            )
+            await register_task(loader.chat.id, loader.message_id, task)
+
+            async with ChatActionSender.typing(chat_id=msg.chat.id, bot=bot):
+                try:
+                    # await не должен падать, потому что _do_processing внутри ловит всё
+                    await task
+                except asyncio.CancelledError:
+                    # На случай если cancel прилетел во внешнем await раньше внутреннего
+                    log_event("pipeline.outer_cancel", user=user_id)
+        finally:
+            # Задача не стартовала (нет loader'а, ошибка до create_task, отмена
+            # до первого шага) — модель не вызывалась. Идущую задачу не трогаем:
+            # квоту сведёт её собственный finally.
+            if task is None or task.done():
+                with suppress(Exception):
+                    await quotas.release(charge)
 
-        async with ChatActionSender.typing(chat_id=msg.chat.id, bot=bot):
+
+# ────────────────────────────────────────────────────────────────────────────
+# Голосовые и документы — через кэш (utils/media_cache.py)
+# ────────────────────────────────────────────────────────────────────────────
+async def _transcribe_voice(msg: Message) -> str:
+    """
+    Транскрипт голосового: по file_unique_id — без скачивания, по хэшу
+    содержимого — без транскрипции, иначе — Whisper и запись в кэш.
+    """
+    voice = msg.voice
+    text = await media_cache.get("voice", voice.file_unique_id)
+    if text is not None:
+        return text
+
+    async with ChatActionSender(action=ChatAction.RECORD_VOICE, chat_id=msg.chat.id, bot=bot):
+        async with download_media(voice.file_id, size=voice.file_size, name="voice.ogg") as media:
+            digest = await content_digest(media)
+            text = await media_cache.get_content(
+                "voice", digest, file_unique_id=voice.file_unique_id
+            )
+            if text is not None:
+                return text
+
+            # Секунды голосовых списываются только за реальную транскрипцию
+            charge = await quotas.charge(msg.from_user.id, media_seconds=voice.duration or 0)
             try:
-                # await не должен падать, потому что _do_processing внутри ловит всё
-                await task
-            except asyncio.CancelledError:
-                # На случай если cancel прилетел во внешнем await раньше внутреннего
-                log_event("pipeline.outer_cancel", user=user_id)
+                text = await process_audio_with_whisper(telegram_id=msg.from_user.id, media=media)
+            except BaseException:
+                # Whisper упал, admission отказал (Overloaded) или отмена — секунды не потрачены
+                with suppress(Exception):
+                    await quotas.release(charge)
+                raise
+            await media_cache.put(
+                "voice",
+                digest,
+                text,
+                file_unique_id=voice.file_unique_id,
+                source_size=media.size,
+            )
+    return text
+
+
+async def _extract_document(msg: Message, ext: str) -> DocumentText:
+    """
+    Текст документа с тем же порядком поиска, что у голосовых. В кэш идёт
+    только полностью извлечённый текст: отказ по лимиту слов не кэшируется.
+    """
+    document = msg.document
+    text = await media_cache.get("doc", document.file_unique_id)
+    if text is not None:
+        return DocumentText(text, False)
+
+    async with download_media(
+        document.file_id, size=document.file_size, name=document.file_name or ""
+    ) as media:
+        digest = await content_digest(media)
+        text = await media_cache.get_content(
+            "doc", digest, file_unique_id=document.file_unique_id
+        )
+        if text is not None:
+            return DocumentText(text, False)
+
+        doc = await extract_text(media, ext)
+        if not doc.too_long:
+            await media_cache.put(
+                "doc",
+                digest,
+                doc.text,
+                file_unique_id=document.file_unique_id,
+                source_size=media.size,
+            )
+    return doc
 
 
 # ────────────────────────────────────────────────────────────────────────────
@@ -556,23 +819,11 @@ async def text_handler(msg: Message) -> None:
 
 @rt.message(F.voice)
 async def voice_handler(msg: Message) -> None:
-    voice_path: Path | None = None
     try:
         if not await check_subscription(msg):
             return
 
-        voice_path = DOCUMENTS_DIR / f"{msg.voice.file_id}.ogg"
-
-        async with ChatActionSender(action=ChatAction.RECORD_VOICE, chat_id=msg.chat.id, bot=bot):
-            async with log_timing("telegram.download_voice", file_id=msg.voice.file_id):
-                buf = await bot.download(msg.voice.file_id)
-                async with aiofiles.open(voice_path, "wb") as f:
-                    await f.write(buf.read())
-
-            text = await process_audio_with_whisper(
-                telegram_id=msg.from_user.id,
-                file_path=str(voice_path),
-            )
+        text = await _transcribe_voice(msg)
 
         if not text or not text.strip():
             await safe_answer(msg, "Не удалось распознать речь. Попробуйте записать чётче.")
@@ -580,50 +831,64 @@ async def voice_handler(msg: Message) -> None:
 
         await process_content(msg, text)
 
+    except Overloaded:
+        await safe_answer(msg, lexicon["overloaded"], parse_mode="HTML")
+    except QuotaExceeded as e:
+        await safe_answer(msg, _quota_message(e), parse_mode="HTML")
     except Exception as e:
         logger.exception(f"voice_handler error: {e}")
         await safe_answer(msg, lexicon["error_voice"])
-    finally:
-        if voice_path and voice_path.exists():
-            with suppress(OSError):
-                voice_path.unlink()
 
 
 @rt.message(F.document)
 async def document_handler(msg: Message) -> None:
-    file_path: Path | None = None
     try:
         if not await check_subscription(msg):
             return
 
-        async with log_timing("telegram.get_file", file_id=msg.document.file_id):
-            file = await bot.get_file(msg.document.file_id)
-        remote_basename = os.path.basename(file.file_path)
-        file_path = DOCUMENTS_DIR / f"{msg.document.file_id}_{remote_basename}"
+        ext = extractor_for(msg.document.file_name or "")
+        if ext is None:
+            await safe_answer(
+                msg,
+                "Поддерживаются только .pdf, .docx и .txt. "
+                "Скопируйте текст из файла и пришлите сообщением.",
+            )
+            return
+
+        # Размер известен из сообщения — слишком большой файл даже не качаем
+        if (msg.document.file_size or 0) > DOCUMENT_MAX_MB * 1024 * 1024:
+            log_event(
+                "document.rejected",
+                user=msg.from_user.id,
+                reason="size",
+                kb=msg.document.file_size // 1024,
+            )
+            await safe_answer(
+                msg,
+                f"Файл слишком большой — максимум {DOCUMENT_MAX_MB} MB. "
+                "Скопируйте нужную часть текста и пришлите сообщением.",
+            )
+            return
 
         async with ChatActionSender(action=ChatAction.UPLOAD_DOCUMENT, chat_id=msg.chat.id, bot=bot):
-            async with log_timing(
-                "telegram.download_file",
-                size=msg.document.file_size,
-                name=msg.document.file_name,
-            ):
-                await bot.download_file(file.file_path, file_path)
-
-            filename = (msg.document.file_name or "").lower()
-            if filename.endswith(".pdf"):
-                text = await read_pdf(file_path)
-            elif filename.endswith(".docx"):
-                text = await read_docx(file_path)
-            elif filename.endswith(".txt"):
-                text = await read_txt(file_path)
-            else:
-                await safe_answer(
-                    msg,
-                    "Поддерживаются только .pdf, .docx и .txt. "
-                    "Скопируйте текст из файла и пришлите сообщением.",
-                )
+            try:
+                doc = await _extract_document(msg, ext)
+            except DocumentTooLarge as e:
+                log_event("document.rejected", user=msg.from_user.id, reason="pages")
+                await safe_answer(msg, f"{e} Пришлите нужную часть документа.")
                 return
 
+        if doc.too_long:
+            # Чтение остановлено на лимите слов — остаток документа не парсился
+            log_event("document.rejected", user=msg.from_user.id, reason="words")
+            await safe_answer(
+                msg,
+                "К сожалению, текст вашего сообщения слишком длинный. "
+                "Сократите его, чтобы получить ответ нейросети.",
+            )
+            return
+
+        text = doc.text
         if not text or not text.strip():
             await safe_answer(msg, "Не удалось извлечь текст из документа.")
             return
@@ -637,26 +902,24 @@ async def document_handler(msg: Message) -> None:
     except Exception as e:
         logger.exception(f"document_handler error for {msg.document.file_name}: {e}")
         await safe_answer(msg, lexicon["error_document"])
-    finally:
-        if file_path and file_path.exists():
-            with suppress(OSError):
-                file_path.unlink()
 
 
 @rt.message(F.photo)
 async def photo_handler(msg: Message) -> None:
     """Одиночные фото и альбомы (media_group)."""
-    image_paths: list[str] = []
     try:
         if not await check_subscription(msg):
             return
 
         media_group_id = msg.media_group_id
+        # Не самый большой размер, а наименьший, которого хватит vision-модели
+        photo_size = pick_photo_size(msg.photo, VISION_MAX_SIDE)
 
         if media_group_id:
             key = f"album:{msg.from_user.id}:{media_group_id}"
             photo_info = json.dumps({
-                "file_id": msg.photo[-1].file_id,
+                "file_id": photo_size.file_id,
+                "file_size": photo_size.file_size,
                 "caption": msg.caption or "",
             })
             await redis.lpush(key, photo_info)
@@ -671,47 +934,31 @@ async def photo_handler(msg: Message) -> None:
                 pipe.lrange(key, 0, -1)
                 pipe.delete(key, f"{key}:lock")
                 results = await pipe.execute()
-            album_data = results[0]
+            album_data = [json.loads(entry.decode("utf-8")) for entry in results[0]]
 
             if len(album_data) > MAX_IMAGES_PER_REQUEST:
                 await safe_answer(msg, f"❌ Максимум {MAX_IMAGES_PER_REQUEST} изображений за раз")
                 return
 
-            caption = ""
+            caption = next((photo["caption"] for photo in album_data if photo["caption"]), "")
 
-            async def _download(entry: bytes) -> str:
-                photo = json.loads(entry.decode("utf-8"))
-                nonlocal caption
-                if photo["caption"] and not caption:
-                    caption = photo["caption"]
-                f = await bot.get_file(photo["file_id"])
-                fp = DOCUMENTS_DIR / f"{photo['file_id']}.jpg"
-                await bot.download_file(f.file_path, fp)
-                return str(fp)
-
-            async with log_timing("telegram.download_album", count=len(album_data)):
-                image_paths = await asyncio.gather(*(_download(e) for e in album_data))
-
-            content = caption or "Опиши что на изображениях. Если есть текст или задачи — извлеки их."
-            await process_content(msg, content, image_paths=image_paths)
+            album_files = [(photo["file_id"], photo.get("file_size")) for photo in album_data]
+            async with download_media_group(album_files, name="album photo") as images:
+                content = caption or "Опиши что на изображениях. Если есть текст или задачи — извлеки их."
+                await process_content(msg, content, images=images)
 
         else:
-            f = await bot.get_file(msg.photo[-1].file_id)
-            fp = DOCUMENTS_DIR / f"{msg.photo[-1].file_id}.jpg"
-            async with log_timing("telegram.download_photo", file_id=msg.photo[-1].file_id):
-                await bot.download_file(f.file_path, fp)
-            image_paths.append(str(fp))
-
-            content = msg.caption or "Опиши что на изображении. Если есть текст или задача — извлеки его полностью."
-            await process_content(msg, content, image_paths=image_paths)
+            async with download_media(
+                photo_size.file_id,
+                size=photo_size.file_size,
+                name=f"photo {photo_size.width}x{photo_size.height}",
+            ) as media:
+                content = msg.caption or "Опиши что на изображении. Если есть текст или задача — извлеки его полностью."
+                await process_content(msg, content, images=[media])
 
     except Exception as e:
         logger.exception(f"photo_handler error: {e}")
         await safe_answer(msg, "Произошла ошибка при обработке изображения.")
-    finally:
-        for p in image_paths:
-            with suppress(OSError, FileNotFoundError):
-                os.remove(p)
 
 
 # ────────────────────────────────────────────────────────────────────────────
@@ -733,24 +980,26 @@ async def cancel_callback(callback: CallbackQuery) -> None:
         message=message_id,
     )
 
-    cancelled = cancel_task(chat_id, message_id)
-    if cancelled:
+    # Задача может идти на другой реплике — cancel_task спросит её через Redis
+    result = await cancel_task(chat_id, message_id)
+    if result == CANCELLED:
         await callback.answer("Запрос отменяется...")
+    elif result == UNKNOWN:
+        await callback.answer("Не удалось найти запрос, попробуйте ещё раз", show_alert=False)
     else:
         await callback.answer("Запрос уже завершён", show_alert=False)
         # Если задачи нет — снимем кнопку, чтобы юзер её больше не видел
-        if callback.message:
-            with suppress(Exception):
-                await callback.message.edit_reply_markup(reply_markup=None)
+        if isinstance(callback.message, Message):
+            await safe_edit_reply_markup(callback.message)
 
 
 @rt.callback_query(lambda c: c.data == "check_subscription")
 async def check_subscription_callback(callback: CallbackQuery) -> None:
     try:
-        if await is_subscribed(callback.from_user.id):
+        if await is_subscribed(callback.from_user.id, refresh=True):
             await callback.answer("✅ Спасибо за подписку! Доступ открыт.")
-            with suppress(TelegramBadRequest):
-                await callback.message.delete()
+            if isinstance(callback.message, Message):
+                await safe_delete(callback.message)
             await safe_answer(
                 callback.message,
                 "✅ Доступ к боту открыт! Теперь вы можете отправить мне свой запрос.",
@@ -34,6 +34,21 @@ LEXICON_RU = {
         "Скопируйте текст и отправьте сообщением или попробуйте позже."
     ),
 
+    "overloaded": (
+        "😮‍💨 <b>Сейчас слишком много запросов.</b>\n"
+        "Попробуйте ещё раз через минуту."
+    ),
+
+    "quota_exceeded": (
+        "⏳ <b>Лимит {what} исчерпан.</b>\n"
+        "Попробуйте {wait}."
+    ),
+
+    "quota_too_large": (
+        "⏳ Этот запрос больше вашего лимита.\n"
+        "Сократите его и попробуйте ещё раз."
+    ),
+
     "cancel": "❌ Вы отменили рассылку.",
 
     "support": (
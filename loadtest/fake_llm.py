@@ -0,0 +1,170 @@
+"""
+Фейковый OpenAI-совместимый сервер для нагрузочного теста — и основная
+модель, и Groq (анализатор, пересказ), и транскрипция.
+
+/v1/chat/completions:
+- stream=true — SSE-чанки как у OpenAI: первый токен через ttft
+  (логнормальный разброс вокруг среднего), дальше token_rate токенов/с;
+  с вероятностью stall_prob посреди ответа стрим замирает на
+  stall_seconds — так выглядят «медленные полосы» провайдера;
+- stream=false — ответ анализатора (<intent>…</intent> + текст запроса)
+  или пересказа, после ttft.
+
+/v1/audio/transcriptions — текст «транскрипции» после transcribe_delay.
+
+Ответы — markdown с заголовком, списком, кодом и иногда таблицей, чтобы
+рендерер и rich-сообщения работали как на реальных ответах.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from aiohttp import web
+
+_WORDS = (
+    "решение задачи сводится к тому чтобы аккуратно разобрать условие и "
+    "записать известные величины затем подставить их в формулу и проверить "
+    "размерность результата после чего сделать вывод о правильности ответа"
+).split()
+
+_CODE = (
+    "```python\n"
+    "def solve(values: list[int]) -> int:\n"
+    "    total = 0\n"
+    "    for v in values:\n"
+    "        if v % 2 == 0:\n"
+    "            total += v\n"
+    "    return total\n"
+    "```\n"
+)
+
+_TABLE = "| Величина | Значение |\n|---|---|\n| скорость | 12 м/с |\n| время | 4 с |\n"
+
+
+def _answer(tokens: int, rng: random.Random) -> list[str]:
+    """Ответ, нарезанный на «токены» (слова с пробелами и куски разметки)."""
+    parts = ["## Ответ\n\n"]
+    while len(parts) < tokens:
+        roll = rng.random()
+        if roll < 0.03:
+            parts.append("\n\n" + _CODE + "\n")
+        elif roll < 0.04:
+            parts.append("\n\n" + _TABLE + "\n")
+        elif roll < 0.10:
+            parts.append("\n- **" + rng.choice(_WORDS) + "** ")
+        else:
+            parts.append(rng.choice(_WORDS) + " ")
+    return parts
+
+
+@dataclass
+class FakeLLM:
+    ttft: float = 0.8  # сек, среднее
+    ttft_sigma: float = 0.5  # разброс логнормального распределения
+    token_rate: float = 60.0  # токенов/с
+    answer_tokens: int = 400
+    stall_prob: float = 0.0
+    stall_seconds: float = 10.0
+    transcribe_delay: float = 1.0
+    seed: int = 1
+
+    def __post_init__(self) -> None:
+        self._rng = random.Random(self.seed)
+        self.requests = 0
+        self.streams = 0
+        self.stalls = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/audio/transcriptions", self._transcribe)
+        return app
+
+    def _ttft(self) -> float:
+        # Медиана = ttft, хвост — как у реальных провайдеров
+        return self.ttft * math.exp(self._rng.gauss(0, self.ttft_sigma) - self.ttft_sigma ** 2 / 2)
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        model = body.get("model", "fake")
+        created = int(time.time())
+        await asyncio.sleep(self._ttft())
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self._completion(body)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+            })
+
+        self.streams += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        tokens = _answer(min(self.answer_tokens, body.get("max_completion_tokens") or self.answer_tokens), self._rng)
+        stall_at = self._rng.randrange(len(tokens)) if self._rng.random() < self.stall_prob else -1
+        interval = 1 / self.token_rate
+
+        def chunk(delta: dict[str, Any], finish: str | None = None, usage: dict | None = None) -> bytes:
+            data = {
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            if usage:
+                data["usage"] = usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+        try:
+            await response.write(chunk({"role": "assistant", "content": ""}))
+            for i, token in enumerate(tokens):
+                if i == stall_at:
+                    self.stalls += 1
+                    await asyncio.sleep(self.stall_seconds)
+                await response.write(chunk({"content": token}))
+                await asyncio.sleep(interval)
+            await response.write(chunk({}, finish="stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                await response.write(chunk({}, usage={
+                    "prompt_tokens": 500, "completion_tokens": len(tokens), "total_tokens": 500 + len(tokens),
+                }))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # Бот закрыл стрим (отмена, проигравший хедж) — это нормально
+            return response
+        await response.write_eof()
+        return response
+
+    def _completion(self, body: dict[str, Any]) -> str:
+        """Не-стрим: анализатор (тег намерения) или пересказ контекста."""
+        messages = body.get("messages") or []
+        system = messages[0].get("content", "") if messages else ""
+        user = messages[-1].get("content", "") if messages else ""
+        if isinstance(user, list):  # vision: [{"type": "text"}, {"type": "image_url"}...]
+            user = " ".join(p.get("text", "") for p in user if isinstance(p, dict))
+        if "<intent>" in system:
+            intent = "CODE" if "код" in user.lower() or "code" in user.lower() else "TEXT"
+            return f"<intent>{intent}</intent>\n{user or 'Опиши изображение.'}"
+        return "Пользователь решает учебные задачи; получил разборы по физике и математике."
+
+    async def _transcribe(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.requests += 1
+        await asyncio.sleep(self.transcribe_delay)
+        return web.Response(text="Объясни, как решать квадратные уравнения через дискриминант.")
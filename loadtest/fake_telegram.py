@@ -0,0 +1,208 @@
+"""
+Фейковый Bot API для нагрузочного теста.
+
+Отвечает на все методы, которыми пользуется бот, и записывает каждый
+исходящий вызов (время, метод, чат, текст, есть ли клавиатура) — по этим
+записям run.py считает время до первого видимого текста, edit'ы на ответ
+и конец ответа.
+
+Флуд-лимиты как у Telegram: token bucket на чат (личка ~1 сообщение/с с
+небольшим всплеском, группа ~20/мин) и глобальный на бота (~30/с). Сверх
+лимита — 429 с retry_after, как настоящий сервер.
+
+Файлы (getFile + /file/bot{token}/{path}) отдаются из self.files — их
+регистрирует генератор апдейтов.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 7000000001, "is_bot": True, "first_name": "Boompi", "username": "boompi_loadtest_bot"}
+
+# Методы, которые возвращают Message
+_MESSAGE_METHODS = {
+    "sendmessage", "sendrichmessage", "senddocument", "sendphoto",
+    "editmessagetext", "editmessagereplymarkup",
+}
+# Вызовы, которые Telegram считает исходящими сообщениями (под флуд-лимит)
+_LIMITED_METHODS = _MESSAGE_METHODS | {"sendmessagedraft", "sendrichmessagedraft"}
+
+
+@dataclass
+class Call:
+    t: float
+    method: str
+    chat_id: Optional[int]
+    message_id: Optional[int]
+    text: str
+    has_markup: bool
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """0 — токен взят; иначе сколько секунд до следующего."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass
+class FakeTelegram:
+    chat_rate: float = 1.0
+    chat_burst: float = 3.0
+    group_rate: float = 20 / 60
+    global_rate: float = 30.0
+    latency: float = 0.05  # сек на ответ сервера (RTT до api.telegram.org)
+
+    calls: list[Call] = field(default_factory=list)
+    by_chat: dict[int, list[Call]] = field(default_factory=lambda: defaultdict(list))
+    rejected: Counter = field(default_factory=Counter)  # 429 по методам
+    files: dict[str, bytes] = field(default_factory=dict)
+    webhook: dict[str, Any] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        self._ids = itertools.count(1000)
+        self._chat_buckets: dict[int, _Bucket] = {}
+        self._global = _Bucket(self.global_rate, self.global_rate)
+        self._waiters: dict[int, list[asyncio.Event]] = defaultdict(list)
+
+    # ── Подписка run.py на вызовы по чату ──
+    def wait_chat(self, chat_id: int) -> asyncio.Event:
+        event = asyncio.Event()
+        self._waiters[chat_id].append(event)
+        return event
+
+    def _notify(self, chat_id: Optional[int]) -> None:
+        if chat_id is not None:
+            for event in self._waiters.pop(chat_id, ()):
+                event.set()
+
+    # ── HTTP ──
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        return app
+
+    async def _params(self, request: web.Request) -> dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        params: dict[str, Any] = {}
+        form = await request.post()
+        for key, value in form.items():
+            if isinstance(value, str):
+                # aiogram сериализует вложенные объекты в JSON-строки
+                try:
+                    params[key] = json.loads(value) if value[:1] in "{[" else value
+                except ValueError:
+                    params[key] = value
+        return params
+
+    def _limited(self, chat_id: Optional[int]) -> Optional[int]:
+        """retry_after, если вызов сверх лимита; None — можно."""
+        now = time.monotonic()
+        wait = self._global.take(now)
+        if chat_id is not None and not wait:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                rate = self.group_rate if chat_id < 0 else self.chat_rate
+                bucket = self._chat_buckets[chat_id] = _Bucket(rate, self.chat_burst)
+            wait = bucket.take(now)
+        return max(1, math.ceil(wait)) if wait else None
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = await self._params(request)
+        await asyncio.sleep(self.latency)
+
+        # getChatMember проверяет канал — там chat_id вида "@channel"
+        raw_chat = str(params.get("chat_id", ""))
+        chat_id = int(raw_chat) if raw_chat.lstrip("-").isdigit() else None
+
+        if method in _LIMITED_METHODS:
+            retry_after = self._limited(chat_id)
+            if retry_after is not None:
+                self.rejected[method] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                })
+
+        text = params.get("text") or ""
+        if not text and isinstance(params.get("rich_message"), dict):
+            text = params["rich_message"].get("markdown", "")
+        message_id = params.get("message_id")
+        call = Call(
+            t=time.monotonic(),
+            method=method,
+            chat_id=chat_id,
+            message_id=int(message_id) if message_id else None,
+            text=text,
+            has_markup=bool(params.get("reply_markup")),
+        )
+        self.calls.append(call)
+        if chat_id is not None:
+            self.by_chat[chat_id].append(call)
+        self._notify(chat_id)
+        return web.json_response({"ok": True, "result": self._result(method, params, chat_id, text)})
+
+    def _result(self, method: str, params: dict[str, Any], chat_id: Optional[int], text: str) -> Any:
+        if method == "getme":
+            return BOT_USER
+        if method == "getwebhookinfo":
+            return {
+                "url": self.webhook.get("url", ""),
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+            }
+        if method == "setwebhook":
+            self.webhook = params
+            return True
+        if method == "getchatmember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "U"}}
+        if method == "getfile":
+            file_id = params["file_id"]
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id[-16:],
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"files/{file_id}",
+            }
+        if method in _MESSAGE_METHODS:
+            message_id = params.get("message_id")
+            return {
+                "message_id": int(message_id) if message_id else next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if (chat_id or 0) > 0 else "group"},
+                "from": BOT_USER,
+                "text": text or "·",
+            }
+        return True
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        data = self.files.get(file_id)
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="application/octet-stream")
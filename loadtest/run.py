@@ -0,0 +1,398 @@
+"""
+Нагрузочный тест бота целиком: webhook → хендлеры → LLM → Telegram.
+
+Поднимает фейковый Bot API (loadtest/fake_telegram.py) и фейковый
+OpenAI/Groq (loadtest/fake_llm.py), запускает бота (`python main.py`)
+с TELEGRAM_API_URL / NEURO_BASE_URL / GROQ_BASE_URL на них и шлёт в
+/webhook синтетические апдейты с заданной частотой (пуассоновский поток).
+Нужен Redis — по умолчанию отдельная база 15, чтобы не смешивать с рабочей.
+
+По записанным вызовам Bot API для каждого запроса считается:
+- e2e — от отправки апдейта до финального сообщения (без кнопки [Отменить]);
+- ttfvt — до первого видимого текста ответа (не loader'а);
+- edits — сколько editMessageText/sendMessageDraft ушло на ответ;
+плюс 429 от фейкового Telegram, счётчики фейкового LLM и RSS бота.
+
+    python -m loadtest.run --rate 5 --duration 60 --out report.json
+    python -m loadtest.run --rate 5 --env STREAM_FLUSH_POLICY=fixed --out fixed.json
+    python -m loadtest.run --mix text=0.6,photo=0.2,voice=0.1,document=0.1 --stall-prob 0.05
+
+--no-bot поднимает только фейки и печатает env для бота — чтобы запустить
+его самому (под профайлером или отладчиком) и слать нагрузку этим же скриптом
+с --bot-url.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+import aiohttp
+from aiohttp import web
+
+from loadtest.fake_llm import FakeLLM
+from loadtest.fake_telegram import Call, FakeTelegram
+from loadtest.updates import KINDS, UpdateFactory
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TOKEN = "123456:LOADTEST"
+_SECRET = "loadtest"
+_USER_ID_BASE = 900_000_000
+
+# Текст loader'а: «💭 <b>Думаю...</b>», «✍️ <b>Готовлю ответ...</b>» и т.п.
+_LOADER_RE = re.compile(r"^\S+\s*<b>[^<]*\.\.\.</b>$")
+_ANSWER_METHODS = {"editmessagetext", "sendmessage", "sendrichmessage", "sendmessagedraft", "sendrichmessagedraft"}
+_FINAL_METHODS = {"editmessagetext", "sendmessage", "sendrichmessage", "editmessagereplymarkup", "senddocument"}
+_EDIT_METHODS = {"editmessagetext", "sendmessagedraft", "sendrichmessagedraft"}
+
+
+class Result:
+    __slots__ = ("kind", "e2e", "ttfvt", "edits", "timeout")
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.e2e: Optional[float] = None
+        self.ttfvt: Optional[float] = None
+        self.edits = 0
+        self.timeout = False
+
+
+def _analyze(calls: list[Call], t0: float) -> tuple[Optional[float], Optional[float], int]:
+    """(время финала, время первого видимого текста, edit'ы) по вызовам чата после t0."""
+    seen_markup = False
+    first_visible = None
+    edits = 0
+    for call in calls:
+        if call.t < t0:
+            continue
+        if call.method in _EDIT_METHODS:
+            edits += 1
+        if (
+            first_visible is None
+            and call.method in _ANSWER_METHODS
+            and call.text.strip()
+            and not _LOADER_RE.match(call.text.strip())
+        ):
+            first_visible = call.t
+        if call.has_markup:
+            seen_markup = True
+        elif seen_markup and call.method in _FINAL_METHODS:
+            return call.t, first_visible, edits
+    return None, first_visible, edits
+
+
+def _pct(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def _summary_ms(values: list[float]) -> dict[str, Optional[int]]:
+    return {
+        name: (int(v * 1000) if v is not None else None)
+        for name, v in (("p50", _pct(values, 0.5)), ("p95", _pct(values, 0.95)), ("p99", _pct(values, 0.99)))
+    }
+
+
+def _parse_mix(spec: str) -> dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r}, expected one of {KINDS}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def _rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.telegram = FakeTelegram(
+            chat_rate=args.tg_chat_rate,
+            chat_burst=args.tg_chat_burst,
+            latency=args.tg_latency,
+        )
+        self.llm = FakeLLM(
+            ttft=args.ttft,
+            token_rate=args.token_rate,
+            answer_tokens=args.answer_tokens,
+            stall_prob=args.stall_prob,
+            stall_seconds=args.stall_seconds,
+            seed=args.seed,
+        )
+        self.factory = UpdateFactory(self.telegram, args.seed)
+        self.results: list[Result] = []
+        self.skipped = 0
+        self.memory: list[float] = []
+        self._idle = list(range(_USER_ID_BASE, _USER_ID_BASE + args.users))
+        self._bot: Optional[asyncio.subprocess.Process] = None
+        self._runners: list[web.AppRunner] = []
+
+    # ── Инфраструктура ──
+    async def _serve(self, app: web.Application, port: int) -> None:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        self._runners.append(runner)
+
+    def bot_env(self) -> dict[str, str]:
+        args = self.args
+        env = {
+            "BOT_TOKEN": _TOKEN,
+            "NEURO_API_KEY": "loadtest",
+            "GROQ_API_KEY": "loadtest",
+            "PROXY": "",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{args.tg_port}",
+            "NEURO_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+            "GROQ_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+            "LLM_FALLBACK_ENDPOINTS": "[]",
+            "WEBHOOK_HOST": f"http://127.0.0.1:{args.bot_port}",
+            "WEBHOOK_SECRET": _SECRET,
+            "WEBAPP_HOST": "127.0.0.1",
+            "WEBAPP_PORT": str(args.bot_port),
+            "REDIS_HOST": args.redis_host,
+            "REDIS_PORT": str(args.redis_port),
+            "REDIS_DB": str(args.redis_db),
+            "LOG_LEVEL": args.log_level,
+        }
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        return env
+
+    async def _start_bot(self) -> None:
+        self._bot = await asyncio.create_subprocess_exec(
+            sys.executable, "main.py",
+            cwd=_ROOT,
+            env={**os.environ, **self.bot_env()},
+        )
+
+    async def _wait_ready(self, session: aiohttp.ClientSession) -> None:
+        """Бот готов, когда поставил webhook (on_startup ждёт nginx 2 с)."""
+        deadline = time.monotonic() + 60
+        while not self.telegram.webhook:
+            if self._bot is not None and self._bot.returncode is not None:
+                raise RuntimeError(f"bot exited with code {self._bot.returncode}")
+            if time.monotonic() > deadline:
+                raise RuntimeError("bot did not set webhook in 60s")
+            await asyncio.sleep(0.2)
+
+    async def _sample_memory(self) -> None:
+        while True:
+            if self._bot is not None:
+                rss = _rss_mb(self._bot.pid)
+                if rss is not None:
+                    self.memory.append(rss)
+            await asyncio.sleep(0.5)
+
+    # ── Нагрузка ──
+    async def _request(self, session: aiohttp.ClientSession, kind: str, user_id: int) -> None:
+        result = Result(kind)
+        self.results.append(result)
+        t0 = time.monotonic()
+        try:
+            for update in self.factory.make(kind, user_id):
+                async with session.post(
+                    self.args.bot_url,
+                    json=update,
+                    headers={"X-Telegram-Bot-Api-Secret-Token": _SECRET},
+                ) as response:
+                    response.raise_for_status()
+
+            deadline = t0 + self.args.timeout
+            calls = self.telegram.by_chat[user_id]
+            while True:
+                done, first_visible, result.edits = _analyze(calls, t0)
+                if done is not None:
+                    result.e2e = done - t0
+                    result.ttfvt = first_visible - t0 if first_visible is not None else None
+                    return
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    result.timeout = True
+                    return
+                event = self.telegram.wait_chat(user_id)
+                try:
+                    await asyncio.wait_for(event.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Хвост длинного ответа (send_long_text) ещё может идти — даём долететь
+            await asyncio.sleep(1.0)
+            self._idle.append(user_id)
+
+    async def _generate(self, session: aiohttp.ClientSession) -> list[asyncio.Task]:
+        args = self.args
+        kinds, weights = zip(*args.mix.items())
+        rng = random.Random(args.seed)
+        tasks = []
+        end = time.monotonic() + args.duration
+        while time.monotonic() < end:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            if not self._idle:
+                self.skipped += 1  # все пользователи ждут ответа — предложенная нагрузка выше пропускной
+                continue
+            user_id = self._idle.pop(rng.randrange(len(self._idle)))
+            kind = rng.choices(kinds, weights)[0]
+            tasks.append(asyncio.create_task(self._request(session, kind, user_id)))
+        return tasks
+
+    async def run(self) -> dict[str, Any]:
+        args = self.args
+        await self._serve(self.telegram.app(), args.tg_port)
+        await self._serve(self.llm.app(), args.llm_port)
+        if args.no_bot:
+            print("Fake servers are up. Run the bot with:")
+            for key, value in self.bot_env().items():
+                print(f"  {key}={value}")
+        else:
+            await self._start_bot()
+
+        sampler = asyncio.create_task(self._sample_memory())
+        try:
+            async with aiohttp.ClientSession() as session:
+                await self._wait_ready(session)
+                if args.warmup:
+                    await asyncio.gather(*(
+                        self._request(session, "text", self._idle.pop()) for _ in range(min(args.warmup, len(self._idle)))
+                    ))
+                    self.results.clear()
+                started = time.monotonic()
+                tasks = await self._generate(session)
+                await asyncio.gather(*tasks)
+                elapsed = time.monotonic() - started
+        finally:
+            sampler.cancel()
+            await self._shutdown()
+        return self.report(elapsed)
+
+    async def _shutdown(self) -> None:
+        if self._bot is not None and self._bot.returncode is None:
+            self._bot.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self._bot.wait(), 15)
+            except asyncio.TimeoutError:
+                self._bot.kill()
+        for runner in self._runners:
+            await runner.cleanup()
+
+    # ── Отчёт ──
+    def report(self, elapsed: float) -> dict[str, Any]:
+        def _block(results: list[Result]) -> dict[str, Any]:
+            done = [r for r in results if r.e2e is not None]
+            edits = [r.edits for r in done]
+            return {
+                "requests": len(results),
+                "completed": len(done),
+                "timeouts": sum(r.timeout for r in results),
+                "e2e_ms": _summary_ms([r.e2e for r in done]),
+                "ttfvt_ms": _summary_ms([r.ttfvt for r in done if r.ttfvt is not None]),
+                "edits_per_answer": {
+                    "mean": round(sum(edits) / len(edits), 2) if edits else None,
+                    "p95": _pct(edits, 0.95),
+                },
+            }
+
+        by_kind: dict[str, list[Result]] = defaultdict(list)
+        for r in self.results:
+            by_kind[r.kind].append(r)
+
+        return {
+            "config": {
+                "rate": self.args.rate,
+                "duration": self.args.duration,
+                "users": self.args.users,
+                "mix": self.args.mix,
+                "ttft": self.args.ttft,
+                "token_rate": self.args.token_rate,
+                "stall_prob": self.args.stall_prob,
+                "env": self.args.env,
+            },
+            "elapsed_s": round(elapsed, 1),
+            "skipped_no_idle_user": self.skipped,
+            **_block(self.results),
+            "by_kind": {kind: _block(results) for kind, results in sorted(by_kind.items())},
+            "telegram": {
+                "calls": len(self.telegram.calls),
+                "429": dict(self.telegram.rejected),
+                "429_total": sum(self.telegram.rejected.values()),
+            },
+            "llm": {"requests": self.llm.requests, "streams": self.llm.streams, "stalls": self.llm.stalls},
+            "memory_mb": {
+                "start": round(self.memory[0], 1) if self.memory else None,
+                "peak": round(max(self.memory), 1) if self.memory else None,
+                "end": round(self.memory[-1], 1) if self.memory else None,
+            },
+        }
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m loadtest.run")
+    load = parser.add_argument_group("нагрузка")
+    load.add_argument("--rate", type=float, default=2.0, help="запросов в секунду")
+    load.add_argument("--duration", type=float, default=60.0, help="секунд нагрузки")
+    load.add_argument("--users", type=int, default=200, help="пул пользователей (у каждого — один запрос за раз)")
+    load.add_argument("--mix", type=_parse_mix, default=_parse_mix("text=0.7,photo=0.1,album=0.05,voice=0.1,document=0.05"))
+    load.add_argument("--warmup", type=int, default=3, help="текстовых запросов до замера")
+    load.add_argument("--timeout", type=float, default=120.0, help="сек на один запрос")
+    load.add_argument("--seed", type=int, default=1)
+
+    llm = parser.add_argument_group("фейковый LLM")
+    llm.add_argument("--ttft", type=float, default=0.8, help="медиана времени до первого токена, сек")
+    llm.add_argument("--token-rate", type=float, default=60.0, help="токенов в секунду")
+    llm.add_argument("--answer-tokens", type=int, default=400)
+    llm.add_argument("--stall-prob", type=float, default=0.0, help="доля стримов, замирающих посреди ответа")
+    llm.add_argument("--stall-seconds", type=float, default=10.0)
+
+    tg = parser.add_argument_group("фейковый Telegram")
+    tg.add_argument("--tg-chat-rate", type=float, default=1.0, help="сообщений/с в личный чат до 429")
+    tg.add_argument("--tg-chat-burst", type=float, default=3.0)
+    tg.add_argument("--tg-latency", type=float, default=0.05, help="сек на ответ Bot API")
+
+    infra = parser.add_argument_group("инфраструктура")
+    infra.add_argument("--tg-port", type=int, default=18081)
+    infra.add_argument("--llm-port", type=int, default=18082)
+    infra.add_argument("--bot-port", type=int, default=18080)
+    infra.add_argument("--bot-url", default=None, help="webhook бота (по умолчанию — запущенного этим скриптом)")
+    infra.add_argument("--no-bot", action="store_true", help="не запускать бота — только фейки")
+    infra.add_argument("--redis-host", default="127.0.0.1")
+    infra.add_argument("--redis-port", type=int, default=6379)
+    infra.add_argument("--redis-db", type=int, default=15)
+    infra.add_argument("--log-level", default="WARNING")
+    infra.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="доп. env для бота (A/B)")
+    infra.add_argument("--out", help="куда записать JSON-отчёт")
+
+    args = parser.parse_args(argv)
+    args.bot_url = args.bot_url or f"http://127.0.0.1:{args.bot_port}/webhook"
+
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Синтетические webhook-апдейты: текст, фото, альбом, голосовое, документ.
+
+Файлы для фото/голосовых/документов регистрируются в FakeTelegram.files
+под своим file_id — бот скачает их через getFile как настоящие. Тексты
+уникальные (счётчик в конце), чтобы кэш ответов не превратил тест в
+тест Redis.
+"""
+from __future__ import annotations
+
+import itertools
+import os
+import random
+import time
+from io import BytesIO
+from typing import Any
+
+from loadtest.fake_telegram import FakeTelegram
+
+KINDS = ("text", "photo", "album", "voice", "document")
+
+_QUESTIONS = (
+    "Объясни, почему небо голубое, простыми словами",
+    "Реши задачу: поезд прошёл 120 км за 1.5 часа, найди среднюю скорость",
+    "Напиши код на python, который считает сумму чётных чисел в списке",
+    "Чем отличается митоз от мейоза? Сравни в таблице",
+    "Переведи на английский: я люблю читать книги по вечерам",
+    "Выведи формулу корней квадратного уравнения",
+)
+
+_ALBUM_SIZE = 3
+
+
+def _jpeg(width: int, height: int, seed: int) -> bytes:
+    """Настоящий JPEG — бот его декодирует и пережимает (utils/images.py)."""
+    from PIL import Image  # есть там же, где бот
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buf = BytesIO()
+    image.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+class UpdateFactory:
+    def __init__(self, telegram: FakeTelegram, seed: int = 1) -> None:
+        self.telegram = telegram
+        self._rng = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._counter = itertools.count(1)
+        self._groups = itertools.count(1)
+        self._photos = [_jpeg(1600, 1200, i) for i in range(4)]
+        self._voice = b"OggS" + os.urandom(24 * 1024)
+        body = ("Конспект лекции по физике. " * 40 + "\n") * 30
+        self._document = body.encode("utf-8")
+
+    def _file(self, prefix: str, data: bytes) -> dict[str, Any]:
+        file_id = f"{prefix}-{next(self._counter)}-{os.urandom(6).hex()}"
+        self.telegram.files[file_id] = data
+        return {"file_id": file_id, "file_unique_id": file_id[-16:], "file_size": len(data)}
+
+    def _message(self, user_id: int, **fields: Any) -> dict[str, Any]:
+        user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "language_code": "ru"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                "from": user,
+                **fields,
+            },
+        }
+
+    def _photo_sizes(self) -> list[dict[str, Any]]:
+        photo = self._file("photo", self._rng.choice(self._photos))
+        return [{**photo, "width": 1600, "height": 1200}]
+
+    def make(self, kind: str, user_id: int) -> list[dict[str, Any]]:
+        """Апдейты одного запроса (альбом — несколько)."""
+        question = f"{self._rng.choice(_QUESTIONS)} (#{next(self._counter)})"
+        if kind == "text":
+            return [self._message(user_id, text=question)]
+        if kind == "photo":
+            return [self._message(user_id, photo=self._photo_sizes(), caption=question)]
+        if kind == "album":
+            group = f"lt{next(self._groups)}"
+            return [
+                self._message(
+                    user_id,
+                    photo=self._photo_sizes(),
+                    media_group_id=group,
+                    **({"caption": question} if i == 0 else {}),
+                )
+                for i in range(_ALBUM_SIZE)
+            ]
+        if kind == "voice":
+            voice = self._file("voice", self._voice)
+            return [self._message(user_id, voice={**voice, "duration": 7, "mime_type": "audio/ogg"})]
+        if kind == "document":
+            doc = self._file("doc", self._document)
+            return [self._message(
+                user_id,
+                document={**doc, "file_name": "lecture.txt", "mime_type": "text/plain"},
+                caption=question,
+            )]
+        raise ValueError(f"unknown update kind {kind!r}")
@@ -2,14 +2,45 @@
 import asyncio
 import logging
 import os
+import signal
+import socket
+import sys
 
 from aiohttp import web
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
-from config.config import bot, dp, shutdown_clients, WEBHOOK_SECRET
+from config.config import (
+    bot,
+    dp,
+    http_client_groq,
+    http_client_main,
+    http_clients_fallback,
+    redis,
+    shutdown_clients,
+    DRAIN_TIMEOUT,
+    OTLP_ENDPOINT,
+    TRACE_JSON_PATH,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_MS,
+    WEBHOOK_SECRET,
+)
 from handlers import final, general, text_file_audio
 from keyboards.set_menu import set_main_menu
 from middlewares.middlewares import GeneralMiddleware
+from utils.admission import admission
+from utils.cancellation import _active_tasks, cancel_bus
+from utils.documents import shutdown_document_pool
+from utils.images import shutdown_image_pool
+from utils.media import cleanup_spill_dir
+from utils.media_cache import media_cache
+from utils.metrics import httpx_pool_usage, redis_pool_usage, registry
+from utils.rate_limiter import tg_scheduler
+from utils.tracing import (
+    TraceLogFilter,
+    configure as configure_tracing,
+    shutdown_otlp_exporter,
+    start_otlp_exporter,
+)
 
 # uvloop ускоряет asyncio в 2-4 раза на Linux. Если нет — игнор.
 try:
@@ -25,18 +56,39 @@ except ImportError:
 # ────────────────────────────────────────────────────────────────────────────
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
-# В DEBUG-режиме показываем больше: миллисекунды, файл:линия — это нужно
-# чтобы видеть какой именно запрос идёт и сколько он отрабатывал.
+# В DEBUG-режиме показываем больше: миллисекунды, файл:линия, trace_id и
+# стадию — это нужно чтобы видеть какой именно запрос идёт и сколько он отрабатывал.
 if LOG_LEVEL == "DEBUG":
-    log_format = "%(asctime)s.%(msecs)03d | %(levelname)-5s | %(name)s:%(lineno)d | %(message)s"
+    log_format = (
+        "%(asctime)s.%(msecs)03d | %(levelname)-5s | %(trace_id)s %(stage)s | "
+        "%(name)s:%(lineno)d | %(message)s"
+    )
 else:
-    log_format = "%(asctime)s | %(levelname)-8s | %(name)s | %(message)s"
+    log_format = "%(asctime)s | %(levelname)-8s | %(trace_id)s | %(name)s | %(message)s"
+
+# Под supervisor.py логи воркеров идут в один stdout — помечаем, чей
+if int(os.environ.get("WORKERS", "1")) > 1:
+    log_format = f"w{os.environ.get('WORKER_INDEX', '0')} | {log_format}"
 
 logging.basicConfig(
     level=LOG_LEVEL,
     format=log_format,
     datefmt="%Y-%m-%d %H:%M:%S",
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceLogFilter())
+
+# Span'ы трейсинга — JSON-строками, отдельно от обычного лога
+configure_tracing(sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS)
+_trace_handler = (
+    logging.FileHandler(TRACE_JSON_PATH, encoding="utf-8")
+    if TRACE_JSON_PATH
+    else logging.StreamHandler(sys.stdout)
+)
+_trace_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.getLogger("trace").addHandler(_trace_handler)
+logging.getLogger("trace").setLevel(logging.INFO)
+logging.getLogger("trace").propagate = False
 
 # Снижаем шум сторонних либ — они в DEBUG режиме залили бы консоль
 # своими внутренностями (HTTP-заголовками, retry-стратегиями и т.п.)
@@ -62,9 +114,37 @@ WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
 WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
 WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
 
+# Воркеры supervisor.py: общий WEBAPP_PORT (SO_REUSEPORT) и у каждого свой
+# 127.0.0.1:WORKER_PORT для health/метрик. Webhook и меню ставит только primary.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_PORT = int(os.environ.get("WORKER_PORT", "0"))
+WORKER_RESTART = os.environ.get("WORKER_RESTART") == "1"
+IS_PRIMARY = WORKER_INDEX == 0
+
+# SIGUSR1 от supervisor.py — перезапуск одного воркера: тот же graceful
+# shutdown, что по SIGTERM, но webhook остаётся (остальные воркеры работают)
+_restarting = False
+
+_WEBHOOK_HANDLER = web.AppKey("webhook_handler", SimpleRequestHandler)
+
+
+def _on_restart_signal(_signum, _frame) -> None:
+    global _restarting
+    _restarting = True
+    signal.raise_signal(signal.SIGTERM)
+
 
 async def on_startup(app: web.Application) -> None:
-    logging.info(f"Starting bot (uvloop={_UVLOOP})")
+    logging.info(f"Starting bot (uvloop={_UVLOOP}, worker {WORKER_INDEX + 1}/{WORKERS})")
+    if IS_PRIMARY:
+        # spill-каталог общий на все воркеры — чистить его достаточно одному
+        cleanup_spill_dir()
+    start_otlp_exporter(OTLP_ENDPOINT)
+    cancel_bus.start()
+    tg_scheduler.start()
+    if not IS_PRIMARY:
+        return
     try:
         await set_main_menu()
         logging.info("Main menu set")
@@ -79,7 +159,9 @@ async def on_startup(app: web.Application) -> None:
         # на изменение, поэтому всегда переустанавливаем при первом запуске
         kwargs = {
             "url": WEBHOOK_URL,
-            "drop_pending_updates": True,
+            # Перезапуск упавшего primary — остальные воркеры работали,
+            # накопившиеся апдейты настоящие, их не выбрасываем
+            "drop_pending_updates": not WORKER_RESTART,
             "allowed_updates": dp.resolve_used_update_types(),
         }
         if WEBHOOK_SECRET:
@@ -100,12 +182,43 @@ async def on_startup(app: web.Application) -> None:
         logging.exception(f"on_startup error: {e}")
 
 
+async def _drain(app: web.Application) -> None:
+    """
+    Ждёт до DRAIN_TIMEOUT начатые апдейты (фоновые задачи aiogram при
+    handle_in_background) и задачи из реестра отмены; не успевшие —
+    отменяются. Новые апдейты к этому моменту уже не приходят: aiohttp
+    закрыл слушающий сокет и keep-alive соединения до on_shutdown.
+    """
+    # Приватный атрибут aiogram — если его переименуют, ждём хотя бы реестр отмены
+    background = getattr(app[_WEBHOOK_HANDLER], "_background_feed_update_tasks", ())
+    pending = {task for task in (*background, *_active_tasks.values()) if not task.done()}
+    if not pending:
+        return
+    logging.info(f"Draining {len(pending)} in-flight tasks (up to {DRAIN_TIMEOUT:.0f}s)")
+    _, still_running = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+    if still_running:
+        logging.warning(f"{len(still_running)} tasks still running after drain, cancelling")
+        for task in still_running:
+            task.cancel()
+        # Отменённым хендлерам нужен Telegram и Redis, чтобы показать «Отменено»
+        await asyncio.wait(still_running, timeout=5)
+
+
 async def on_shutdown(app: web.Application) -> None:
-    logging.info("Shutting down bot")
-    try:
-        await bot.delete_webhook(drop_pending_updates=False)
-    except Exception as e:
-        logging.warning(f"delete_webhook on shutdown: {e}")
+    logging.info(f"Shutting down bot (restart={_restarting})")
+    # Клиенты и сессия бота нужны до последнего апдейта — закрываются после
+    # (сессию бота закрывает SimpleRequestHandler, его on_shutdown идёт за этим)
+    await _drain(app)
+    if IS_PRIMARY and not _restarting:
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+        except Exception as e:
+            logging.warning(f"delete_webhook on shutdown: {e}")
+    await cancel_bus.stop()
+    await tg_scheduler.stop()
+    shutdown_image_pool()
+    shutdown_document_pool()
+    await shutdown_otlp_exporter()
     await shutdown_clients()
 
 
@@ -114,10 +227,94 @@ async def health_check(_request: web.Request) -> web.Response:
     try:
         # Проверяем что бот живой
         await bot.get_me()
-        return web.Response(text="OK")
+        return web.Response(text="OK", headers={"X-Worker": str(WORKER_INDEX)})
     except Exception as e:
         logging.warning(f"health_check failed: {e}")
-        return web.Response(text="DEGRADED", status=503)
+        return web.Response(text="DEGRADED", status=503, headers={"X-Worker": str(WORKER_INDEX)})
+
+
+async def liveness_check(_request: web.Request) -> web.Response:
+    """
+    Для supervisor.py: event loop воркера отвечает. Без get_me — недоступный
+    Telegram не повод перезапускать воркеры.
+    """
+    return web.Response(text="OK", headers={"X-Worker": str(WORKER_INDEX)})
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Метрики
+# ────────────────────────────────────────────────────────────────────────────
+def _httpx_pools() -> dict[tuple[str, str], float]:
+    clients = {"main": http_client_main, "groq": http_client_groq}
+    clients.update((f"fallback{i}", c) for i, c in enumerate(http_clients_fallback, 1))
+    values = {}
+    for name, http in clients.items():
+        usage = httpx_pool_usage(http)
+        for state, count in (usage or {}).items():
+            values[(name, state)] = count
+    return values
+
+
+def _redis_pool() -> dict[tuple[str], float]:
+    usage = redis_pool_usage(redis) or {}
+    return {(state,): count for state, count in usage.items() if count is not None}
+
+
+def _admission_slots() -> dict[tuple[str, str], float]:
+    return {
+        (name, state): stats[state]
+        for name, stats in admission.stats().items()
+        for state in ("limit", "active", "queued")
+    }
+
+
+def _media_cache_stats() -> dict[tuple[str, str], float]:
+    return {
+        (kind, stat): value
+        for kind, stats in media_cache.stats().items()
+        for stat, value in stats.items()
+    }
+
+
+def register_gauges() -> None:
+    registry.gauge(
+        "bot_active_tasks",
+        "In-flight cancellable requests (utils.cancellation registry)",
+        lambda: len(_active_tasks),
+    )
+    registry.gauge(
+        "bot_httpx_pool_connections",
+        "httpx connection pool usage per upstream client",
+        _httpx_pools,
+        ("client", "state"),
+    )
+    registry.gauge(
+        "bot_redis_pool_connections",
+        "Redis connection pool usage",
+        _redis_pool,
+        ("state",),
+    )
+    registry.gauge(
+        "bot_admission_slots",
+        "Admission control per upstream: limit, active requests and queue length",
+        _admission_slots,
+        ("upstream", "state"),
+    )
+    registry.gauge(
+        "bot_media_cache",
+        "Media cache since process start: hits by file id / content, misses, "
+        "source bytes not downloaded, entries evicted",
+        _media_cache_stats,
+        ("kind", "stat"),
+    )
+
+
+async def metrics_handler(_request: web.Request) -> web.Response:
+    """
+    Prometheus scrape. Наружу через nginx не проксируется — доступен
+    только из docker-сети (bot:8080/metrics).
+    """
+    return web.Response(text=registry.render(), content_type="text/plain")
 
 
 def main() -> None:
@@ -141,11 +338,31 @@ def main() -> None:
         secret_token=WEBHOOK_SECRET or None,
     )
     webhook_handler.register(app, path=WEBHOOK_PATH)
+    app[_WEBHOOK_HANDLER] = webhook_handler
+    if WORKERS > 1:
+        signal.signal(signal.SIGUSR1, _on_restart_signal)
 
     app.router.add_get("/health", health_check)
+    app.router.add_get("/health/live", liveness_check)
+    register_gauges()
+    app.router.add_get("/metrics", metrics_handler)
+
+    # Приватный порт воркера — health и метрики именно этого процесса
+    worker_sock = None
+    if WORKER_PORT:
+        worker_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        worker_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        worker_sock.bind(("127.0.0.1", WORKER_PORT))
 
     logging.info(f"Starting webhook server on {WEBAPP_HOST}:{WEBAPP_PORT}")
-    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, access_log=None)
+    web.run_app(
+        app,
+        host=WEBAPP_HOST,
+        port=WEBAPP_PORT,
+        reuse_port=WORKERS > 1,
+        sock=worker_sock,
+        access_log=None,
+    )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-"""Глобальный middleware — логирование и ловля непойманных исключений."""
+"""Глобальный middleware — логирование, метрики, трейсинг и ловля непойманных исключений."""
 import logging
 import time
 from typing import Any, Awaitable, Callable
@@ -6,12 +6,18 @@ from typing import Any, Awaitable, Callable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Update, User
 
+from utils.metrics import operation_seconds
+from utils.tracing import start_trace
+
 logger = logging.getLogger(__name__)
 
 
 class GeneralMiddleware(BaseMiddleware):
     """
-    Логирует входящие апдейты с временем обработки.
+    Логирует входящие апдейты с временем обработки и пишет его в
+    bot_operation_seconds{op="update"} (медленные — ещё и в лог).
+    Открывает корневой span трейса апдейта: все log_timing внутри хендлера
+    и запущенных им задач становятся его потомками.
     Ловит ВСЕ исключения, чтобы не было «Task exception was never retrieved».
     """
 
@@ -24,18 +30,23 @@ class GeneralMiddleware(BaseMiddleware):
         user: User | None = data.get("event_from_user")
         user_id = user.id if user else "unknown"
 
-        start = time.monotonic()
-        try:
-            result = await handler(event, data)
-            elapsed = time.monotonic() - start
-            if elapsed > 5.0:  # медленные хендлеры — в лог
-                logger.info(f"Handler took {elapsed:.1f}s for user {user_id}")
-            return result
-
-        except Exception as e:
-            elapsed = time.monotonic() - start
-            logger.exception(
-                f"Unhandled exception in handler for user {user_id} "
-                f"after {elapsed:.1f}s: {e}"
-            )
-            return None
+        with start_trace("update", user=user_id, type=getattr(event, "event_type", None)) as root:
+            start = time.monotonic()
+            try:
+                result = await handler(event, data)
+                elapsed = time.monotonic() - start
+                operation_seconds.observe(elapsed, op="update", status="ok")
+                if elapsed > 5.0:  # медленные хендлеры — в лог
+                    logger.info(f"Handler took {elapsed:.1f}s for user {user_id}")
+                return result
+
+            except Exception as e:
+                elapsed = time.monotonic() - start
+                operation_seconds.observe(elapsed, op="update", status="fail")
+                root.status = "fail"
+                root.error = f"{type(e).__name__}: {e}"
+                logger.exception(
+                    f"Unhandled exception in handler for user {user_id} "
+                    f"after {elapsed:.1f}s: {e}"
+                )
+                return None
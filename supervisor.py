@@ -0,0 +1,227 @@
+"""
+Супервизор: N процессов-воркеров main.py на одном порту.
+
+Один процесс — один event loop — одно ядро: рендер markdown, разбор JSON
+апдейтов и вся asyncio-работа шли на одном ядре, остальные простаивали,
+а p99 рос вместе с нагрузкой.
+
+Теперь `python supervisor.py` запускает WORKERS воркеров:
+
+- каждый воркер — обычный `python main.py` (свежий интерпретатор, а не
+  fork уже импортированного config: клиенты httpx/Redis/aiohttp и пулы
+  процессов у каждого свои) с WORKER_INDEX / WORKERS в env;
+- все слушают WEBAPP_PORT с SO_REUSEPORT — ядро само раскладывает
+  соединения от nginx по воркерам;
+- set_webhook и set_main_menu делает только primary (WORKER_INDEX=0),
+  остальные просто принимают апдейты;
+- у воркера i есть приватный порт 127.0.0.1:WORKER_PORT_BASE+i с теми же
+  /health, /health/live и /metrics — здоровье и метрики каждого воркера
+  видны отдельно (через общий порт отвечает случайный);
+- супервизор раз в HEALTH_INTERVAL опрашивает /health/live каждого
+  воркера; умерший или HEALTH_FAILURES раз подряд не ответивший воркер
+  перезапускается (с backoff, если падает сразу после старта). Зависшему
+  уходит SIGUSR1 (graceful shutdown без delete_webhook — остальные воркеры
+  продолжают принимать апдейты), через WORKER_KILL_TIMEOUT — KILL; ожидание
+  идёт в том же цикле опроса, остальные воркеры не ждут;
+- SIGTERM/SIGINT пересылается воркерам как SIGTERM, супервизор ждёт их до
+  WORKER_STOP_TIMEOUT (воркер дорабатывает начатые апдейты до
+  DRAIN_TIMEOUT), потом KILL.
+
+Отмена запроса между воркерами работает как между репликами —
+через Redis (utils/cancellation.py). Admission control, rate limiter
+и пулы картинок/документов — на процесс, т.е. лимиты умножаются на N.
+
+WORKERS<=1 — супервизор просто становится main.py (exec), как раньше.
+Модуль не импортирует config: ему не нужны токены и соединения.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# Приватные порты воркеров: WORKER_PORT_BASE + WORKER_INDEX, только 127.0.0.1
+WORKER_PORT_BASE = int(os.environ.get("WORKER_PORT_BASE", "9100"))
+HEALTH_INTERVAL = 5.0  # сек между опросами
+HEALTH_TIMEOUT = 3.0  # сек на ответ /health/live
+HEALTH_FAILURES = 3  # столько неответов подряд — и воркер перезапускается
+WORKER_START_GRACE = 30.0  # сек после старта без проверок (on_startup, импорт)
+WORKER_STOP_TIMEOUT = 75.0  # сек на graceful shutdown (drain в воркере — DRAIN_TIMEOUT=45)
+WORKER_KILL_TIMEOUT = 10.0  # сек после SIGUSR1 зависшему воркеру, потом KILL
+RESTART_BACKOFF_MAX = 30.0  # сек; воркер, проживший меньше START_GRACE, ждёт дольше
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("supervisor")
+
+
+class Worker:
+    """Один процесс main.py и его состояние для супервизора."""
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.port = WORKER_PORT_BASE + index
+        self.proc: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.starts = 0
+        self.failures = 0
+        self.crashes = 0  # подряд, с коротким временем жизни — для backoff
+        self.restart_at = 0.0
+        self.stopping = False
+        self.kill_at = 0.0  # monotonic-дедлайн KILL после stop(), 0 — не назначен
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self) -> None:
+        env = {
+            **os.environ,
+            "WORKER_INDEX": str(self.index),
+            "WORKERS": str(WORKERS),
+            "WORKER_PORT": str(self.port),
+            # Перезапущенный primary не сбрасывает накопившиеся в Telegram апдейты
+            "WORKER_RESTART": "1" if self.starts else "0",
+        }
+        # Своя сессия: Ctrl+C в терминале получает только супервизор, а воркеры —
+        # один SIGTERM от него, иначе второй сигнал оборвёт их graceful shutdown
+        self.proc = subprocess.Popen(
+            [sys.executable, "main.py"], cwd=_ROOT, env=env, start_new_session=True
+        )
+        self.started = time.monotonic()
+        self.starts += 1
+        self.failures = 0
+        self.stopping = False
+        self.kill_at = 0.0
+        logger.info(f"worker {self.index} started: pid={self.proc.pid} port={self.port}")
+
+    def stop(self, sig: int = signal.SIGTERM) -> None:
+        """SIGTERM — остановка всего сервиса, SIGUSR1 — перезапуск только этого воркера."""
+        if self.alive and not self.stopping:
+            self.stopping = True
+            self.proc.send_signal(sig)
+
+    def probe(self) -> bool:
+        try:
+            with urllib.request.urlopen(
+                f"http://127.0.0.1:{self.port}/health/live", timeout=HEALTH_TIMEOUT
+            ) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
+
+
+class Supervisor:
+    def __init__(self, count: int) -> None:
+        self.workers = [Worker(i) for i in range(count)]
+        self._shutdown = False
+        self._probes = ThreadPoolExecutor(max_workers=count, thread_name_prefix="probe")
+
+    def _on_signal(self, signum, _frame) -> None:
+        logger.info(f"Got signal {signum}, stopping workers")
+        self._shutdown = True
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for worker in self.workers:
+            worker.start()
+        while not self._shutdown:
+            self._reap()
+            self._check_health()
+            deadline = time.monotonic() + HEALTH_INTERVAL
+            while not self._shutdown and time.monotonic() < deadline:
+                time.sleep(0.2)
+                self._reap()
+        return self._stop_all()
+
+    def _reap(self) -> None:
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.proc is None:
+                continue
+            if worker.alive:
+                if worker.kill_at and now >= worker.kill_at:
+                    logger.warning(f"worker {worker.index} did not stop in time, killing")
+                    worker.kill_at = 0.0
+                    worker.proc.kill()
+                continue
+            if worker.restart_at == 0.0:
+                lived = now - worker.started
+                worker.crashes = worker.crashes + 1 if lived < WORKER_START_GRACE else 1
+                delay = min(RESTART_BACKOFF_MAX, 2 ** (worker.crashes - 1))
+                worker.restart_at = now + delay
+                logger.warning(
+                    f"worker {worker.index} exited: code={worker.proc.returncode} "
+                    f"lived={lived:.0f}s, restart in {delay:.0f}s"
+                )
+            if now >= worker.restart_at and not self._shutdown:
+                worker.restart_at = 0.0
+                worker.start()
+
+    def _check_health(self) -> None:
+        now = time.monotonic()
+        due = [
+            w for w in self.workers
+            if w.alive and not w.stopping and now - w.started >= WORKER_START_GRACE
+        ]
+        for worker, ok in zip(due, self._probes.map(Worker.probe, due)):
+            if ok:
+                if worker.failures:
+                    logger.info(f"worker {worker.index} healthy again")
+                worker.failures = 0
+                continue
+            worker.failures += 1
+            logger.warning(
+                f"worker {worker.index} health check failed ({worker.failures}/{HEALTH_FAILURES})"
+            )
+            if worker.failures >= HEALTH_FAILURES:
+                logger.error(f"worker {worker.index} unresponsive, restarting")
+                self._terminate(worker)
+
+    def _terminate(self, worker: Worker) -> None:
+        # Завис — graceful shutdown может и не сработать: через
+        # WORKER_KILL_TIMEOUT _reap его убьёт, а после выхода перезапустит
+        worker.stop(signal.SIGUSR1)
+        worker.kill_at = time.monotonic() + WORKER_KILL_TIMEOUT
+
+    def _stop_all(self) -> int:
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for worker in self.workers:
+            if worker.proc is None:
+                continue
+            try:
+                worker.proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"worker {worker.index} did not stop in time, killing")
+                worker.proc.kill()
+                worker.proc.wait()
+        self._probes.shutdown(wait=False)
+        logger.info("All workers stopped")
+        return 0
+
+
+def main() -> int:
+    if WORKERS <= 1:
+        os.chdir(_ROOT)
+        os.execv(sys.executable, [sys.executable, "main.py"])
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger.info(f"Starting {WORKERS} workers, private ports from {WORKER_PORT_BASE}")
+    return Supervisor(WORKERS).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,9 @@
+"""
+Общие настройки тестов: фиктивные обязательные переменные окружения, чтобы
+модули, импортирующие config, загружались без .env. Сети при импорте нет —
+клиенты Redis/httpx подключаются лениво.
+"""
+import os
+
+for _name, _value in (("BOT_TOKEN", "123:abc"), ("NEURO_API_KEY", "x"), ("GROQ_API_KEY", "x")):
+    os.environ.setdefault(_name, _value)
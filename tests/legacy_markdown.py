@@ -0,0 +1,132 @@
+"""
+Замороженная копия конвертера до токенизатора (utils/functions.py до
+переноса в utils/markdown.py): цепочка re.sub + _validate_and_fix_html.
+Эталон для дифференциальных тестов — не трогать и не импортировать из бота.
+"""
+from __future__ import annotations
+
+import re
+from html import escape
+
+_ALLOWED_TAGS = {"b", "i", "u", "s", "code", "pre", "a", "blockquote"}
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Rich Messages (Bot API 10.1, июнь 2026) — детект таблиц/формул
+# ────────────────────────────────────────────────────────────────────────────
+_MD_TABLE_ROW_RE = re.compile(r"^\s*\|.+\|\s*$", re.MULTILINE)
+_MD_TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)+\|?\s*$", re.MULTILINE)
+_LATEX_BLOCK_RE = re.compile(r"\$\$.+?\$\$", re.DOTALL)
+_LATEX_INLINE_RE = re.compile(r"(?<!\$)\$(?!\$)[^\n$]+?(?<!\$)\$(?!\$)")
+_LATEX_BRACKET_RE = re.compile(r"\\\[.+?\\\]|\\\(.+?\\\)", re.DOTALL)
+
+
+def contains_rich_markup(text: str) -> bool:
+    """
+    True, если в тексте есть markdown-таблица или LaTeX-формула — такие ответы
+    стоит отправлять через sendRichMessage (Bot API 10.1), а не через
+    markdown_to_telegram_html, который таблицы/формулы не умеет рендерить.
+    """
+    if not text:
+        return False
+    if _MD_TABLE_SEP_RE.search(text) and _MD_TABLE_ROW_RE.search(text):
+        return True
+    if _LATEX_BLOCK_RE.search(text) or _LATEX_BRACKET_RE.search(text):
+        return True
+    if _LATEX_INLINE_RE.search(text):
+        return True
+    return False
+
+
+def markdown_to_telegram_html(text: str) -> str:
+    """
+    Конвертирует Markdown в безопасный для Telegram HTML.
+    Гарантирует, что все теги сбалансированы — ключевое для стриминга,
+    где отображаемый текст обрывается посреди тега.
+    """
+    text = escape(text)
+
+    # Горизонтальная линия
+    text = re.sub(r"^\s*---\s*$", "──────────────────", text, flags=re.MULTILINE)
+
+    # >>> цитата (после escape стало &gt;&gt;&gt;)
+    text = re.sub(
+        r"(^|\n)\s*&gt;&gt;&gt;\s*(.*?)(?=\n|$)",
+        r"\1<blockquote>\2</blockquote>",
+        text,
+        flags=re.MULTILINE,
+    )
+
+    # Заголовки # ## ### → <b>
+    text = re.sub(r"^(#+)\s*(.*?)\s*$", r"<b>\2</b>", text, flags=re.MULTILINE)
+
+    # Жирный
+    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text, flags=re.DOTALL)
+    text = re.sub(r"__(.*?)__", r"<b>\1</b>", text, flags=re.DOTALL)
+
+    # Курсив (одиночные * и _, но не при двойных)
+    text = re.sub(r"(?<!\*)\*(?!\*)([^*\n]+?)\*(?!\*)", r"<i>\1</i>", text)
+    text = re.sub(r"(?<!_)_(?!_)([^_\n]+?)_(?!_)", r"<i>\1</i>", text)
+
+    # Зачёркнутый
+    text = re.sub(r"~~(.*?)~~", r"<s>\1</s>", text, flags=re.DOTALL)
+
+    # Ссылки
+    text = re.sub(r"\[(.*?)\]\((.*?)\)", r'<a href="\2">\1</a>', text)
+
+    # Блок кода (тройные кавычки) — должен идти ДО однострочного `code`
+    text = re.sub(r"```(?:\w*\n)?(.*?)```", r"<pre>\1</pre>", text, flags=re.DOTALL)
+
+    # Однострочный код
+    text = re.sub(r"`([^`\n]+)`", r"<code>\1</code>", text)
+
+    # Очистим возможное вложение <b> вокруг <pre>/<blockquote>
+    text = re.sub(r"<b>(<pre>.*?</pre>)</b>", r"\1", text, flags=re.DOTALL)
+    text = re.sub(r"<b>(<blockquote>.*?</blockquote>)</b>", r"\1", text, flags=re.DOTALL)
+
+    return _validate_and_fix_html(text)
+
+
+def _validate_and_fix_html(html: str) -> str:
+    """
+    Балансирует теги: открытые без закрытия — закрывает, лишние закрывающие — выкидывает.
+    Это критично для стриминга, где сообщение обрывается посреди форматирования.
+    """
+    stack: list[str] = []
+    result: list[str] = []
+    parts = re.split(r"(</?[^>]+>)", html)
+
+    for part in parts:
+        if not part:
+            continue
+
+        if open_match := re.match(r"<(\w+)(?:\s[^>]*)?>$", part):
+            tag = open_match.group(1).lower()
+            if tag in _ALLOWED_TAGS:
+                stack.append(tag)
+                result.append(part)
+            # неизвестные теги — игнорируем (могут прийти из бредового вывода модели)
+
+        elif close_match := re.match(r"</(\w+)>$", part):
+            tag = close_match.group(1).lower()
+            if tag not in _ALLOWED_TAGS:
+                continue
+            if stack and stack[-1] == tag:
+                stack.pop()
+                result.append(part)
+            elif tag in stack:
+                # закрываем «через голову» — закрываем всё что выше по стеку
+                while stack and stack[-1] != tag:
+                    result.append(f"</{stack.pop()}>")
+                if stack:
+                    stack.pop()
+                    result.append(part)
+            # лишний закрывающий — игнор
+        else:
+            result.append(part)
+
+    while stack:
+        result.append(f"</{stack.pop()}>")
+    return "".join(result)
+
+
@@ -0,0 +1,113 @@
+"""
+Дифференциальные тесты utils/markdown.py.
+
+- токенизатор против замороженной цепочки re.sub (tests/legacy_markdown.py)
+  на случайных склейках разметки;
+- флаг render_markdown против contains_rich_markup;
+- StreamingMarkdownRenderer против полного рендера на каждом флаше.
+
+Генератор — seeded random, падение воспроизводится по seed из имени теста.
+"""
+from __future__ import annotations
+
+import random
+import re
+from pathlib import Path
+
+import pytest
+
+from tests import legacy_markdown
+from utils.markdown import (
+    StreamingMarkdownRenderer,
+    contains_rich_markup,
+    markdown_to_telegram_html,
+    render_markdown,
+)
+
+_CORPUS = Path(__file__).resolve().parent.parent / "benchmarks" / "corpus"
+
+# Без обратных кавычек: код теперь вырезается первым, и разметка внутри него
+# намеренно больше не интерпретируется — тут легаси-поведение не эталон
+_INLINE_ATOMS = [
+    "**", "*", "__", "_", "~~", "\n", "\n\n", " ", "# ", "## ", "---", ">>> ",
+    "x", "слово", "[", "](", ")", "[a](b)", "<", ">", "&",
+]
+_RICH_ATOMS = _INLINE_ATOMS + [
+    "|", "| a | b |", "|---|---|", "\n|", ":--", "$", "$$", "\\[", "\\]",
+    "\\(", "\\)", "x^2", "`", "```",
+]
+_STREAM_ATOMS = _INLINE_ATOMS + [
+    "`", "```", "```python\n", "```\n", "\n```\n", "\n\n\n", "  ", "#", ">",
+    "-", "- item", "\t", " \n", "(", "]", "1. ", "code()", "$", "|",
+]
+
+# Разметка внутри URL ссылки: легаси паровал её вместе с текстом и вставлял
+# теги в href (`[**a](**b)` → href="<b>…"), токенизатор URL не трогает —
+# это исправленный баг старой цепочки, а не поведение, которое нужно сохранять
+_MARKUP_IN_HREF_RE = re.compile(r'href="[^"]*[<*_~]')
+
+
+def _random_text(rng: random.Random, atoms: list[str], max_atoms: int) -> str:
+    return "".join(rng.choice(atoms) for _ in range(rng.randint(1, max_atoms)))
+
+
+def _corpus_texts() -> list[str]:
+    return [p.read_text(encoding="utf-8") for p in sorted(_CORPUS.glob("*.md"))]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_tokenizer_matches_legacy(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(2500):
+        text = _random_text(rng, _INLINE_ATOMS, 40)
+        expected = legacy_markdown.markdown_to_telegram_html(text)
+        html = markdown_to_telegram_html(text)
+        if _MARKUP_IN_HREF_RE.search(expected) or _MARKUP_IN_HREF_RE.search(html):
+            continue
+        assert html == expected, repr(text)
+
+
+def test_code_is_not_formatted() -> None:
+    html = markdown_to_telegram_html("`__init__` и\n```py\n# коммент **x**\n```")
+    assert html == "<code>__init__</code> и\n<pre># коммент **x**\n</pre>"
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_render_markdown_flag_matches_contains_rich_markup(seed: int) -> None:
+    rng = random.Random(seed)
+    texts = [_random_text(rng, _RICH_ATOMS, 60) for _ in range(2500)]
+    for text in texts + _corpus_texts():
+        html, rich = render_markdown(text)
+        assert html == markdown_to_telegram_html(text), repr(text)
+        assert rich == legacy_markdown.contains_rich_markup(text), repr(text)
+        assert rich == contains_rich_markup(text), repr(text)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_streaming_matches_full_render(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(1000):
+        text = _random_text(rng, _STREAM_ATOMS, 120)
+        renderer = StreamingMarkdownRenderer()
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 8)
+            renderer.feed(text[pos:pos + step])
+            pos += step
+            assert renderer.text == text[:pos]
+            # Пока ```-блок открыт, превью показывает его как <pre> — это
+            # сознательное отличие от полного рендера, где ``` ещё текст
+            if rng.random() < 0.5:
+                html = renderer.render()
+                if renderer._open is None:
+                    assert html == markdown_to_telegram_html(text[:pos]), repr(text[:pos])
+        assert renderer.finish() == markdown_to_telegram_html(text), repr(text)
+
+
+@pytest.mark.parametrize("text", _corpus_texts(), ids=[p.stem for p in sorted(_CORPUS.glob("*.md"))])
+def test_streaming_corpus(text: str) -> None:
+    renderer = StreamingMarkdownRenderer()
+    for pos in range(0, len(text), 7):
+        renderer.feed(text[pos:pos + 7])
+        renderer.render()
+    assert renderer.finish() == markdown_to_telegram_html(text)
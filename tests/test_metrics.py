@@ -0,0 +1,48 @@
+"""Чтение пулов соединений в utils/metrics.py."""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+from utils.metrics import httpx_pool_usage
+
+
+class _Conn:
+    def __init__(self, idle: bool) -> None:
+        self._idle = idle
+
+    def is_idle(self) -> bool:
+        return self._idle
+
+
+def _transport(busy: int, idle: int, requests: int) -> SimpleNamespace:
+    connections = [_Conn(False)] * busy + [_Conn(True)] * idle
+    return SimpleNamespace(_pool=SimpleNamespace(connections=connections, _requests=[None] * requests))
+
+
+def test_httpx_pool_usage_sums_proxy_mounts() -> None:
+    # Как httpx.AsyncClient(proxy=...): трафик идёт через пул из _mounts
+    proxied = _transport(busy=3, idle=1, requests=5)
+    client = SimpleNamespace(
+        _transport=_transport(busy=0, idle=1, requests=0),
+        _mounts={"all://": proxied, "all://localhost": None},
+    )
+    assert httpx_pool_usage(client) == {"in_use": 3, "idle": 2, "queued": 2}
+
+
+def test_httpx_pool_usage_counts_shared_pool_once() -> None:
+    transport = _transport(busy=1, idle=0, requests=1)
+    client = SimpleNamespace(_transport=transport, _mounts={"all://": transport})
+    assert httpx_pool_usage(client) == {"in_use": 1, "idle": 0, "queued": 0}
+
+
+def test_httpx_pool_usage_unknown_client() -> None:
+    assert httpx_pool_usage(object()) is None
+
+
+@pytest.mark.parametrize("proxy", [None, "http://127.0.0.1:3128"])
+def test_httpx_pool_usage_real_client(proxy) -> None:
+    httpx = pytest.importorskip("httpx")
+    client = httpx.AsyncClient(proxy=proxy)
+    assert httpx_pool_usage(client) == {"in_use": 0, "idle": 0, "queued": 0}
@@ -0,0 +1,29 @@
+"""Ключ кэша ответов в utils/response_cache.py."""
+from __future__ import annotations
+
+from utils.response_cache import cache_key
+
+_CODE_A = "Исправь код:\nfor x in xs:\n    if x:\n        print(x)\n    print('done')\n"
+_CODE_B = "Исправь код:\nfor x in xs:\n    if x:\n        print(x)\n        print('done')\n"
+
+
+def _key(content: str) -> str:
+    return cache_key("system", "model", content)
+
+
+def test_indentation_changes_key() -> None:
+    assert _key(_CODE_A) != _key(_CODE_B)
+
+
+def test_line_structure_changes_key() -> None:
+    assert _key("- a\n- b") != _key("- a - b")
+    assert _key("| a | b |\n| c | d |") != _key("| a | b | | c | d |")
+
+
+def test_trailing_whitespace_and_blank_edges_ignored() -> None:
+    assert _key("\n\n" + _CODE_A.replace("\n", "  \r\n") + "\n\n") == _key(_CODE_A)
+
+
+def test_prompt_and_model_change_key() -> None:
+    assert cache_key("other", "model", "q") != _key("q")
+    assert cache_key("system", "other", "q") != _key("q")
@@ -0,0 +1,79 @@
+"""Закрытие спекулятивного стрима в handlers/text_file_audio._analyze_speculatively."""
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from handlers import text_file_audio as handler
+
+
+class _Stream:
+    def __init__(self) -> None:
+        self.closed = False
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class _Analyzer:
+    def __init__(self, analyze) -> None:
+        self.analyze = analyze
+
+    def guess_intent(self, content: str) -> bool:
+        return False
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    streams: list[_Stream] = []
+
+    async def _open_stream(user_id: int, content: str, wants_code: bool) -> _Stream:
+        streams.append(_Stream())
+        return streams[-1]
+
+    monkeypatch.setattr(handler, "_open_stream", _open_stream)
+    return streams
+
+
+def test_cancel_during_analysis_closes_opened_stream(monkeypatch, opened) -> None:
+    async def analyze(content: str):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(handler, "analyzer", _Analyzer(analyze))
+
+    async def scenario() -> None:
+        task = asyncio.create_task(handler._analyze_speculatively(1, "привет"))
+        # Основная модель ответила раньше Groq — стрим уже открыт
+        while not opened:
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert [s.closed for s in opened] == [True]
+
+
+def test_analysis_error_closes_opened_stream(monkeypatch, opened) -> None:
+    async def analyze(content: str):
+        while not opened:
+            await asyncio.sleep(0)
+        raise RuntimeError("groq down")
+
+    monkeypatch.setattr(handler, "analyzer", _Analyzer(analyze))
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler._analyze_speculatively(1, "привет"))
+    assert [s.closed for s in opened] == [True]
+
+
+@pytest.mark.parametrize("intent, expected", [(False, [False]), (True, [True, False])])
+def test_speculation_hands_over_only_matching_stream(monkeypatch, opened, intent, expected) -> None:
+    async def analyze(content: str):
+        return intent, content
+
+    monkeypatch.setattr(handler, "analyzer", _Analyzer(analyze))
+    wants_code, stream = asyncio.run(handler._analyze_speculatively(1, "привет"))
+    assert wants_code is intent
+    assert stream is opened[-1]
+    assert [s.closed for s in opened] == expected
@@ -0,0 +1,86 @@
+"""safe_edit_reply_markup / safe_delete в utils/telegram_helpers.py идут через планировщик."""
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import DeleteMessage
+
+from utils import telegram_helpers
+
+
+class _Scheduler:
+    def __init__(self, superseded: bool = False) -> None:
+        self.acquired: list[tuple[int, object]] = []
+        self.retry_after: list[int] = []
+        self.superseded = superseded
+
+    async def acquire(self, chat_id: int, *, edit_key=None) -> bool:
+        self.acquired.append((chat_id, edit_key))
+        return not self.superseded
+
+    async def report_retry_after(self, chat_id: int, seconds: int) -> None:
+        self.retry_after.append(seconds)
+
+
+class _Message:
+    def __init__(self, *errors: Exception) -> None:
+        self.chat = SimpleNamespace(id=7)
+        self.message_id = 42
+        self.calls: list[str] = []
+        self._errors = list(errors)
+
+    async def _call(self, name: str) -> bool:
+        self.calls.append(name)
+        if self._errors:
+            raise self._errors.pop(0)
+        return True
+
+    async def edit_reply_markup(self, reply_markup=None) -> bool:
+        return await self._call(f"markup:{reply_markup}")
+
+    async def delete(self) -> bool:
+        return await self._call("delete")
+
+
+def _retry_after(seconds: int) -> TelegramRetryAfter:
+    return TelegramRetryAfter(DeleteMessage(chat_id=7, message_id=42), "flood", seconds)
+
+
+def _bad_request(text: str) -> TelegramBadRequest:
+    return TelegramBadRequest(DeleteMessage(chat_id=7, message_id=42), text)
+
+
+@pytest.fixture
+def scheduler(monkeypatch) -> _Scheduler:
+    scheduler = _Scheduler()
+    monkeypatch.setattr(telegram_helpers, "tg_scheduler", scheduler)
+    return scheduler
+
+
+def test_reply_markup_acquires_message_edit_key_and_retries_429(scheduler) -> None:
+    message = _Message(_retry_after(3))
+    assert asyncio.run(telegram_helpers.safe_edit_reply_markup(message)) is True
+    assert message.calls == ["markup:None", "markup:None"]
+    assert scheduler.acquired == [(7, (7, 42))] * 2
+    assert scheduler.retry_after == [3]
+
+
+def test_reply_markup_not_modified_is_success(scheduler) -> None:
+    message = _Message(_bad_request("Bad Request: message is not modified"))
+    assert asyncio.run(telegram_helpers.safe_edit_reply_markup(message)) is True
+
+
+def test_delete_bad_request_returns_false(scheduler) -> None:
+    message = _Message(_bad_request("Bad Request: message to delete not found"))
+    assert asyncio.run(telegram_helpers.safe_delete(message)) is False
+    assert scheduler.acquired == [(7, (7, 42))]
+
+
+def test_superseded_call_is_not_sent(monkeypatch) -> None:
+    monkeypatch.setattr(telegram_helpers, "tg_scheduler", _Scheduler(superseded=True))
+    message = _Message()
+    assert asyncio.run(telegram_helpers.safe_delete(message)) is True
+    assert message.calls == []
@@ -0,0 +1,75 @@
+"""Хвостовое сэмплирование в utils/tracing.py."""
+from __future__ import annotations
+
+import asyncio
+import json
+from contextlib import suppress
+
+import pytest
+
+from utils import tracing
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    spans: list[dict] = []
+    monkeypatch.setattr(tracing, "_exporter", None)
+    monkeypatch.setattr(tracing.span_logger, "isEnabledFor", lambda level: True)
+    monkeypatch.setattr(tracing.span_logger, "info", lambda msg: spans.append(json.loads(msg)))
+    tracing.configure(sample_rate=0.0, slow_ms=1000)
+    yield spans
+    tracing.configure(sample_rate=0.0, slow_ms=float("inf"))
+
+
+def test_unsampled_healthy_trace_is_dropped(emitted) -> None:
+    with tracing.start_trace("update"):
+        with tracing.span("a"):
+            pass
+        with tracing.span("b"):
+            pass
+    assert emitted == []
+
+
+def test_failed_child_keeps_whole_trace(emitted) -> None:
+    with tracing.start_trace("update"):
+        with tracing.span("ok"):
+            pass
+        with pytest.raises(RuntimeError):
+            with tracing.span("boom"):
+                raise RuntimeError("x")
+        # Ещё не вывелось: решение принимается на закрытии корня
+        assert emitted == []
+    assert [s["name"] for s in emitted] == ["ok", "boom", "update"]
+    assert len({s["trace_id"] for s in emitted}) == 1
+
+
+def test_sampled_trace_is_emitted(emitted) -> None:
+    tracing.configure(sample_rate=1.0, slow_ms=1000)
+    with tracing.start_trace("update"):
+        with tracing.span("a"):
+            pass
+    assert [s["name"] for s in emitted] == ["a", "update"]
+
+
+def test_late_span_follows_decision(emitted) -> None:
+    async def background(fail: bool) -> None:
+        await asyncio.sleep(0)
+        with tracing.span("background"):
+            if fail:
+                raise ValueError("late failure")
+
+    async def update(fail: bool) -> asyncio.Task:
+        # Как schedule_summary: задача копирует контекст и переживает корень
+        with tracing.start_trace("update"):
+            task = asyncio.create_task(background(fail))
+        return task
+
+    async def run(fail: bool) -> None:
+        task = await update(fail)
+        with suppress(ValueError):
+            await task
+
+    asyncio.run(run(fail=False))
+    assert emitted == []
+    asyncio.run(run(fail=True))
+    assert [s["name"] for s in emitted] == ["background"]
@@ -0,0 +1,190 @@
+"""
+Admission control: ограничение одновременной работы на каждый upstream.
+
+Раньше число задач _do_processing ничем не ограничивалось: во всплеске
+сотни стримов разом тянули соединения из http_client_main
+(max_connections=100, pool=10.0), и те, кому не хватило, падали с
+PoolTimeout — вместо того чтобы дождаться своей очереди. Чем больше
+всплеск, тем больше запросов заканчивалось ошибкой.
+
+Теперь перед обращением к upstream'у запрос берёт слот:
+
+    async with admission.slot("main", on_queue=show_position):
+        stream = await _open_stream(...)
+        ...
+
+- у каждого upstream'а (main — основная модель, groq — анализатор и
+  пересказ, whisper — транскрипция) свой лимит одновременных запросов,
+  меньше пула httpx — до PoolTimeout дело не доходит;
+- сверх лимита запрос встаёт в очередь FIFO; освободившийся слот
+  передаётся первому ждущему напрямую — никто не проскочит вперёд;
+- пока запрос ждёт, раз в ADMISSION_POSITION_INTERVAL вызывается
+  on_queue(позиция) — хендлер показывает её в loader'е;
+- очередь ограничена: если она полна (или запрос прождал
+  ADMISSION_MAX_WAIT), поднимается Overloaded — хендлер сразу отвечает
+  «перегружен», а не держит пользователя минутами.
+
+Отмена ждущего (кнопка [Отменить]) просто убирает его из очереди.
+
+Слоты in-memory, на процесс — как и bucket'ы tg_scheduler: каждая реплика
+защищает свой собственный пул соединений.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Awaitable, Callable, Optional
+
+from config.config import (
+    ADMISSION_GROQ_CONCURRENCY,
+    ADMISSION_GROQ_QUEUE,
+    ADMISSION_MAIN_CONCURRENCY,
+    ADMISSION_MAIN_QUEUE,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_POSITION_INTERVAL,
+    ADMISSION_WHISPER_CONCURRENCY,
+    ADMISSION_WHISPER_QUEUE,
+)
+from utils.logging_helpers import log_event, log_timing
+
+logger = logging.getLogger(__name__)
+
+OnQueue = Callable[[int], Awaitable[None]]
+
+
+class Overloaded(Exception):
+    """Очередь upstream'а полна или ожидание затянулось — запрос не принят."""
+
+    def __init__(self, upstream: str, reason: str) -> None:
+        super().__init__(f"{upstream} overloaded ({reason})")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class Upstream:
+    """Слоты одного upstream'а и очередь ожидающих."""
+
+    def __init__(self, name: str, limit: int, queue_max: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.queue_max = queue_max
+        self.active = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.shed = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, on_queue: Optional[OnQueue] = None) -> None:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.queue_max:
+            self._shed("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued_total += 1
+        start = time.monotonic()
+        notify: Optional[asyncio.Task] = None
+        shown = 0
+        try:
+            async with log_timing("admission.wait", upstream=self.name, position=len(self._waiters)):
+                while not waiter.done():
+                    if on_queue is not None:
+                        position = self._waiters.index(waiter) + 1
+                        # Показ позиции не должен задерживать сам запрос: edit
+                        # идёт фоном, следующий — когда закончится предыдущий
+                        if position != shown and (notify is None or notify.done()):
+                            shown = position
+                            notify = asyncio.create_task(on_queue(position))
+                    left = start + ADMISSION_MAX_WAIT - time.monotonic()
+                    if left <= 0:
+                        self._shed("timeout")
+                    with suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(
+                            asyncio.shield(waiter), min(left, ADMISSION_POSITION_INTERVAL)
+                        )
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам, а мы уходим — отдаём его следующему
+                self.release()
+            else:
+                waiter.cancel()
+                with suppress(ValueError):
+                    self._waiters.remove(waiter)
+            raise
+        finally:
+            if notify is not None and not notify.done():
+                notify.cancel()
+
+        self.admitted += 1
+        log_event(
+            "admission.admitted",
+            upstream=self.name,
+            waited_ms=int((time.monotonic() - start) * 1000),
+            queued=len(self._waiters),
+        )
+
+    def release(self) -> None:
+        # Слот переходит первому живому ожидающему, active не меняется
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _shed(self, reason: str) -> None:
+        self.shed += 1
+        log_event(
+            "admission.shed",
+            upstream=self.name,
+            reason=reason,
+            active=self.active,
+            queued=len(self._waiters),
+        )
+        raise Overloaded(self.name, reason)
+
+
+class AdmissionController:
+    """Реестр upstream'ов: admission.slot("main" | "groq" | "whisper")."""
+
+    def __init__(self, upstreams: list[Upstream]) -> None:
+        self.upstreams = {u.name: u for u in upstreams}
+
+    @asynccontextmanager
+    async def slot(self, name: str, on_queue: Optional[OnQueue] = None):
+        upstream = self.upstreams[name]
+        await upstream.acquire(on_queue)
+        try:
+            yield
+        finally:
+            upstream.release()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            name: {
+                "limit": u.limit,
+                "active": u.active,
+                "queued": u.queued,
+                "admitted": u.admitted,
+                "queued_total": u.queued_total,
+                "shed": u.shed,
+            }
+            for name, u in self.upstreams.items()
+        }
+
+
+admission = AdmissionController([
+    Upstream("main", ADMISSION_MAIN_CONCURRENCY, ADMISSION_MAIN_QUEUE),
+    Upstream("groq", ADMISSION_GROQ_CONCURRENCY, ADMISSION_GROQ_QUEUE),
+    Upstream("whisper", ADMISSION_WHISPER_CONCURRENCY, ADMISSION_WHISPER_QUEUE),
+])
@@ -12,17 +12,45 @@
 4. Хендлер задачи ловит CancelledError и редактирует loader в «Отменено».
 5. add_done_callback автоматом удаляет запись из реестра.
 
-Реестр in-memory, не Redis — задачи живут только в этом процессе, нет смысла
-синхронизировать. Если процесс упадёт, все запросы умрут вместе с ним.
+Сама задача живёт только в своём процессе, но реплик несколько, и
+callback с кнопки может прийти не на ту, что ведёт запрос. Поэтому:
+
+- register_task() пишет в Redis владельца: cancel:v1:{chat}:{msg} → id
+  реплики (TTL CANCEL_OWNER_TTL); по завершении значение меняется на
+  метку «завершён» (TTL CANCEL_DONE_TTL);
+- cancel_task() сначала смотрит локальный реестр, затем владельца в Redis
+  и, если это другая реплика, публикует запрос в её канал
+  cancel:v1:replica:{id} и ждёт ответ (BLPOP на одноразовом ключе);
+- каждая реплика слушает свой канал (cancel_bus, старт в main.on_startup),
+  отменяет задачу локально и отвечает.
+
+Результат — CANCELLED, FINISHED или UNKNOWN: хендлер отличает «отменяем»
+от «уже завершён» и от «не знаем такого запроса». Реплика-владелец умерла
+(в канале никто не слушает) — её задачи умерли вместе с ней, это FINISHED.
+
+Redis недоступен — отмена работает как раньше, только в пределах процесса.
 """
 from __future__ import annotations
 
 import asyncio
+import json
 import logging
+import os
+import secrets
+import socket
 from typing import Optional, Tuple
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
+from config.config import (
+    CANCEL_DONE_TTL,
+    CANCEL_OWNER_TTL,
+    CANCEL_REPLY_TIMEOUT,
+    REPLICA_ID,
+    redis,
+)
+from utils.logging_helpers import log_event
+
 logger = logging.getLogger(__name__)
 
 # (chat_id, message_id) → asyncio.Task
@@ -30,6 +58,27 @@ _active_tasks: dict[Tuple[int, int], asyncio.Task] = {}
 
 CANCEL_CB_PREFIX = "cancel:"
 
+# Результаты cancel_task()
+CANCELLED = "cancelled"  # задача была в работе, cancel() отправлен
+FINISHED = "finished"  # задача уже завершилась (или умерла с репликой)
+UNKNOWN = "unknown"  # о таком запросе ничего не знаем / владелец не ответил
+
+_PREFIX = "cancel:v1:"
+_DONE = b"-"
+
+replica_id = REPLICA_ID or f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+# Фоновые записи в Redis из done-callback'ов — держим ссылки до завершения
+_pending: set[asyncio.Task] = set()
+
+
+def _owner_key(chat_id: int, message_id: int) -> str:
+    return f"{_PREFIX}{chat_id}:{message_id}"
+
+
+def _channel(replica: str) -> str:
+    return f"{_PREFIX}replica:{replica}"
+
 
 def make_cancel_keyboard(chat_id: int, message_id: int) -> InlineKeyboardMarkup:
     """Inline-кнопка под сообщением бота для отмены текущего запроса."""
@@ -43,13 +92,26 @@ def make_cancel_keyboard(chat_id: int, message_id: int) -> InlineKeyboardMarkup:
     )
 
 
-def register_task(chat_id: int, message_id: int, task: asyncio.Task) -> None:
-    """Регистрирует задачу. По её завершении автоматически удалится из реестра."""
+async def _mark_done(chat_id: int, message_id: int) -> None:
+    try:
+        await redis.set(_owner_key(chat_id, message_id), _DONE, ex=CANCEL_DONE_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to mark task done ({chat_id}, {message_id}): {e}")
+
+
+async def register_task(chat_id: int, message_id: int, task: asyncio.Task) -> None:
+    """
+    Регистрирует задачу локально и владельцем в Redis. По её завершении
+    запись удалится из реестра, а в Redis останется метка «завершён».
+    """
     key = (chat_id, message_id)
     _active_tasks[key] = task
 
     def _cleanup(_t: asyncio.Task) -> None:
         _active_tasks.pop(key, None)
+        pending = asyncio.ensure_future(_mark_done(chat_id, message_id))
+        _pending.add(pending)
+        pending.add_done_callback(_pending.discard)
         logger.debug(
             f"Task removed from registry: ({chat_id}, {message_id}); "
             f"active total: {len(_active_tasks)}"
@@ -59,24 +121,133 @@ def register_task(chat_id: int, message_id: int, task: asyncio.Task) -> None:
     logger.debug(
         f"Task registered: ({chat_id}, {message_id}); active total: {len(_active_tasks)}"
     )
+    if task.done():
+        return
+    try:
+        # NX: задача могла завершиться, пока шёл этот SET, и _mark_done
+        # (отдельная задача, другое соединение пула) уже записал метку —
+        # владелец не должен её затереть. (chat, msg) не переиспользуются,
+        # так что чужого ключа здесь быть не может.
+        await redis.set(
+            _owner_key(chat_id, message_id), replica_id, ex=CANCEL_OWNER_TTL, nx=True
+        )
+    except Exception as e:
+        logger.warning(f"Failed to register task owner ({chat_id}, {message_id}): {e}")
 
 
-def cancel_task(chat_id: int, message_id: int) -> bool:
-    """
-    Отменяет задачу. Возвращает True если задача была активна и реально
-    cancel(), False если задачи уже нет (завершилась или не существовала).
-    """
-    key = (chat_id, message_id)
-    task = _active_tasks.get(key)
+def _cancel_local(chat_id: int, message_id: int) -> Optional[str]:
+    """CANCELLED / FINISHED, если задача в локальном реестре; None — её здесь нет."""
+    task = _active_tasks.get((chat_id, message_id))
     if task is None:
-        logger.debug(f"cancel_task: no active task for ({chat_id}, {message_id})")
-        return False
+        return None
     if task.done():
         logger.debug(f"cancel_task: task already done for ({chat_id}, {message_id})")
-        return False
+        return FINISHED
     task.cancel()
     logger.info(f"Task cancelled by user for ({chat_id}, {message_id})")
-    return True
+    return CANCELLED
+
+
+async def _cancel_remote(owner: str, chat_id: int, message_id: int) -> str:
+    reply_key = f"{_PREFIX}reply:{secrets.token_hex(8)}"
+    request = json.dumps({"chat": chat_id, "msg": message_id, "reply": reply_key})
+    receivers = await redis.publish(_channel(owner), request)
+    if not receivers:
+        # Канал никто не слушает — реплика умерла, а с ней и задача
+        await redis.delete(_owner_key(chat_id, message_id))
+        log_event("cancel.owner_gone", owner=owner, chat=chat_id, message=message_id)
+        return FINISHED
+    reply = await redis.blpop([reply_key], timeout=CANCEL_REPLY_TIMEOUT)
+    if reply is None:
+        log_event("cancel.owner_timeout", owner=owner, chat=chat_id, message=message_id)
+        return UNKNOWN
+    result = reply[1].decode()
+    log_event("cancel.remote", owner=owner, chat=chat_id, message=message_id, result=result)
+    return result
+
+
+async def cancel_task(chat_id: int, message_id: int) -> str:
+    """
+    Отменяет задачу, где бы она ни выполнялась. Возвращает CANCELLED,
+    FINISHED или UNKNOWN (см. константы выше).
+    """
+    local = _cancel_local(chat_id, message_id)
+    if local is not None:
+        return local
+
+    try:
+        owner = await redis.get(_owner_key(chat_id, message_id))
+        if owner is None:
+            logger.debug(f"cancel_task: no owner for ({chat_id}, {message_id})")
+            return UNKNOWN
+        if owner == _DONE or owner.decode() == replica_id:
+            # Наша задача, но в реестре её уже нет — завершилась, метка ещё в пути
+            return FINISHED
+        return await _cancel_remote(owner.decode(), chat_id, message_id)
+    except Exception as e:
+        logger.warning(f"cancel_task: redis lookup failed for ({chat_id}, {message_id}): {e}")
+        return UNKNOWN
+
+
+class CancelBus:
+    """Подписка на канал этой реплики: отменяет задачи по запросам других."""
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="cancel-bus")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        channel = _channel(replica_id)
+        while True:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(channel)
+                logger.info(f"Cancel bus listening on {channel}")
+                async for message in pubsub.listen():
+                    await self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Переподключаемся: пока нас нет, чужие отмены получат UNKNOWN / FINISHED
+                logger.warning(f"Cancel bus error, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def _handle(self, data: bytes) -> None:
+        try:
+            request = json.loads(data)
+            chat_id, message_id = int(request["chat"]), int(request["msg"])
+            reply_key = request["reply"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Cancel bus: malformed request {data!r}")
+            return
+        result = _cancel_local(chat_id, message_id) or FINISHED
+        log_event("cancel.bus_request", chat=chat_id, message=message_id, result=result)
+        try:
+            await redis.rpush(reply_key, result)
+            await redis.expire(reply_key, CANCEL_REPLY_TIMEOUT * 5)
+        except Exception as e:
+            logger.warning(f"Cancel bus: reply failed for ({chat_id}, {message_id}): {e}")
+
+
+cancel_bus = CancelBus()
 
 
 def parse_cancel_data(data: str) -> Optional[Tuple[int, int]]:
@@ -0,0 +1,247 @@
+"""
+Компактный формат записей контекста диалога в Redis (user:{id}:context).
+
+Раньше каждая пара «вопрос → ответ» лежала как json.dumps-текст, и
+get_context на каждом запросе делал json.loads на всех записях. Ответы
+с кодом раздувают списки, и память Redis растёт вместе с активными
+пользователями.
+
+Формат записи — первый байт задаёт версию:
+
+    0x01 + msgpack([question, answer, tokens])                  — короткие записи
+    0x02 + zstd(msgpack([question, answer, tokens]), словарь)   — всё остальное
+
+tokens — сколько токенов занимает пара (для бюджета контекста), его
+может не быть; лишние поля в конце массива декодер игнорирует.
+
+Словарь zstd обучается на нашем же трафике (записи короткие, без словаря
+сжатие почти ничего не даёт); его id записан в заголовке zstd-фрейма.
+Запись, сжатая со словарём, которого у процесса нет (словарь сменили),
+не декодируется и пропускается — контекст живёт сутки, так что при смене
+словаря теряется только контекст разговоров, идущих во время выкатки.
+
+Старые JSON-записи (начинаются с "{") читаются как раньше — миграция
+происходит сама по мере того, как пишутся новые записи и истекают старые.
+
+Модуль без зависимостей от config — словарь и бенчмарк работают офлайн
+(кроме export, которому нужен Redis):
+
+    python -m utils.context_codec export contexts.jsonl [--dict data/context.zdict]
+    python -m utils.context_codec train-dict contexts.jsonl --out data/context.zdict
+    python -m utils.context_codec bench contexts.jsonl --dict data/context.zdict
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+import msgpack
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+_RAW = 0x01
+_ZSTD = 0x02
+_JSON_START = ord("{")
+
+# Меньше этого zstd-фрейм (заголовок + блок) не окупается даже со словарём
+_COMPRESS_MIN_BYTES = 64
+
+
+class ContextCodec:
+    """Кодирует/декодирует записи контекста. dict_data=None — zstd без словаря."""
+
+    def __init__(self, dict_data: Optional[bytes] = None, level: int = 3) -> None:
+        self.dict = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+        self.dict_id = self.dict.dict_id() if self.dict else 0
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=self.dict)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=self.dict)
+
+    @classmethod
+    def load(cls, path: str, level: int = 3) -> ContextCodec:
+        """Словарь из файла; нет файла — кодек без словаря, всё равно рабочий."""
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    codec = cls(f.read(), level)
+                logger.info(f"Context zstd dictionary loaded: {path} (id={codec.dict_id})")
+                return codec
+            except (OSError, zstandard.ZstdError) as e:
+                logger.warning(f"Failed to load context dictionary {path}: {e}")
+        return cls(None, level)
+
+    def encode(self, question: str, answer: str, tokens: Optional[int] = None) -> bytes:
+        fields = [question, answer] if tokens is None else [question, answer, tokens]
+        packed = msgpack.packb(fields)
+        if len(packed) >= _COMPRESS_MIN_BYTES:
+            compressed = self._compressor.compress(packed)
+            if len(compressed) < len(packed):
+                return bytes((_ZSTD,)) + compressed
+        return bytes((_RAW,)) + packed
+
+    def decode(self, raw: bytes) -> Optional[dict]:
+        """{"question", "answer", "tokens"} или None, если запись битая или не читается."""
+        if not raw:
+            return None
+        kind = raw[0]
+        try:
+            if kind == _ZSTD:
+                question, answer, *rest = msgpack.unpackb(self._decompressor.decompress(raw[1:]))
+            elif kind == _RAW:
+                question, answer, *rest = msgpack.unpackb(raw[1:])
+            elif kind == _JSON_START:
+                # Запись старого формата
+                ctx = json.loads(raw.decode("utf-8"))
+                question, answer, rest = ctx.get("question"), ctx.get("answer"), []
+            else:
+                raise ValueError(f"unknown context format 0x{kind:02x}")
+        except (zstandard.ZstdError, ValueError, TypeError, UnicodeDecodeError) as e:
+            # msgpack.UnpackException и json.JSONDecodeError — наследники ValueError
+            logger.warning(f"Failed to decode context entry: {e}")
+            return None
+        tokens = rest[0] if rest and isinstance(rest[0], int) else None
+        return {"question": question, "answer": answer, "tokens": tokens}
+
+
+def train_dictionary(samples: Iterable[tuple[str, str]], size: int = 64 * 1024) -> bytes:
+    """Словарь zstd по msgpack-представлению пар — ровно тому, что потом сжимается."""
+    packed = [msgpack.packb([q, a]) for q, a in samples]
+    return zstandard.train_dictionary(size, packed).as_bytes()
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Выгрузка, обучение словаря, бенчмарк
+# ────────────────────────────────────────────────────────────────────────────
+def load_contexts(path: str) -> list[list[tuple[str, str]]]:
+    """JSONL из export: {"user": id, "turns": [{"question", "answer"}, ...]} на строку."""
+    users: list[list[tuple[str, str]]] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            turns = [
+                (t["question"], t["answer"])
+                for t in row.get("turns", [])
+                if isinstance(t.get("question"), str) and isinstance(t.get("answer"), str)
+            ]
+            if turns:
+                users.append(turns)
+    return users
+
+
+def bench(codec: ContextCodec, users: list[list[tuple[str, str]]], rounds: int = 5) -> dict:
+    """
+    Байты на пользователя и время декодирования его списка (как в get_context):
+    json — старый формат, v1 — текущий кодек. Время — в микросекундах, лучшее из rounds.
+    """
+    legacy = [
+        [json.dumps({"question": q, "answer": a}, ensure_ascii=False).encode("utf-8") for q, a in turns]
+        for turns in users
+    ]
+    encoded = [[codec.encode(q, a) for q, a in turns] for turns in users]
+
+    def _decode_times(lists: list[list[bytes]], decode) -> list[float]:
+        best = [float("inf")] * len(lists)
+        for _ in range(rounds):
+            for i, entries in enumerate(lists):
+                start = time.perf_counter()
+                for raw in entries:
+                    decode(raw)
+                best[i] = min(best[i], (time.perf_counter() - start) * 1e6)
+        return sorted(best)
+
+    def _legacy_decode(raw: bytes) -> dict:
+        return json.loads(raw.decode("utf-8"))
+
+    json_bytes = sorted(sum(map(len, entries)) for entries in legacy)
+    v1_bytes = sorted(sum(map(len, entries)) for entries in encoded)
+    json_us = _decode_times(legacy, _legacy_decode)
+    v1_us = _decode_times(encoded, codec.decode)
+    n = len(users)
+
+    def _pct(values: list, q: float):
+        return values[min(n - 1, int(n * q))]
+
+    return {
+        "users": n,
+        "entries": sum(map(len, users)),
+        "dict_id": codec.dict_id,
+        "json_bytes_per_user_avg": sum(json_bytes) / n,
+        "v1_bytes_per_user_avg": sum(v1_bytes) / n,
+        "ratio": sum(v1_bytes) / sum(json_bytes),
+        "json_decode_us_p50": _pct(json_us, 0.5),
+        "json_decode_us_p99": _pct(json_us, 0.99),
+        "v1_decode_us_p50": _pct(v1_us, 0.5),
+        "v1_decode_us_p99": _pct(v1_us, 0.99),
+    }
+
+
+async def _export(path: str, limit: int, dict_path: Optional[str] = None) -> int:
+    # только здесь: train-dict/bench работают без .env
+    from config.config import CONTEXT_DICT_PATH, redis
+
+    # Тот же словарь, что у бота: без него все сжатые (v2) записи пропустятся,
+    # и повторное обучение увидит только короткие реплики
+    codec = ContextCodec.load(dict_path or CONTEXT_DICT_PATH)
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        async for key in redis.scan_iter(match="user:*:context", count=1000):
+            turns = [ctx for ctx in map(codec.decode, await redis.lrange(key, 0, -1)) if ctx]
+            if turns:
+                user = key.decode().split(":")[1]
+                f.write(json.dumps({"user": user, "turns": turns}, ensure_ascii=False) + "\n")
+                count += 1
+                if count >= limit:
+                    break
+    await redis.aclose()
+    return count
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m utils.context_codec")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="выгрузить контексты пользователей из Redis в JSONL")
+    p_export.add_argument("out")
+    p_export.add_argument("--limit", type=int, default=20_000)
+    p_export.add_argument("--dict", default=None, help="по умолчанию CONTEXT_DICT_PATH")
+
+    p_train = sub.add_parser("train-dict", help="обучить zstd-словарь на выгруженных контекстах")
+    p_train.add_argument("contexts")
+    p_train.add_argument("--out", default="data/context.zdict")
+    p_train.add_argument("--size", type=int, default=64 * 1024)
+
+    p_bench = sub.add_parser("bench", help="байты на пользователя и время декодирования: JSON vs v1")
+    p_bench.add_argument("contexts")
+    p_bench.add_argument("--dict", default="data/context.zdict")
+    p_bench.add_argument("--level", type=int, default=3)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        count = asyncio.run(_export(args.out, args.limit, args.dict))
+        print(f"exported {count} users → {args.out}")
+
+    elif args.command == "train-dict":
+        samples = [turn for turns in load_contexts(args.contexts) for turn in turns]
+        data = train_dictionary(samples, args.size)
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "wb") as f:
+            f.write(data)
+        print(f"trained on {len(samples)} entries, {len(data)} bytes → {args.out}")
+
+    else:
+        users = load_contexts(args.contexts)
+        if not users:
+            parser.error(f"no contexts in {args.contexts}")
+        print(json.dumps(bench(ContextCodec.load(args.dict, args.level), users), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Извлечение текста из документов в отдельном пуле процессов.
+
+pypdf и python-docx — чистый Python. В asyncio.to_thread парсинг
+300-страничного PDF держал GIL и тормозил event loop всем запросам
+воркера. К тому же текст извлекался целиком и только потом
+process_content отказывал по лимиту длины.
+
+Теперь:
+- парсинг идёт в ProcessPoolExecutor (DOCUMENT_POOL_WORKERS процессов);
+- страницы/абзацы читаются по одной, и как только токенов набралось больше
+  MAX_INPUT_TOKENS, чтение останавливается: остаток документа не парсится;
+- файл больше DOCUMENT_MAX_MB хендлер отклоняет ещё до скачивания (по
+  file_size из сообщения); число страниц Telegram не сообщает, поэтому
+  PDF длиннее DOCUMENT_MAX_PAGES отклоняется сразу после чтения
+  заголовка — до извлечения текста.
+
+Как и utils/images.py, модуль грузится в воркерах пула, поэтому config
+импортируется только внутри корутин основного процесса.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import TYPE_CHECKING, NamedTuple, Optional, Union
+
+from utils.logging_helpers import log_timing
+from utils.tokens import count_tokens, exceeds
+
+if TYPE_CHECKING:
+    # utils.media тянет config (бот, Redis) — воркерам пула он не нужен
+    from utils.media import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+# Байты документа (буфер в памяти) или путь к файлу (буфер сброшен на диск) —
+# путь в воркер передать дешевле, чем гонять мегабайты через pickle
+_Source = Union[bytes, str]
+
+
+class DocumentText(NamedTuple):
+    text: str
+    too_long: bool  # чтение остановлено: токенов больше лимита
+
+
+class DocumentTooLarge(ValueError):
+    """Документ отклонён по размеру или числу страниц — текст понятен пользователю."""
+
+
+def _open(source: _Source):
+    return BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+
+
+def _extract_pdf(source: _Source, token_limit: int, max_pages: int) -> DocumentText:
+    from pypdf import PdfReader
+
+    with _open(source) as f:
+        reader = PdfReader(f)
+        n_pages = len(reader.pages)
+        if n_pages > max_pages:
+            raise DocumentTooLarge(
+                f"В документе {n_pages} страниц — максимум {max_pages}."
+            )
+        parts: list[str] = []
+        tokens = 0
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            parts.append(text)
+            tokens += count_tokens(text)
+            if tokens > token_limit:
+                return DocumentText("\n".join(parts), True)
+    return DocumentText("\n".join(parts), False)
+
+
+def _extract_docx(source: _Source, token_limit: int, max_pages: int) -> DocumentText:
+    from docx import Document
+
+    with _open(source) as f:
+        doc = Document(f)
+        parts: list[str] = []
+        tokens = 0
+        for p in doc.paragraphs:
+            if not p.text:
+                continue
+            parts.append(p.text)
+            tokens += count_tokens(p.text)
+            if tokens > token_limit:
+                return DocumentText(" ".join(parts), True)
+    return DocumentText(" ".join(parts), False)
+
+
+def _extract_txt(source: _Source, token_limit: int, max_pages: int) -> DocumentText:
+    if isinstance(source, bytes):
+        text = source.decode("utf-8", errors="replace")
+    else:
+        with open(source, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    return DocumentText(text, exceeds(text, token_limit))
+
+
+_EXTRACTORS = {
+    ".pdf": _extract_pdf,
+    ".docx": _extract_docx,
+    ".txt": _extract_txt,
+}
+
+
+def extractor_for(filename: str) -> Optional[str]:
+    """Расширение, если формат поддерживается, иначе None."""
+    filename = filename.lower()
+    for ext in _EXTRACTORS:
+        if filename.endswith(ext):
+            return ext
+    return None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        from config.config import DOCUMENT_POOL_WORKERS
+
+        # Не fork: процесс с живым event loop и потоками (httpx, redis, OTLP)
+        # форкается вместе с захваченными ими локами, и воркер может зависнуть
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(
+            max_workers=DOCUMENT_POOL_WORKERS, mp_context=multiprocessing.get_context(method)
+        )
+    return _pool
+
+
+def _drop_broken_pool(pool: ProcessPoolExecutor) -> None:
+    """Снимает сломанный пул: следующий вызов создаст новый, остатки старого — гасим."""
+    global _pool
+    # Параллельный вызов мог уже заменить пул — новый не трогаем
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def extract_text(media: MediaBuffer, ext: str) -> DocumentText:
+    """
+    Текст документа, извлечённый в пуле процессов. DocumentTooLarge —
+    слишком много страниц; too_long=True — токенов больше MAX_INPUT_TOKENS.
+    """
+    from config.config import DOCUMENT_MAX_PAGES, MAX_INPUT_TOKENS
+
+    source: _Source = await media.read() if media.in_memory else str(media.path)
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    async with log_timing("document.extract", ext=ext, name=media.name, kb=media.size // 1024):
+        try:
+            return await loop.run_in_executor(
+                pool, _EXTRACTORS[ext], source, MAX_INPUT_TOKENS, DOCUMENT_MAX_PAGES
+            )
+        except BrokenProcessPool:
+            logger.error("Document pool is broken, recreating on next call")
+            _drop_broken_pool(pool)
+            raise
+
+
+def shutdown_document_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
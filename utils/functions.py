@@ -1,241 +1,169 @@
-"""Утилиты для работы с файлами, OpenAI и Markdown→HTML конвертацией."""
+"""Утилиты для работы с файлами, OpenAI и контекстом диалога."""
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
-import os
-import re
+import secrets
+from contextlib import suppress
 from datetime import datetime
-from html import escape
-from io import BytesIO
 
-import aiofiles
-from PIL import Image
-from pypdf import PdfReader
-from docx import Document
+from openai import BadRequestError
 
 from config.config import (
     redis,
     client,
+    groq_client,
     MAX_CONTEXT_MESSAGES,
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_SUMMARY_MAX_TOKENS,
+    SUMMARY_LOCK_TTL,
+    SUMMARY_MODEL,
+    SUMMARY_PROMPT,
     SYSTEM_PROMPT,
     CODE_GENERATION_PROMPT,
     MODEL_NAME,
-    MAX_IMAGE_SIZE_MB,
-    MAX_IMAGE_RESOLUTION_MP,
     MAX_OUTPUT_TOKENS_TEXT,
     MAX_OUTPUT_TOKENS_CODE,
+    FFMPEG_MAX_PROCS,
+    WHISPER_ACCEPTS_OGG,
+    CONTEXT_DICT_PATH,
+    CONTEXT_ZSTD_LEVEL,
 )
-from utils.logging_helpers import log_timing
+from utils.admission import admission
+from utils.context_codec import ContextCodec
+from utils.llm_pool import llm_pool
+from utils.logging_helpers import log_event, log_timing
+from utils.media import MediaBuffer
+from utils.response_cache import cached_stream
+from utils.tokens import count_tokens
 
 logger = logging.getLogger(__name__)
 
 
 # ────────────────────────────────────────────────────────────────────────────
-# Валидация изображений
+# Whisper / транскрипция голосовых
 # ────────────────────────────────────────────────────────────────────────────
-async def validate_image(image_path: str) -> tuple[bool, str]:
-    """Проверяет размер и разрешение. Не блокирует event loop."""
-    try:
-        file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
-        if file_size_mb > MAX_IMAGE_SIZE_MB:
-            return False, (
-                f"Размер изображения ({file_size_mb:.1f} MB) превышает "
-                f"максимальный ({MAX_IMAGE_SIZE_MB} MB)"
-            )
-
-        async with aiofiles.open(image_path, "rb") as f:
-            image_data = await f.read()
+# Ограничивает число одновременных ffmpeg — на пике голосовых они съедают все ядра
+_ffmpeg_slots = asyncio.Semaphore(FFMPEG_MAX_PROCS)
 
-        # PIL — синхронный, выносим в thread pool
-        def _check():
-            with Image.open(BytesIO(image_data)) as img:
-                w, h = img.size
-                return (w * h) / 1_000_000
-
-        megapixels = await asyncio.to_thread(_check)
-
-        if megapixels > MAX_IMAGE_RESOLUTION_MP:
-            return False, (
-                f"Разрешение изображения ({megapixels:.1f} MP) превышает "
-                f"максимальное ({MAX_IMAGE_RESOLUTION_MP} MP)"
-            )
 
-        return True, ""
-
-    except Exception as e:
-        logger.error(f"Ошибка валидации изображения {image_path}: {e}")
-        return False, f"Ошибка проверки изображения: {e}"
-
-
-# ────────────────────────────────────────────────────────────────────────────
-# Whisper / транскрипция голосовых
-# ────────────────────────────────────────────────────────────────────────────
-async def process_audio_with_whisper(telegram_id: int, file_path: str) -> str:
-    mp3_path = file_path.rsplit(".", 1)[0] + ".mp3"
-    try:
-        async with log_timing("ffmpeg.convert_to_mp3", path=file_path):
+async def _transcode_voice(voice_data: bytes) -> bytes:
+    """OGG/Opus → mono MP3 с низким битрейтом: ffmpeg stdin → stdout, без файлов."""
+    async with _ffmpeg_slots:
+        async with log_timing("ffmpeg.convert_to_mp3", in_kb=len(voice_data) // 1024):
             process = await asyncio.create_subprocess_exec(
-                "/usr/bin/ffmpeg", "-y", "-i", file_path, "-acodec", "mp3", mp3_path,
+                "/usr/bin/ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0",
+                "-ac", "1", "-b:a", "32k", "-f", "mp3", "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
             )
-            _, stderr = await process.communicate()
+            try:
+                audio_data, stderr = await process.communicate(voice_data)
+            except asyncio.CancelledError:
+                with suppress(ProcessLookupError):
+                    process.kill()
+                raise
             if process.returncode != 0:
                 raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')[:500]}")
-
-        async with aiofiles.open(mp3_path, "rb") as audio_file:
-            audio_data = await audio_file.read()
-
-        async with log_timing(
-            "openai.whisper.transcribe",
-            user=telegram_id,
-            audio_kb=len(audio_data) // 1024,
-        ):
-            transcription = await client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=("audio.mp3", audio_data, "audio/mp3"),
-                response_format="text",
-            )
-        return transcription if isinstance(transcription, str) else str(transcription)
-
-    finally:
-        if os.path.exists(mp3_path):
-            try:
-                os.remove(mp3_path)
-            except OSError:
-                pass
+    return audio_data
 
 
-# ────────────────────────────────────────────────────────────────────────────
-# Markdown → Telegram HTML
-# ────────────────────────────────────────────────────────────────────────────
-_ALLOWED_TAGS = {"b", "i", "u", "s", "code", "pre", "a", "blockquote"}
+async def _transcribe(telegram_id: int, file: tuple[str, bytes, str]) -> str:
+    async with admission.slot("whisper"), log_timing(
+        "openai.whisper.transcribe",
+        user=telegram_id,
+        audio_kb=len(file[1]) // 1024,
+        format=file[2],
+    ):
+        transcription = await client.audio.transcriptions.create(
+            model="gpt-4o-mini-transcribe",
+            file=file,
+            response_format="text",
+        )
+    return transcription if isinstance(transcription, str) else str(transcription)
 
 
-# ────────────────────────────────────────────────────────────────────────────
-# Rich Messages (Bot API 10.1, июнь 2026) — детект таблиц/формул
-# ────────────────────────────────────────────────────────────────────────────
-_MD_TABLE_ROW_RE = re.compile(r"^\s*\|.+\|\s*$", re.MULTILINE)
-_MD_TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)+\|?\s*$", re.MULTILINE)
-_LATEX_BLOCK_RE = re.compile(r"\$\$.+?\$\$", re.DOTALL)
-_LATEX_INLINE_RE = re.compile(r"(?<!\$)\$(?!\$)[^\n$]+?(?<!\$)\$(?!\$)")
-_LATEX_BRACKET_RE = re.compile(r"\\\[.+?\\\]|\\\(.+?\\\)", re.DOTALL)
+# Коды и фразы, которыми OpenAI/Groq отвечают на неподдерживаемый формат файла
+_UNSUPPORTED_FORMAT_CODES = frozenset(
+    {"invalid_file_format", "unsupported_file_format", "unsupported_format"}
+)
+_UNSUPPORTED_FORMAT_HINTS = (
+    "file format", "audio format", "unsupported format", "invalid format",
+    "file type", "must be one of", "could not be decoded", "could not decode",
+)
 
 
-def contains_rich_markup(text: str) -> bool:
-    """
-    True, если в тексте есть markdown-таблица или LaTeX-формула — такие ответы
-    стоит отправлять через sendRichMessage (Bot API 10.1), а не через
-    markdown_to_telegram_html, который таблицы/формулы не умеет рендерить.
-    """
-    if not text:
-        return False
-    if _MD_TABLE_SEP_RE.search(text) and _MD_TABLE_ROW_RE.search(text):
-        return True
-    if _LATEX_BLOCK_RE.search(text) or _LATEX_BRACKET_RE.search(text):
-        return True
-    if _LATEX_INLINE_RE.search(text):
+def _is_unsupported_format(e: BadRequestError) -> bool:
+    """400 именно из-за формата аудио, а не лимита длины, модели и т.п."""
+    if str(e.code or "").lower() in _UNSUPPORTED_FORMAT_CODES:
         return True
-    return False
+    message = (e.message or str(e)).lower()
+    return any(hint in message for hint in _UNSUPPORTED_FORMAT_HINTS)
 
 
-def markdown_to_telegram_html(text: str) -> str:
+async def process_audio_with_whisper(telegram_id: int, media: MediaBuffer) -> str:
     """
-    Конвертирует Markdown в безопасный для Telegram HTML.
-    Гарантирует, что все теги сбалансированы — ключевое для стриминга,
-    где отображаемый текст обрывается посреди тега.
+    Голосовое Telegram (OGG/Opus) → текст. Если эндпоинт принимает OGG
+    (WHISPER_ACCEPTS_OGG), байты уходят как есть — без ffmpeg вовсе.
+    Иначе, или если эндпоинт отверг именно формат, — перекодируем в MP3.
+    Любой другой 400 пробрасывается: MP3 его не исправит.
     """
-    text = escape(text)
-
-    # Горизонтальная линия
-    text = re.sub(r"^\s*---\s*$", "──────────────────", text, flags=re.MULTILINE)
-
-    # >>> цитата (после escape стало &gt;&gt;&gt;)
-    text = re.sub(
-        r"(^|\n)\s*&gt;&gt;&gt;\s*(.*?)(?=\n|$)",
-        r"\1<blockquote>\2</blockquote>",
-        text,
-        flags=re.MULTILINE,
-    )
+    voice_data = await media.read()
+    if WHISPER_ACCEPTS_OGG:
+        try:
+            return await _transcribe(telegram_id, ("voice.ogg", voice_data, "audio/ogg"))
+        except BadRequestError as e:
+            if not _is_unsupported_format(e):
+                raise
+            logger.warning(f"Transcription rejected OGG, falling back to ffmpeg: {e}")
 
-    # Заголовки # ## ### → <b>
-    text = re.sub(r"^(#+)\s*(.*?)\s*$", r"<b>\2</b>", text, flags=re.MULTILINE)
+    audio_data = await _transcode_voice(voice_data)
+    return await _transcribe(telegram_id, ("audio.mp3", audio_data, "audio/mpeg"))
 
-    # Жирный
-    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text, flags=re.DOTALL)
-    text = re.sub(r"__(.*?)__", r"<b>\1</b>", text, flags=re.DOTALL)
 
-    # Курсив (одиночные * и _, но не при двойных)
-    text = re.sub(r"(?<!\*)\*(?!\*)([^*\n]+?)\*(?!\*)", r"<i>\1</i>", text)
-    text = re.sub(r"(?<!_)_(?!_)([^_\n]+?)_(?!_)", r"<i>\1</i>", text)
+# ────────────────────────────────────────────────────────────────────────────
+# Контекст диалога в Redis
+# ────────────────────────────────────────────────────────────────────────────
+# Рядом со списком пар user:{id}:context лежит user:{id}:summary — сжатый
+# пересказ старых пар. В промпт идут пересказ и столько самых новых пар,
+# сколько влезает в CONTEXT_TOKEN_BUDGET; остальные после ответа фоновая
+# задача сворачивает в пересказ и удаляет из списка.
+_CONTEXT_TTL = 86400
+# Сколько символов каждой реплики показываем суммаризатору — код и
+# вставленные документы целиком ему не нужны
+_SUMMARY_TURN_CHARS = 4000
 
-    # Зачёркнутый
-    text = re.sub(r"~~(.*?)~~", r"<s>\1</s>", text, flags=re.DOTALL)
+_context_codec = ContextCodec.load(CONTEXT_DICT_PATH, CONTEXT_ZSTD_LEVEL)
+_summary_tasks: dict[int, asyncio.Task] = {}
 
-    # Ссылки
-    text = re.sub(r"\[(.*?)\]\((.*?)\)", r'<a href="\2">\1</a>', text)
+# Снимаем только свой лок: если TTL истёк и лок взяла другая реплика — не трогаем
+_UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_unlock_script = redis.register_script(_UNLOCK_LUA)
 
-    # Блок кода (тройные кавычки) — должен идти ДО однострочного `code`
-    text = re.sub(r"```(?:\w*\n)?(.*?)```", r"<pre>\1</pre>", text, flags=re.DOTALL)
 
-    # Однострочный код
-    text = re.sub(r"`([^`\n]+)`", r"<code>\1</code>", text)
+def _context_key(user_id: int) -> str:
+    return f"user:{user_id}:context"
 
-    # Очистим возможное вложение <b> вокруг <pre>/<blockquote>
-    text = re.sub(r"<b>(<pre>.*?</pre>)</b>", r"\1", text, flags=re.DOTALL)
-    text = re.sub(r"<b>(<blockquote>.*?</blockquote>)</b>", r"\1", text, flags=re.DOTALL)
 
-    return _validate_and_fix_html(text)
+def _summary_key(user_id: int) -> str:
+    return f"user:{user_id}:summary"
 
 
-def _validate_and_fix_html(html: str) -> str:
-    """
-    Балансирует теги: открытые без закрытия — закрывает, лишние закрывающие — выкидывает.
-    Это критично для стриминга, где сообщение обрывается посреди форматирования.
-    """
-    stack: list[str] = []
-    result: list[str] = []
-    parts = re.split(r"(</?[^>]+>)", html)
+def _summary_lock_key(user_id: int) -> str:
+    return f"user:{user_id}:summary:lock"
 
-    for part in parts:
-        if not part:
-            continue
 
-        if open_match := re.match(r"<(\w+)(?:\s[^>]*)?>$", part):
-            tag = open_match.group(1).lower()
-            if tag in _ALLOWED_TAGS:
-                stack.append(tag)
-                result.append(part)
-            # неизвестные теги — игнорируем (могут прийти из бредового вывода модели)
-
-        elif close_match := re.match(r"</(\w+)>$", part):
-            tag = close_match.group(1).lower()
-            if tag not in _ALLOWED_TAGS:
-                continue
-            if stack and stack[-1] == tag:
-                stack.pop()
-                result.append(part)
-            elif tag in stack:
-                # закрываем «через голову» — закрываем всё что выше по стеку
-                while stack and stack[-1] != tag:
-                    result.append(f"</{stack.pop()}>")
-                if stack:
-                    stack.pop()
-                    result.append(part)
-            # лишний закрывающий — игнор
-        else:
-            result.append(part)
-
-    while stack:
-        result.append(f"</{stack.pop()}>")
-    return "".join(result)
+def _pair_tokens(question: str, answer: str) -> int:
+    return count_tokens(question) + count_tokens(answer)
 
 
-# ────────────────────────────────────────────────────────────────────────────
-# Контекст диалога в Redis
-# ────────────────────────────────────────────────────────────────────────────
 async def save_context(user_id: int, question: str, answer: str) -> None:
     if not isinstance(question, str) or not question.strip():
         logger.warning(f"Invalid question for user {user_id}")
@@ -244,36 +172,195 @@ async def save_context(user_id: int, question: str, answer: str) -> None:
         logger.warning(f"Invalid answer for user {user_id}")
         return
 
-    entry = json.dumps({"question": question, "answer": answer}, ensure_ascii=False)
-    key = f"user:{user_id}:context"
+    # Ответ с кодом — десятки тысяч символов: токенизация не держит event loop
+    tokens = await asyncio.to_thread(_pair_tokens, question, answer)
+    entry = _context_codec.encode(question, answer, tokens)
+    key = _context_key(user_id)
 
-    # Atomic с pipeline — три команды в одном round-trip
+    # Atomic с pipeline — один round-trip. LTRIM — страховка: обычно старые
+    # пары уходят в пересказ раньше, чем упрутся в MAX_CONTEXT_MESSAGES
     async with redis.pipeline(transaction=False) as pipe:
         pipe.lpush(key, entry)
         pipe.ltrim(key, 0, MAX_CONTEXT_MESSAGES - 1)
-        pipe.expire(key, 86400)
+        pipe.expire(key, _CONTEXT_TTL)
+        pipe.expire(_summary_key(user_id), _CONTEXT_TTL)
         await pipe.execute()
 
     logger.debug(f"Context saved for user {user_id}")
+    schedule_summary(user_id)
+
+
+async def _read_history(user_id: int) -> tuple[list[tuple[bytes, dict]], str]:
+    """([(сырая запись, пара)] от новых к старым, пересказ) — за один round-trip."""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.lrange(_context_key(user_id), 0, -1)
+        pipe.get(_summary_key(user_id))
+        raw, summary = await pipe.execute()
+
+    valid: list[tuple[bytes, dict]] = []
+    for entry in raw or ():
+        # Новый формат и старые JSON-записи — см. utils/context_codec.py
+        ctx = _context_codec.decode(entry)
+        if ctx is None:
+            logger.warning(f"Skipping undecodable context entry for {user_id}")
+            continue
+        q, a = ctx["question"], ctx["answer"]
+        if isinstance(q, str) and q.strip() and isinstance(a, str) and a.strip():
+            if ctx["tokens"] is None:
+                ctx["tokens"] = count_tokens(q) + count_tokens(a)
+            valid.append((entry, ctx))
+
+    return valid, summary.decode("utf-8") if summary else ""
+
+
+def _fit_budget(history: list[tuple[bytes, dict]], budget: int) -> int:
+    """Сколько самых новых пар влезает в budget токенов."""
+    used = 0
+    for i, (_, ctx) in enumerate(history):
+        used += ctx["tokens"]
+        if used > budget:
+            return i
+    return len(history)
 
 
 async def get_context(user_id: int) -> list[dict]:
-    key = f"user:{user_id}:context"
-    raw = await redis.lrange(key, 0, -1)
-    if not raw:
-        return []
+    history, _ = await _read_history(user_id)
+    return [ctx for _, ctx in history]
 
-    valid: list[dict] = []
-    for entry in raw:
-        try:
-            ctx = json.loads(entry.decode("utf-8"))
-            q, a = ctx.get("question"), ctx.get("answer")
-            if isinstance(q, str) and q.strip() and isinstance(a, str) and a.strip():
-                valid.append(ctx)
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-            logger.warning(f"Failed to decode context for {user_id}: {e}")
 
-    return valid
+async def build_messages(
+    user_id: int,
+    system_prompt: str,
+    content: str,
+) -> tuple[list[dict], int]:
+    """
+    Промпт с историей в пределах CONTEXT_TOKEN_BUDGET. Второе значение —
+    сколько элементов контекста вошло (пары + пересказ); 0 — запрос без
+    контекста, ответ на него можно кэшировать.
+    """
+    history, summary = await _read_history(user_id)
+    summary_tokens = count_tokens(summary)
+    n_turns = _fit_budget(history, CONTEXT_TOKEN_BUDGET - summary_tokens)
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({
+            "role": "system",
+            "content": f"Краткое содержание предыдущей части диалога:\n{summary}",
+        })
+    for _, ctx in reversed(history[:n_turns]):
+        messages.append({"role": "user", "content": ctx["question"]})
+        messages.append({"role": "assistant", "content": ctx["answer"]})
+    messages.append({"role": "user", "content": content})
+
+    if history or summary:
+        log_event(
+            "context.assembled",
+            user=user_id,
+            turns=n_turns,
+            skipped=len(history) - n_turns,
+            ctx_tokens=summary_tokens + sum(ctx["tokens"] for _, ctx in history[:n_turns]),
+            summary=bool(summary),
+        )
+    return messages, n_turns + bool(summary)
+
+
+def schedule_summary(user_id: int) -> None:
+    """
+    Фоновое сворачивание старых пар — ответ пользователю уже доставлен.
+    Локально — одна задача на пользователя, между репликами — Redis-лок
+    в _update_summary.
+    """
+    running = _summary_tasks.get(user_id)
+    if running is not None and not running.done():
+        return  # следующая пара всё равно запустит ещё раз
+    task = asyncio.create_task(_update_summary(user_id), name=f"summary-{user_id}")
+    _summary_tasks[user_id] = task
+    task.add_done_callback(
+        lambda t: _summary_tasks.pop(user_id, None) if _summary_tasks.get(user_id) is t else None
+    )
+
+
+async def _update_summary(user_id: int) -> None:
+    """
+    Пары, не влезающие в бюджет (или в MAX_CONTEXT_MESSAGES - 1, чтобы
+    следующий LTRIM ничего не выкинул молча), сворачиваются в пересказ.
+    Удаляются точечно через LREM по значению — новые пары, пришедшие,
+    пока думал суммаризатор, не задеваются.
+
+    Ответы одного пользователя могут сохранять разные реплики — без лока
+    каждая свернула бы те же пары своим вызовом Groq, и последний SET
+    затёр бы пересказ остальных.
+    """
+    lock_key = _summary_lock_key(user_id)
+    token = secrets.token_hex(8)
+    try:
+        if not await redis.set(lock_key, token, ex=SUMMARY_LOCK_TTL, nx=True):
+            log_event("context.summary_busy", user=user_id)
+            return
+    except Exception as e:
+        logger.warning(f"Context summary lock failed for {user_id}: {e}")
+        return
+    try:
+        history, summary = await _read_history(user_id)
+        keep = min(
+            _fit_budget(history, CONTEXT_TOKEN_BUDGET - count_tokens(summary)),
+            MAX_CONTEXT_MESSAGES - 1,
+        )
+        overflow = history[keep:]
+        if not overflow:
+            return
+
+        new_summary = await _summarize(user_id, summary, [ctx for _, ctx in reversed(overflow)])
+        if not new_summary:
+            return
+
+        key = _context_key(user_id)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(_summary_key(user_id), new_summary.encode("utf-8"), ex=_CONTEXT_TTL)
+            for entry, _ in overflow:
+                pipe.lrem(key, -1, entry)
+            await pipe.execute()
+
+        log_event(
+            "context.summarized",
+            user=user_id,
+            folded=len(overflow),
+            folded_tokens=sum(ctx["tokens"] for _, ctx in overflow),
+            summary_tokens=count_tokens(new_summary),
+        )
+    except Exception as e:
+        logger.warning(f"Context summary update failed for {user_id}: {e}")
+    finally:
+        with suppress(Exception):
+            await _unlock_script(keys=[lock_key], args=[token])
+
+
+async def _summarize(user_id: int, previous: str, turns: list[dict]) -> str:
+    parts = []
+    if previous:
+        parts.append(f"Текущий пересказ:\n{previous}")
+    for ctx in turns:
+        parts.append(
+            f"Пользователь: {ctx['question'][:_SUMMARY_TURN_CHARS]}\n"
+            f"Ассистент: {ctx['answer'][:_SUMMARY_TURN_CHARS]}"
+        )
+    text = "\n\n".join(parts)
+
+    # Пересказ — фоновая работа: при полной очереди Groq просто откладывается
+    async with admission.slot("groq"), log_timing(
+        "groq.summarize", user=user_id, turns=len(turns), input_chars=len(text)
+    ):
+        response = await groq_client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            temperature=0.2,
+        )
+    return (response.choices[0].message.content or "").strip()
 
 
 # ────────────────────────────────────────────────────────────────────────────
@@ -290,37 +377,37 @@ async def process_request(
     (контекст сохраняется снаружи, в handler-е, после полного получения).
     Если stream=False — возвращает строку и сохраняет контекст внутри.
     """
-    context_list = await get_context(telegram_id)
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for ctx in reversed(context_list):
-        messages.append({"role": "user", "content": ctx["question"]})
-        messages.append({"role": "assistant", "content": ctx["answer"]})
-    messages.append({"role": "user", "content": content})
+    messages, ctx_size = await build_messages(telegram_id, SYSTEM_PROMPT, content)
 
     if stream:
-        async with log_timing(
-            "openai.chat.create",
-            mode="stream",
-            user=telegram_id,
-            model=MODEL_NAME,
-            ctx_msgs=len(context_list),
-            input_chars=len(content),
-            max_tokens=MAX_OUTPUT_TOKENS_TEXT,
-        ):
-            return await client.chat.completions.create(
-                messages=messages,
+        async def open_stream():
+            async with log_timing(
+                "openai.chat.create",
+                mode="stream",
+                user=telegram_id,
                 model=MODEL_NAME,
-                max_completion_tokens=MAX_OUTPUT_TOKENS_TEXT,
-                stream=True,
-                stream_options={"include_usage": True},
-            )
+                ctx_msgs=ctx_size,
+                input_chars=len(content),
+                max_tokens=MAX_OUTPUT_TOKENS_TEXT,
+            ):
+                return await llm_pool.stream_chat(
+                    messages=messages,
+                    model=MODEL_NAME,
+                    max_completion_tokens=MAX_OUTPUT_TOKENS_TEXT,
+                    stream_options={"include_usage": True},
+                )
+
+        if ctx_size:
+            return await open_stream()
+        # Без контекста ответ зависит только от запроса — кэш и singleflight
+        return await cached_stream(SYSTEM_PROMPT, MODEL_NAME, content, open_stream)
 
     async with log_timing(
         "openai.chat.create",
         mode="full",
         user=telegram_id,
         model=MODEL_NAME,
-        ctx_msgs=len(context_list),
+        ctx_msgs=ctx_size,
         input_chars=len(content),
         max_tokens=MAX_OUTPUT_TOKENS_TEXT,
     ):
@@ -345,29 +432,28 @@ async def process_request(
 
 async def generate_code(telegram_id: int, request: str, stream: bool = False):
     """Запрос к модели с промптом для генерации кода."""
-    context_list = await get_context(telegram_id)
-    messages = [{"role": "system", "content": CODE_GENERATION_PROMPT}]
-    for ctx in reversed(context_list):
-        messages.append({"role": "user", "content": ctx["question"]})
-        messages.append({"role": "assistant", "content": ctx["answer"]})
-    messages.append({"role": "user", "content": request})
+    messages, ctx_size = await build_messages(telegram_id, CODE_GENERATION_PROMPT, request)
 
     if stream:
-        async with log_timing(
-            "openai.code.create",
-            mode="stream",
-            user=telegram_id,
-            model=MODEL_NAME,
-            input_chars=len(request),
-            max_tokens=MAX_OUTPUT_TOKENS_CODE,
-        ):
-            return await client.chat.completions.create(
-                messages=messages,
+        async def open_stream():
+            async with log_timing(
+                "openai.code.create",
+                mode="stream",
+                user=telegram_id,
                 model=MODEL_NAME,
-                max_completion_tokens=MAX_OUTPUT_TOKENS_CODE,
-                stream=True,
-                stream_options={"include_usage": True},
-            )
+                input_chars=len(request),
+                max_tokens=MAX_OUTPUT_TOKENS_CODE,
+            ):
+                return await llm_pool.stream_chat(
+                    messages=messages,
+                    model=MODEL_NAME,
+                    max_completion_tokens=MAX_OUTPUT_TOKENS_CODE,
+                    stream_options={"include_usage": True},
+                )
+
+        if ctx_size:
+            return await open_stream()
+        return await cached_stream(CODE_GENERATION_PROMPT, MODEL_NAME, request, open_stream)
 
     async with log_timing(
         "openai.code.create",
@@ -388,31 +474,5 @@ async def generate_code(telegram_id: int, request: str, stream: bool = False):
     return bot_response
 
 
-# ────────────────────────────────────────────────────────────────────────────
-# Чтение документов — все sync операции вынесены в thread pool,
-# чтобы не блокировать event loop при больших PDF/DOCX.
-# ────────────────────────────────────────────────────────────────────────────
-async def read_pdf(file_path: str | os.PathLike) -> str:
-    def _read() -> str:
-        reader = PdfReader(str(file_path))
-        return "\n".join((p.extract_text() or "") for p in reader.pages)
-    async with log_timing("read_pdf", path=str(file_path)):
-        return await asyncio.to_thread(_read)
-
-
-async def read_docx(file_path: str | os.PathLike) -> str:
-    def _read() -> str:
-        doc = Document(str(file_path))
-        return " ".join(p.text for p in doc.paragraphs if p.text)
-    async with log_timing("read_docx", path=str(file_path)):
-        return await asyncio.to_thread(_read)
-
-
-async def read_txt(file_path: str | os.PathLike) -> str:
-    async with log_timing("read_txt", path=str(file_path)):
-        async with aiofiles.open(file_path, "r", encoding="utf-8", errors="replace") as f:
-            return await f.read()
-
-
 async def format_datetime(dt: datetime) -> str:
     return dt.strftime("%d.%m.%Y")
@@ -0,0 +1,156 @@
+"""
+Нормализация изображений перед отправкой в vision-модель.
+
+Раньше каждое фото читалось с диска дважды (валидация + base64), PIL
+крутился в thread pool, base64 — прямо в event loop, а в Groq уходили
+исходные байты: до 5 × 4 MB (+33% на base64) через прокси.
+
+Теперь одна CPU-задача в ProcessPoolExecutor на картинку:
+decode один раз → проверка размера/разрешения → уменьшение до стороны,
+которую vision-модель реально использует → WebP/JPEG с подобранным
+качеством → готовый data URL. Event loop и GIL основного процесса
+свободны, альбом обрабатывается параллельно на нескольких ядрах.
+
+Плюс pick_photo_size(): из msg.photo берём не самый большой размер,
+а наименьший, которого хватает модели — меньше качать и декодировать.
+
+Воркеры пула импортируют этот модуль, поэтому config здесь не
+импортируется на верхнем уровне — лимиты передаются аргументом.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import NamedTuple, Optional, Sequence
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+class ImageLimits(NamedTuple):
+    max_bytes: int
+    max_megapixels: float
+    max_side: int
+    fmt: str  # "WEBP" или "JPEG"
+    quality: int
+
+
+def _normalize(data: bytes, limits: ImageLimits) -> str:
+    """Выполняется в воркере пула. ValueError — понятная пользователю причина отказа."""
+    size_mb = len(data) / (1024 * 1024)
+    if len(data) > limits.max_bytes:
+        max_mb = limits.max_bytes / (1024 * 1024)
+        raise ValueError(f"Размер ({size_mb:.1f} MB) превышает {max_mb:.0f} MB")
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # Разрешение известно из заголовка — до декодирования пикселей
+            w, h = img.size
+            megapixels = (w * h) / 1_000_000
+            if megapixels > limits.max_megapixels:
+                raise ValueError(
+                    f"Разрешение ({megapixels:.1f} MP) превышает {limits.max_megapixels} MP"
+                )
+            # JPEG умеет декодироваться сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+            img.draft("RGB", (limits.max_side, limits.max_side))
+            out_img = ImageOps.exif_transpose(img)
+            keep_alpha = limits.fmt == "WEBP" and out_img.mode in ("RGBA", "LA")
+            if out_img.mode not in ("RGB", "L") and not keep_alpha:
+                out_img = out_img.convert("RGB")
+            out_img.thumbnail((limits.max_side, limits.max_side), Image.Resampling.LANCZOS)
+
+            buf = BytesIO()
+            if limits.fmt == "WEBP":
+                out_img.save(buf, format="WEBP", quality=limits.quality, method=4)
+            else:
+                out_img.save(buf, format="JPEG", quality=limits.quality, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError(f"Не удалось прочитать изображение: {e}") from e
+
+    b64 = base64.b64encode(buf.getbuffer()).decode("ascii")
+    return f"data:image/{limits.fmt.lower()};base64,{b64}"
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        from config.config import IMAGE_POOL_WORKERS
+
+        # Не fork: процесс с живым event loop и потоками (httpx, redis, OTLP)
+        # форкается вместе с захваченными ими локами, и воркер может зависнуть
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_POOL_WORKERS, mp_context=multiprocessing.get_context(method)
+        )
+    return _pool
+
+
+def _drop_broken_pool(pool: ProcessPoolExecutor) -> None:
+    """Снимает сломанный пул: следующий вызов создаст новый, остатки старого — гасим."""
+    global _pool
+    # Параллельный вызов мог уже заменить пул — новый не трогаем
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _limits() -> ImageLimits:
+    from config.config import (
+        MAX_IMAGE_RESOLUTION_MP,
+        MAX_IMAGE_SIZE_MB,
+        VISION_IMAGE_FORMAT,
+        VISION_IMAGE_QUALITY,
+        VISION_MAX_SIDE,
+    )
+
+    return ImageLimits(
+        max_bytes=MAX_IMAGE_SIZE_MB * 1024 * 1024,
+        max_megapixels=MAX_IMAGE_RESOLUTION_MP,
+        max_side=VISION_MAX_SIDE,
+        fmt=VISION_IMAGE_FORMAT,
+        quality=VISION_IMAGE_QUALITY,
+    )
+
+
+async def normalize_image(data: bytes) -> str:
+    """Байты картинки → data URL для vision-модели. ValueError — картинка не подходит."""
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    try:
+        return await loop.run_in_executor(pool, _normalize, data, _limits())
+    except BrokenProcessPool:
+        # Воркер умер (OOM на огромной картинке и т.п.) — следующий вызов создаст пул заново
+        logger.error("Image pool is broken, recreating on next call")
+        _drop_broken_pool(pool)
+        raise
+
+
+def shutdown_image_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def pick_photo_size(sizes: Sequence, max_side: int):
+    """
+    Наименьший PhotoSize, у которого большая сторона ≥ max_side (дальше
+    всё равно уменьшим); если таких нет — самый большой из доступных.
+    """
+    best = None
+    for size in sizes:
+        if max(size.width, size.height) >= max_side and (
+            best is None or size.width * size.height < best.width * best.height
+        ):
+            best = size
+    if best is not None:
+        return best
+    return max(sizes, key=lambda s: s.width * s.height)
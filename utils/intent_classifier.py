@@ -0,0 +1,256 @@
+"""
+Локальный классификатор намерения CODE/TEXT перед UniversalAnalyzer.
+
+Groq-анализ (llama-4-scout, max_tokens=1024) нужен текстовым запросам только
+ради тега <intent>. Для уверенных случаев его заменяет линейная модель
+(логистическая регрессия) на символьных n-граммах: предсказание — сумма
+весов n-грамм текста, десятки микросекунд на CPU, без сети.
+
+Обучается на решениях самого анализатора: UniversalAnalyzer складывает
+в Redis-список пары «текст → intent» от Groq, отсюда же они выгружаются.
+Модель — JSON-файл с весами; если файла нет, классификатор просто
+отключён и всё идёт в Groq, как раньше.
+
+Модуль без зависимостей от config — команды ниже работают офлайн
+(кроме export, которому нужен Redis):
+
+    python -m utils.intent_classifier export decisions.jsonl
+    python -m utils.intent_classifier train decisions.jsonl --out data/intent_model.json
+    python -m utils.intent_classifier evaluate decisions.jsonl --model data/intent_model.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+from collections import Counter
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+_NGRAM_SIZES = (2, 3, 4)
+# Намерение видно по началу запроса; длинный вставленный код/текст только
+# раздувает время предсказания
+_MAX_CHARS = 1000
+
+DECISIONS_KEY = "analyzer:decisions"
+
+
+def _ngrams(text: str) -> Counter[str]:
+    text = " " + " ".join(text.lower().split())[:_MAX_CHARS] + " "
+    return Counter(
+        text[i:i + n]
+        for n in _NGRAM_SIZES
+        for i in range(len(text) - n + 1)
+    )
+
+
+def _features(text: str) -> list[tuple[str, float]]:
+    """TF n-грамм, нормированный по L2 — длина текста не влияет на уверенность."""
+    counts = _ngrams(text)
+    norm = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+    return [(g, c / norm) for g, c in counts.items()]
+
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+
+class IntentClassifier:
+    """Логистическая регрессия: P(CODE) по символьным n-граммам."""
+
+    __slots__ = ("weights", "bias", "confidence")
+
+    def __init__(self, weights: dict[str, float], bias: float, confidence: float = 0.9) -> None:
+        self.weights = weights
+        self.bias = bias
+        # classify() отвечает сам, только если P(CODE) ≥ confidence или ≤ 1 - confidence
+        self.confidence = confidence
+
+    def predict_proba(self, text: str) -> float:
+        weights = self.weights
+        z = self.bias
+        for gram, value in _features(text):
+            w = weights.get(gram)
+            if w is not None:
+                z += w * value
+        return _sigmoid(z)
+
+    def classify(self, text: str) -> Optional[bool]:
+        """True — CODE, False — TEXT, None — не уверен, спросить Groq."""
+        p = self.predict_proba(text)
+        if p >= self.confidence:
+            return True
+        if p <= 1 - self.confidence:
+            return False
+        return None
+
+    # ── Файл модели ──
+    @classmethod
+    def load(cls, path: str, confidence: float = 0.9) -> Optional[IntentClassifier]:
+        """None, если модели нет или она битая — тогда всё решает Groq."""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            model = cls(data["weights"], float(data["bias"]), confidence)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load intent model {path}: {e}")
+            return None
+        logger.info(f"Intent model loaded: {path} ({len(model.weights)} n-grams)")
+        return model
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"weights": self.weights, "bias": self.bias}, f, ensure_ascii=False)
+
+    # ── Обучение ──
+    @classmethod
+    def train(
+        cls,
+        samples: list[tuple[str, bool]],
+        *,
+        epochs: int = 8,
+        lr: float = 0.5,
+        l2: float = 1e-6,
+        min_weight: float = 1e-3,
+        seed: int = 0,
+    ) -> IntentClassifier:
+        """
+        SGD по логистической функции потерь. Веса с |w| < min_weight
+        выбрасываются — на качество не влияют, а модель становится в разы меньше.
+        """
+        rng = random.Random(seed)
+        data = [(_features(text), 1.0 if is_code else 0.0) for text, is_code in samples]
+        weights: dict[str, float] = {}
+        bias = 0.0
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            step = lr / (1 + epoch)
+            for feats, y in data:
+                z = bias
+                for gram, value in feats:
+                    z += weights.get(gram, 0.0) * value
+                grad = _sigmoid(z) - y
+                bias -= step * grad
+                for gram, value in feats:
+                    w = weights.get(gram, 0.0)
+                    weights[gram] = w - step * (grad * value + l2 * w)
+        weights = {g: round(w, 5) for g, w in weights.items() if abs(w) >= min_weight}
+        return cls(weights, bias)
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Офлайн-оценка
+# ────────────────────────────────────────────────────────────────────────────
+def load_decisions(path: str) -> list[tuple[str, bool]]:
+    """JSONL из export: {"text": ..., "intent": "CODE" | "TEXT"} на строку."""
+    samples: list[tuple[str, bool]] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            intent = str(row.get("intent", "")).upper()
+            if intent in ("CODE", "TEXT") and row.get("text"):
+                samples.append((row["text"], intent == "CODE"))
+    return samples
+
+
+def evaluate(model: IntentClassifier, samples: Iterable[tuple[str, bool]]) -> dict[str, float]:
+    """
+    accuracy — по порогу 0.5 на всех примерах; coverage — доля, на которой
+    classify() уверен и Groq не нужен; confident_accuracy — точность на ней.
+    Латентность — одного classify(), в микросекундах.
+    """
+    n = correct = covered = covered_correct = 0
+    latencies: list[float] = []
+    for text, is_code in samples:
+        start = time.perf_counter()
+        decision = model.classify(text)
+        latencies.append((time.perf_counter() - start) * 1e6)
+        n += 1
+        correct += (model.predict_proba(text) >= 0.5) == is_code
+        if decision is not None:
+            covered += 1
+            covered_correct += decision == is_code
+    if not n:
+        return {"n": 0}
+    latencies.sort()
+    return {
+        "n": n,
+        "accuracy": correct / n,
+        "coverage": covered / n,
+        "confident_accuracy": covered_correct / covered if covered else 0.0,
+        "latency_us_p50": latencies[n // 2],
+        "latency_us_p99": latencies[min(n - 1, int(n * 0.99))],
+    }
+
+
+async def _export(path: str, limit: int) -> int:
+    from config.config import redis  # только здесь: train/evaluate работают без .env
+
+    rows = await redis.lrange(DECISIONS_KEY, 0, limit - 1)
+    with open(path, "w", encoding="utf-8") as f:
+        for raw in rows:
+            f.write(raw.decode("utf-8") + "\n")
+    await redis.aclose()
+    return len(rows)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m utils.intent_classifier")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="выгрузить решения анализатора из Redis в JSONL")
+    p_export.add_argument("out")
+    p_export.add_argument("--limit", type=int, default=100_000)
+
+    p_train = sub.add_parser("train", help="обучить модель на выгруженных решениях")
+    p_train.add_argument("decisions")
+    p_train.add_argument("--out", default="data/intent_model.json")
+    p_train.add_argument("--holdout", type=float, default=0.2)
+    p_train.add_argument("--epochs", type=int, default=8)
+    p_train.add_argument("--seed", type=int, default=0)
+
+    p_eval = sub.add_parser("evaluate", help="точность, покрытие и латентность модели")
+    p_eval.add_argument("decisions")
+    p_eval.add_argument("--model", default="data/intent_model.json")
+    p_eval.add_argument("--confidence", type=float, default=0.9)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        count = asyncio.run(_export(args.out, args.limit))
+        print(f"exported {count} decisions → {args.out}")
+
+    elif args.command == "train":
+        samples = load_decisions(args.decisions)
+        random.Random(args.seed).shuffle(samples)
+        split = int(len(samples) * (1 - args.holdout))
+        train_set, test_set = samples[:split], samples[split:]
+        model = IntentClassifier.train(train_set, epochs=args.epochs, seed=args.seed)
+        model.save(args.out)
+        print(f"trained on {len(train_set)}, saved {len(model.weights)} n-grams → {args.out}")
+        if test_set:
+            print(json.dumps(evaluate(model, test_set), indent=2))
+
+    else:
+        model = IntentClassifier.load(args.model, args.confidence)
+        if model is None:
+            parser.error(f"no model at {args.model}")
+        print(json.dumps(evaluate(model, load_decisions(args.decisions)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Пул LLM-эндпоинтов с hedged-запросами.
+
+Основной клиент (config.client) — один провайдер через один прокси. Когда
+у провайдера медленная полоса, все пользователи ждут первого токена
+вплоть до read=180. Теперь стрим открывается через пул:
+
+1. Запрос уходит на основной эндпоинт (первый здоровый по порядку).
+2. Если первый токен не пришёл за адаптивную задержку — перцентиль
+   HEDGE_PERCENTILE недавних TTFT этого эндпоинта (в пределах
+   HEDGE_MIN_DELAY..HEDGE_MAX_DELAY) — тот же запрос уходит на запасной
+   эндпоинт с наименьшим EWMA времени до первого токена.
+3. Побеждает тот, кто первым прислал токен; второй отменяется и его
+   стрим закрывается.
+
+Ошибка основного эндпоинта до первого токена — сразу запрос на запасной
+(без ожидания задержки). Хеджей не больше HEDGE_MAX_RATIO от числа
+запросов (token bucket), поэтому средняя стоимость почти не растёт:
+при p95 хеджируется ~5% запросов — ровно хвост, который и портит p99.
+
+Стрим, который возвращает stream_chat(), отдаёт те же чанки openai,
+что и client.chat.completions.create(stream=True): буферизованные до
+первого токена, затем остальные; close() закрывает upstream.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Any, Optional
+
+from openai import AsyncOpenAI
+
+from config.config import (
+    HEDGE_DEFAULT_DELAY,
+    HEDGE_MAX_DELAY,
+    HEDGE_MAX_RATIO,
+    HEDGE_MIN_DELAY,
+    HEDGE_PERCENTILE,
+    HEDGE_WINDOW,
+    USE_HEDGING,
+    client,
+    fallback_llm_clients,
+)
+from utils.logging_helpers import log_event
+
+logger = logging.getLogger(__name__)
+
+_EWMA_ALPHA = 0.2
+# Меньше выборка — перцентиль ничего не значит, используем HEDGE_DEFAULT_DELAY
+_MIN_SAMPLES = 20
+# Доля ошибок (EWMA), выше которой эндпоинт не берётся основным
+_UNHEALTHY_ERROR_RATE = 0.5
+_HEDGE_BURST = 5.0
+
+
+class Endpoint:
+    """Клиент одного провайдера + его статистика."""
+
+    def __init__(self, name: str, client: AsyncOpenAI, model: Optional[str] = None) -> None:
+        self.name = name
+        self.client = client
+        self.model = model  # None — модель из запроса, иначе подменяем (у провайдера своё имя)
+        self.ttft_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.in_flight = 0
+        self.recent: deque[float] = deque(maxlen=HEDGE_WINDOW)
+
+    @property
+    def healthy(self) -> bool:
+        return self.error_ewma < _UNHEALTHY_ERROR_RATE
+
+    def record_ttft(self, seconds: float) -> None:
+        """Успешный первый токен: EWMA, окно перцентиля и минус к доле ошибок."""
+        if self.ttft_ewma is None:
+            self.ttft_ewma = seconds
+        else:
+            self.ttft_ewma += _EWMA_ALPHA * (seconds - self.ttft_ewma)
+        self.error_ewma *= 1 - _EWMA_ALPHA
+        self.recent.append(seconds)
+
+    def record_ttft_bound(self, seconds: float) -> None:
+        """
+        Проигравший хедж отменён до первого токена: его TTFT не меньше seconds.
+        Успехом это не было — error_ewma не трогаем, в окно перцентиля не идёт,
+        EWMA только поднимаем (граница ниже EWMA ничего не говорит).
+        """
+        if self.ttft_ewma is None:
+            self.ttft_ewma = seconds
+        elif seconds > self.ttft_ewma:
+            self.ttft_ewma += _EWMA_ALPHA * (seconds - self.ttft_ewma)
+
+    def record_error(self) -> None:
+        self.error_ewma += _EWMA_ALPHA * (1 - self.error_ewma)
+
+    def hedge_delay(self) -> float:
+        if len(self.recent) < _MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.recent)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, value))
+
+    def request_kwargs(self, kwargs: dict[str, Any]) -> dict[str, Any]:
+        if self.model is None:
+            return kwargs
+        return {**kwargs, "model": self.model}
+
+
+class _PooledStream:
+    """Победивший стрим: сначала буфер до первого токена, потом upstream."""
+
+    def __init__(self, endpoint: str, stream, buffered: list) -> None:
+        self.endpoint = endpoint
+        self._stream = stream
+        self._buffered = deque(buffered)
+
+    def __aiter__(self) -> _PooledStream:
+        return self
+
+    async def __anext__(self):
+        if self._buffered:
+            return self._buffered.popleft()
+        return await self._stream.__anext__()
+
+    async def close(self) -> None:
+        self._buffered.clear()
+        await self._stream.close()
+
+
+class LLMPool:
+    def __init__(self, endpoints: list[Endpoint]) -> None:
+        self.endpoints = endpoints
+        self._hedge_tokens = _HEDGE_BURST
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    # ── Выбор эндпоинтов ──
+    def _primary(self) -> Endpoint:
+        for ep in self.endpoints:
+            if ep.healthy:
+                return ep
+        return self.endpoints[0]
+
+    def _backup(self, primary: Endpoint) -> Optional[Endpoint]:
+        others = [ep for ep in self.endpoints if ep is not primary]
+        if not others:
+            return None
+        # Без статистики — по порядку в конфиге; дальше — по здоровью и EWMA
+        return min(
+            others,
+            key=lambda ep: (not ep.healthy, ep.ttft_ewma if ep.ttft_ewma is not None else 0.0),
+        )
+
+    def _take_hedge_token(self) -> bool:
+        if self._hedge_tokens >= 1:
+            self._hedge_tokens -= 1
+            return True
+        return False
+
+    # ── Открытие стрима ──
+    async def _open(self, ep: Endpoint, kwargs: dict[str, Any]) -> _PooledStream:
+        """Открывает стрим и читает его до первого токена (или до конца)."""
+        start = time.monotonic()
+        ep.in_flight += 1
+        stream = None
+        try:
+            stream = await ep.client.chat.completions.create(**ep.request_kwargs(kwargs))
+            buffered = []
+            while True:
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                buffered.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except asyncio.CancelledError:
+            if stream is not None:
+                with suppress(Exception):
+                    await stream.close()
+            raise
+        except Exception:
+            ep.record_error()
+            if stream is not None:
+                with suppress(Exception):
+                    await stream.close()
+            raise
+        finally:
+            ep.in_flight -= 1
+        ep.record_ttft(time.monotonic() - start)
+        return _PooledStream(ep.name, stream, buffered)
+
+    async def stream_chat(self, **kwargs: Any) -> _PooledStream:
+        """Аналог client.chat.completions.create(stream=True, ...) с хеджированием."""
+        kwargs["stream"] = True
+        self.requests += 1
+        self._hedge_tokens = min(_HEDGE_BURST, self._hedge_tokens + HEDGE_MAX_RATIO)
+
+        primary = self._primary()
+        backup = self._backup(primary) if USE_HEDGING else None
+        start = time.monotonic()
+        tasks: dict[asyncio.Task, Endpoint] = {
+            asyncio.create_task(self._open(primary, kwargs), name=f"llm-{primary.name}"): primary
+        }
+        last_error: Optional[BaseException] = None
+        try:
+            timeout: Optional[float] = primary.hedge_delay() if backup else None
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                timeout = None
+
+                for task in done:
+                    ep = tasks.pop(task)
+                    if task.exception() is None:
+                        if ep is not primary:
+                            self.hedge_wins += 1
+                        self._log_winner(ep, primary, start, hedged=len(tasks) > 0 or ep is not primary)
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"LLM endpoint {ep.name} failed before first token: {last_error}")
+
+                if backup is None or backup in tasks.values():
+                    continue
+                if not done:
+                    # Первый токен не пришёл за задержку — хедж, если есть бюджет
+                    if not self._take_hedge_token():
+                        log_event("llm.hedge_skipped", primary=primary.name, reason="budget")
+                        continue
+                    self.hedges += 1
+                    log_event(
+                        "llm.hedge",
+                        primary=primary.name,
+                        backup=backup.name,
+                        after_ms=int((time.monotonic() - start) * 1000),
+                    )
+                elif last_error is not None and not tasks:
+                    self.failovers += 1
+                    log_event("llm.failover", primary=primary.name, backup=backup.name)
+                else:
+                    continue
+                tasks[asyncio.create_task(self._open(backup, kwargs), name=f"llm-{backup.name}")] = backup
+                backup = None  # не больше одного хеджа на запрос
+        finally:
+            # Проигравший (или все при отмене пользователем) — отменяем. Второй
+            # успешный из того же done (или успевший открыться до cancel) —
+            # закрываем его стрим, иначе upstream-соединение утечёт
+            for task, ep in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    ep.record_ttft_bound(time.monotonic() - start)
+            for task in tasks:
+                with suppress(BaseException):
+                    stream = await task
+                    await stream.close()
+
+        raise last_error or RuntimeError("No LLM endpoint available")
+
+    def _log_winner(self, winner: Endpoint, primary: Endpoint, start: float, *, hedged: bool) -> None:
+        log_event(
+            "llm.first_token",
+            endpoint=winner.name,
+            ttft_ms=int((time.monotonic() - start) * 1000),
+            hedged=hedged,
+            ewma_ms=int((winner.ttft_ewma or 0) * 1000),
+        )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "endpoints": {
+                ep.name: {
+                    "ttft_ewma_ms": int((ep.ttft_ewma or 0) * 1000),
+                    "error_ewma": round(ep.error_ewma, 3),
+                    "in_flight": ep.in_flight,
+                    "hedge_delay_ms": int(ep.hedge_delay() * 1000),
+                }
+                for ep in self.endpoints
+            },
+        }
+
+
+llm_pool = LLMPool([
+    Endpoint("main", client),
+    *(Endpoint(name, c, model) for name, c, model in fallback_llm_clients),
+])
@@ -14,6 +14,11 @@
 
     # → 12:34:56.789 | DEBUG | utils.functions:42 | → openai.chat.create model=gpt-5 msgs=7
     # → 12:34:58.123 | DEBUG | utils.functions:42 | ✓ openai.chat.create OK (1334ms) model=gpt-5 msgs=7
+
+Оба заодно пишут метрики (utils/metrics.py): log_timing — гистограмму
+bot_operation_seconds{op, status}, log_event — счётчик bot_events_total.
+И трейс (utils/tracing.py): log_timing — вложенный span текущего trace'а,
+log_event — событие в текущем span'е.
 """
 from __future__ import annotations
 
@@ -23,6 +28,9 @@ import time
 from contextlib import asynccontextmanager
 from typing import Any
 
+from utils.metrics import operation_seconds, record_event
+from utils.tracing import add_event, span
+
 logger = logging.getLogger("timing")
 
 
@@ -46,28 +54,37 @@ async def log_timing(name: str, **kwargs: Any):
     парсинг документов) обёрнуты в это, чтобы при LOG_LEVEL=DEBUG было видно
     «что именно тормозит».
     """
-    start = time.monotonic()
-    ctx = _format_kwargs(kwargs)
-    logger.debug(f"→ {name}{ctx}")
-    try:
-        yield
-        elapsed_ms = (time.monotonic() - start) * 1000
-        logger.debug(f"✓ {name} OK ({elapsed_ms:.0f}ms){ctx}")
-    except asyncio.CancelledError:
-        elapsed_ms = (time.monotonic() - start) * 1000
-        logger.debug(f"⊘ {name} CANCELLED ({elapsed_ms:.0f}ms){ctx}")
-        raise
-    except Exception as e:
-        elapsed_ms = (time.monotonic() - start) * 1000
-        # Ошибки логируем даже без DEBUG-уровня — это всегда полезно
-        logger.warning(
-            f"✗ {name} FAIL ({elapsed_ms:.0f}ms){ctx}: "
-            f"{type(e).__name__}: {e}"
-        )
-        raise
+    with span(name, **kwargs):
+        start = time.monotonic()
+        ctx = _format_kwargs(kwargs)
+        logger.debug(f"→ {name}{ctx}")
+        try:
+            yield
+            elapsed = time.monotonic() - start
+            operation_seconds.observe(elapsed, op=name, status="ok")
+            elapsed_ms = elapsed * 1000
+            logger.debug(f"✓ {name} OK ({elapsed_ms:.0f}ms){ctx}")
+        except asyncio.CancelledError:
+            elapsed = time.monotonic() - start
+            operation_seconds.observe(elapsed, op=name, status="cancelled")
+            elapsed_ms = elapsed * 1000
+            logger.debug(f"⊘ {name} CANCELLED ({elapsed_ms:.0f}ms){ctx}")
+            raise
+        except Exception as e:
+            elapsed = time.monotonic() - start
+            operation_seconds.observe(elapsed, op=name, status="fail")
+            elapsed_ms = elapsed * 1000
+            # Ошибки логируем даже без DEBUG-уровня — это всегда полезно
+            logger.warning(
+                f"✗ {name} FAIL ({elapsed_ms:.0f}ms){ctx}: "
+                f"{type(e).__name__}: {e}"
+            )
+            raise
 
 
 def log_event(name: str, **kwargs: Any) -> None:
     """Точечная запись события без тайминга. Удобно для милстоунов в пайплайне."""
+    record_event(name, kwargs)
+    add_event(name, kwargs)
     ctx = _format_kwargs(kwargs)
     logger.debug(f"• {name}{ctx}")
@@ -0,0 +1,694 @@
+"""
+Markdown → Telegram HTML.
+
+Вместо цепочки из полутора десятков re.sub по всему тексту + отдельного
+прохода балансировки тегов здесь один токенизатор:
+
+1. Код (```блоки``` и `инлайн`) вырезается первым и заменяется плейсхолдером —
+   внутри кода разметка больше не интерпретируется (раньше `__init__` или
+   `# комментарий` в коде превращались в <b>, и Telegram отвергал HTML).
+2. Строчные правила (---, >>> цитаты, # заголовки) — три якорных regex
+   по тексту без кода; теги вставляются управляющими символами-маркерами.
+3. Один проход compiled-regex по оставшемуся тексту собирает разделители
+   (**, __, ~~, *, _, [ссылки]) и маркеры, парует их так же, как это делала
+   цепочка re.sub, и сразу эмитит HTML со стеком открытых тегов — отдельный
+   _validate_and_fix_html больше не нужен.
+
+render_markdown() в том же вызове отдаёт флаг «есть таблица/LaTeX».
+Модуль без зависимостей от config — его можно импортировать в бенчмарках.
+"""
+from __future__ import annotations
+
+import re
+from html import escape
+
+# ────────────────────────────────────────────────────────────────────────────
+# Rich Messages (Bot API 10.1, июнь 2026) — детект таблиц/формул
+# ────────────────────────────────────────────────────────────────────────────
+_MD_TABLE_ROW_RE = re.compile(r"^\s*\|.+\|\s*$", re.MULTILINE)
+_MD_TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)+\|?\s*$", re.MULTILINE)
+_LATEX_BLOCK_RE = re.compile(r"\$\$.+?\$\$", re.DOTALL)
+_LATEX_INLINE_RE = re.compile(r"(?<!\$)\$(?!\$)[^\n$]+?(?<!\$)\$(?!\$)")
+_LATEX_BRACKET_RE = re.compile(r"\\\[.+?\\\]|\\\(.+?\\\)", re.DOTALL)
+
+
+def contains_rich_markup(text: str) -> bool:
+    """
+    True, если в тексте есть markdown-таблица или LaTeX-формула — такие ответы
+    стоит отправлять через sendRichMessage (Bot API 10.1), а не через
+    markdown_to_telegram_html, который таблицы/формулы не умеет рендерить.
+    """
+    if not text:
+        return False
+    # Дешёвые str-проверки отсекают regex для подавляющего большинства ответов
+    if "|" in text and _MD_TABLE_SEP_RE.search(text) and _MD_TABLE_ROW_RE.search(text):
+        return True
+    if "\\" in text and _LATEX_BRACKET_RE.search(text):
+        return True
+    if "$" in text and (_LATEX_BLOCK_RE.search(text) or _LATEX_INLINE_RE.search(text)):
+        return True
+    return False
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Токенизатор
+# ────────────────────────────────────────────────────────────────────────────
+_ALLOWED_TAGS = {"b", "i", "u", "s", "code", "pre", "a", "blockquote"}
+
+# Маркеры внутри промежуточного текста. Во входе их быть не должно —
+# управляющие символы из ответа модели просто выкидываются.
+_CODE_MARK = "\x00"
+_QUOTE_OPEN, _QUOTE_CLOSE = "\x01", "\x02"
+_HEADER_OPEN, _HEADER_CLOSE = "\x03", "\x04"
+_MARKS_RE = re.compile(r"[\x00-\x04]")
+
+_HR = "──────────────────"
+
+_CODE_RE = re.compile(r"```(?:\w*\n)?(.*?)```|`([^`\n]+)`", re.DOTALL)
+_HR_RE = re.compile(r"^\s*---\s*$", re.MULTILINE)
+# >>> цитата (после escape стало &gt;&gt;&gt;)
+_QUOTE_RE = re.compile(r"(^|\n)\s*&gt;&gt;&gt;\s*(.*?)(?=\n|$)", re.MULTILINE)
+_HEADER_RE = re.compile(r"^(#+)\s*(.*?)\s*$", re.MULTILINE)
+
+# Все инлайн-токены одним regex. Для «[» lookahead сразу отдаёт текст и url
+# ссылки, не поглощая их: текст ссылки дальше разбирается как обычно.
+# Url — непрозрачная строка, плейсхолдера кода в нём быть не может.
+_INLINE_RE = re.compile(r"\*\*|__|~~|\*|_|[\x00-\x04]|\[(?=(.*?)\]\(([^\x00\n]*?)\))")
+
+_PAIRED_TAGS = {"**": "b", "__": "b", "~~": "s", "*": "i", "_": "i"}
+_MARK_EVENTS = {
+    _QUOTE_OPEN: ("blockquote", True),
+    _QUOTE_CLOSE: ("blockquote", False),
+    _HEADER_OPEN: ("b", True),
+    _HEADER_CLOSE: ("b", False),
+}
+
+# Роли токенов после паровки
+_LITERAL, _OPEN, _CLOSE = 0, 1, 2
+# Типы событий для эмиттера
+_EV_TEXT, _EV_OPEN, _EV_CLOSE, _EV_PRE = 0, 1, 2, 3
+
+
+def _pair_sequential(kinds: list[str], roles: list[int], kind: str) -> bool:
+    """**, __, ~~ — каждый разделитель закрывается следующим таким же (как
+    нежадный DOTALL-regex). False — остался непарный."""
+    idx = [i for i, k in enumerate(kinds) if k == kind]
+    for n, i in enumerate(idx):
+        roles[i] = _OPEN if n % 2 == 0 else _CLOSE
+    if len(idx) % 2:
+        roles[idx[-1]] = _LITERAL
+        return False
+    return True
+
+
+def _pair_italic(
+    text: str,
+    kinds: list[str],
+    starts: list[int],
+    ends: list[int],
+    roles: list[int],
+    single: str,
+    double: str,
+) -> None:
+    """
+    Одиночные * или _: открывающий не соседствует с другим таким же символом,
+    закрывающий — следующий такой символ в той же строке, за которым нет
+    ещё одного. Непарные ** / __ остаются буквальными символами и мешают.
+    """
+    chars = [
+        i for i, k in enumerate(kinds)
+        if k == single or (k == double and roles[i] == _LITERAL)
+    ]
+    n = len(chars)
+    j = 0
+    while j < n - 1:
+        i = chars[j]
+        k = chars[j + 1]
+        if (
+            kinds[i] == single
+            and kinds[k] == single
+            and ends[i] != starts[k]
+            and (j == 0 or ends[chars[j - 1]] != starts[i])
+            and (j + 2 >= n or ends[k] != starts[chars[j + 2]])
+            and text.find("\n", ends[i], starts[k]) == -1
+        ):
+            roles[i] = _OPEN
+            roles[k] = _CLOSE
+            j += 2
+        else:
+            j += 1
+
+
+def _strip_bold_wrappers(events: list[tuple], inner_open: int, is_inner_end) -> bool:
+    """
+    <b> вокруг <pre>/<blockquote> Telegram не принимает — снимаем его так же,
+    как это делал regex `<b>(<pre>.*?</pre>)</b>`: от <b>, за которым сразу
+    идёт блок, до первого конца блока, за которым сразу идёт </b>.
+    False — такой <b> не нашёл своего </b>.
+    """
+    found_all = True
+    n = len(events)
+    i = 0
+    while i < n:
+        ev = events[i]
+        if ev[0] == _EV_OPEN and ev[1] == "b" and i + 1 < n and _is_inner_start(events[i + 1], inner_open):
+            for j in range(i + 1, n - 1):
+                nxt = events[j + 1]
+                if is_inner_end(events[j]) and nxt[0] == _EV_CLOSE and nxt[1] == "b":
+                    events[i] = events[j + 1] = (_EV_TEXT, "")
+                    i = j + 1
+                    break
+            else:
+                found_all = False
+        i += 1
+    return found_all
+
+
+def _is_inner_start(ev: tuple, inner_open: int) -> bool:
+    if inner_open == _EV_PRE:
+        return ev[0] == _EV_PRE
+    return ev[0] == _EV_OPEN and ev[1] == "blockquote"
+
+
+def _render(text: str, detect_rich: bool = False) -> tuple[str, bool, bool]:
+    """
+    Рабочая часть markdown_to_telegram_html. Второй элемент — «чистое»
+    окончание: нет незакрытых ```/**/__/~~ и ни один тег не пришлось
+    закрывать принудительно. Такой кусок можно склеивать со следующим.
+    Третий — contains_rich_markup (только при detect_rich, иначе False).
+    """
+    text = escape(text)
+    # escape не трогает | $ \ ( ) [ ] и переводы строк — флаг по уже
+    # экранированному буферу тот же, что по исходному тексту
+    rich = detect_rich and contains_rich_markup(text)
+    if _MARKS_RE.search(text):
+        text = _MARKS_RE.sub("", text)
+    clean = True
+
+    # 1. Код
+    codes: list[tuple[bool, str]] = []
+    if "`" in text:
+        def _cut_code(m: re.Match[str]) -> str:
+            if m.lastindex == 1:
+                codes.append((True, f"<pre>{m.group(1)}</pre>"))
+            else:
+                codes.append((False, f"<code>{m.group(2)}</code>"))
+            return _CODE_MARK
+
+        prose = _CODE_RE.sub(_cut_code, text)
+        if text.count("```") != 2 * sum(is_pre for is_pre, _ in codes):
+            clean = False  # незакрытый ``` может закрыться дальше по тексту
+    else:
+        prose = text
+
+    # 2. Строчные правила
+    if "---" in prose:
+        prose = _HR_RE.sub(_HR, prose)
+    if "&gt;&gt;&gt;" in prose:
+        prose = _QUOTE_RE.sub(f"\\1{_QUOTE_OPEN}\\2{_QUOTE_CLOSE}", prose)
+    if prose.startswith("#") or "\n#" in prose:
+        prose = _HEADER_RE.sub(f"{_HEADER_OPEN}\\2{_HEADER_CLOSE}", prose)
+
+    # 3. Инлайн-токены
+    kinds: list[str] = []
+    starts: list[int] = []
+    ends: list[int] = []
+    urls: dict[int, str] = {}
+    search = _INLINE_RE.search
+    pos = 0
+    link_text_end = -1
+    link_resume = 0
+    while True:
+        m = search(prose, pos)
+        if link_text_end >= 0 and (m is None or m.start() >= link_text_end):
+            kinds.append("]")
+            starts.append(link_text_end)
+            ends.append(link_resume)
+            pos = link_resume
+            link_text_end = -1
+            continue
+        if m is None:
+            break
+        tok = m.group()
+        if tok == "[":
+            if link_text_end < 0:
+                urls[len(kinds)] = m.group(2)
+                kinds.append(tok)
+                starts.append(m.start())
+                ends.append(m.end())
+                link_text_end = m.end(1)
+                link_resume = m.end(2) + 1
+            pos = m.end()
+            continue
+        kinds.append(tok)
+        starts.append(m.start())
+        ends.append(m.end())
+        pos = m.end()
+
+    # 4. Паровка — в том же порядке, в каком работали re.sub
+    roles = [_LITERAL] * len(kinds)
+    clean &= _pair_sequential(kinds, roles, "**")
+    clean &= _pair_sequential(kinds, roles, "__")
+    _pair_italic(prose, kinds, starts, ends, roles, "*", "**")
+    _pair_italic(prose, kinds, starts, ends, roles, "_", "__")
+    clean &= _pair_sequential(kinds, roles, "~~")
+
+    # 5. События
+    events: list[tuple] = []
+    has_pre = False
+    code_idx = 0
+    pos = 0
+    for i, kind in enumerate(kinds):
+        start = starts[i]
+        if start > pos:
+            events.append((_EV_TEXT, prose[pos:start]))
+        pos = ends[i]
+        if kind == _CODE_MARK:
+            is_pre, html = codes[code_idx]
+            code_idx += 1
+            if is_pre:
+                has_pre = True
+                events.append((_EV_PRE, html))
+            else:
+                events.append((_EV_TEXT, html))
+        elif kind in _MARK_EVENTS:
+            tag, is_open = _MARK_EVENTS[kind]
+            events.append((_EV_OPEN, tag, f"<{tag}>") if is_open else (_EV_CLOSE, tag))
+        elif kind == "[":
+            events.append((_EV_OPEN, "a", f'<a href="{urls[i]}">'))
+        elif kind == "]":
+            events.append((_EV_CLOSE, "a"))
+        elif roles[i] == _OPEN:
+            tag = _PAIRED_TAGS[kind]
+            events.append((_EV_OPEN, tag, f"<{tag}>"))
+        elif roles[i] == _CLOSE:
+            events.append((_EV_CLOSE, _PAIRED_TAGS[kind]))
+        else:
+            events.append((_EV_TEXT, kind))
+    if pos < len(prose):
+        events.append((_EV_TEXT, prose[pos:]))
+
+    if has_pre:
+        clean &= _strip_bold_wrappers(events, _EV_PRE, lambda ev: ev[0] == _EV_PRE)
+        events = [ev for ev in events if ev[0] != _EV_TEXT or ev[1]]
+    if _QUOTE_OPEN in prose:
+        clean &= _strip_bold_wrappers(
+            events, _EV_OPEN, lambda ev: ev[0] == _EV_CLOSE and ev[1] == "blockquote"
+        )
+
+    # 6. Эмиссия со стеком: открытые без закрытия — закрываем, лишние
+    # закрывающие — выкидываем (то, что раньше делал _validate_and_fix_html)
+    stack: list[str] = []
+    out: list[str] = []
+    for ev in events:
+        typ = ev[0]
+        if typ == _EV_TEXT or typ == _EV_PRE:
+            out.append(ev[1])
+        elif typ == _EV_OPEN:
+            stack.append(ev[1])
+            out.append(ev[2])
+        else:
+            tag = ev[1]
+            if stack and stack[-1] == tag:
+                stack.pop()
+                out.append(f"</{tag}>")
+            elif tag in stack:
+                while stack[-1] != tag:
+                    out.append(f"</{stack.pop()}>")
+                stack.pop()
+                out.append(f"</{tag}>")
+    if stack:
+        clean = False
+        while stack:
+            out.append(f"</{stack.pop()}>")
+    return "".join(out), clean, rich
+
+
+def markdown_to_telegram_html(text: str) -> str:
+    """
+    Конвертирует Markdown в безопасный для Telegram HTML.
+    Гарантирует, что все теги сбалансированы — ключевое для стриминга,
+    где отображаемый текст обрывается посреди тега.
+    """
+    return _render(text)[0]
+
+
+def render_markdown(text: str) -> tuple[str, bool]:
+    """HTML для Telegram и флаг contains_rich_markup — за один проход _render."""
+    html, _clean, rich = _render(text, detect_rich=True)
+    return html, rich
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Инкрементальный рендер для стриминга
+# ────────────────────────────────────────────────────────────────────────────
+# Строки, которые правила выше склеивают с соседней пустой строкой
+# (---, заголовки, >>> цитаты) — по ним резать текст нельзя.
+_UNSAFE_LINE_STARTS = ("#", "-", ">")
+
+# Тело закрытого ```-блока в ещё не закоммиченном хвосте заменено меткой
+# \ue000N\ue001: код непрозрачен для остальной разметки, поэтому рендер
+# хвоста с меткой отличается от рендера с телом только содержимым <pre>.
+_STANDIN_OPEN, _STANDIN_CLOSE = "\ue000", "\ue001"
+_STANDIN_RE = re.compile("\ue000\\d+\ue001")
+_PRE_STANDIN_RE = re.compile("<pre>(\ue000\\d+\ue001)</pre>")
+# Остаток строки после ``` целиком из \w — это язык, тело со следующей строки
+# (как (?:\w*\n)? в _CODE_RE)
+_LANG_RE = re.compile(r"\w*\n")
+
+
+def _is_cut(lines: list[str], i: int, nxt: str) -> bool:
+    """
+    Можно ли резать между lines[:i] и следующей строкой, начинающейся с nxt:
+    markdown_to_telegram_html(левое + правое) равен конкатенации рендеров
+    половин (если в левой нет незакрытых **, ``` и т.п. — это проверяет
+    _render). lines — строки хвоста; закрытый ```-блок с меткой вместо тела
+    входит в ту строку, где он открылся.
+
+    Граница абзаца (левая половина кончается пустой строкой) — правила
+    выше не должны дотягиваться \\s* через пустую строку; граница строки —
+    последняя строка не заголовок, не --- и не >>> (их \\s*$ на конце
+    текста съел бы перевод строки).
+    """
+    if not nxt or nxt.isspace() or nxt == _STANDIN_OPEN:
+        return False
+    last = lines[i - 1]
+    if last == "\n":
+        if nxt in _UNSAFE_LINE_STARTS or i < 2:
+            return False
+        i -= 1
+        last = lines[i - 1]
+        # Строка, закрывающая ```-блок, могла начаться заголовком выше блока —
+        # тогда его \s* съедает пустую строку после кода
+        if "```" in last:
+            return False
+    if len(last) < 2 or last[-2].isspace() or last.lstrip().startswith(_UNSAFE_LINE_STARTS):
+        return False
+    # Пустой заголовок «#» (или «>>>») выше через пустые строки «дотягивается»
+    # \s* до последней строки и съедает перевод строки после неё
+    for j in range(i - 2, -1, -1):
+        line = lines[j].strip()
+        if line:
+            return not (line.startswith(_UNSAFE_LINE_STARTS) and not line.strip("#->"))
+    return True
+
+
+class _Fence:
+    """Тело ```-блока: markdown для text и уже экранированный HTML для <pre>."""
+
+    __slots__ = ("key", "md", "html")
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.md: list[str] = []
+        self.html: list[str] = []
+
+    def add(self, chunk: str) -> None:
+        if chunk:
+            self.md.append(chunk)
+            self.html.append(escape(chunk))
+
+
+class StreamingMarkdownRenderer:
+    """
+    Markdown → Telegram HTML для стриминга: работа flush'а растёт с новым
+    текстом, а не со всем ответом.
+
+    Дельты разбираются по строкам один раз. Закоммиченный префикс (HTML
+    считается один раз) растёт по границам строк и абзацев, после которых
+    не висит незакрытых **, ``` или ~~ — стек открытых тегов там пуст.
+    Внутри ```-блока строки тела сразу экранируются в HTML для <pre>, а в
+    хвосте блок представлен меткой: после закрытия рендер хвоста не
+    проходит по коду заново. Каждый flush рендерит только незакоммиченный
+    хвост — обычно последние строки.
+
+    render() — снимок для промежуточного flush'а: побайтно совпадает с
+    markdown_to_telegram_html(renderer.text), кроме одного: незакрытый
+    ```-блок показан как <pre> (закроется дальше). finish() — финальный
+    HTML, всегда равный markdown_to_telegram_html(renderer.text).
+    """
+
+    __slots__ = (
+        "_stable_md", "_stable_html", "_lines", "_line", "_scan", "_fences", "_open",
+        "_open_prefix", "_open_at", "_head_html", "_pending", "_length", "_keys",
+        "_checked", "_retry_at", "_tail_len", "_plain",
+    )
+
+    def __init__(self) -> None:
+        self._stable_md: list[str] = []
+        self._stable_html = ""
+        # Незакоммиченный хвост: целые строки и текущая недописанная
+        self._lines: list[str] = []
+        self._line = ""
+        self._scan = 0  # до куда в _line уже нет ``` (после закрытого блока)
+        self._fences: dict[str, _Fence] = {}
+        # Открытый ```-блок: текст его строки до тела и позиция ``` в нём
+        self._open: _Fence | None = None
+        self._open_prefix = ""
+        self._open_at = 0
+        self._head_html: str | None = None
+        self._pending: list[str] = []
+        self._length = 0
+        self._keys = 0
+        self._checked = 0  # столько границ строк уже проверено на разрез
+        self._retry_at = 0  # после неудачного коммита — ждём, пока хвост вырастет
+        self._tail_len = 0
+        # Метки или управляющие \x00-\x04 во входе (_render выкидывает их до
+        # поиска ```, и границы блоков сдвигаются) — рендерим целиком, как раньше
+        self._plain = False
+
+    def __len__(self) -> int:
+        return self._length
+
+    def feed(self, delta: str) -> None:
+        if delta:
+            self._pending.append(delta)
+            self._length += len(delta)
+
+    @property
+    def text(self) -> str:
+        """Весь накопленный markdown-текст."""
+        tail = self._expand("".join(self._lines))
+        if self._open is not None:
+            tail += self._expand(self._open_prefix) + "".join(self._open.md) + self._line
+        else:
+            tail += self._expand(self._line)
+        return "".join(self._stable_md) + tail + "".join(self._pending)
+
+    def render(self) -> str:
+        self._consume()
+        if self._plain:
+            return markdown_to_telegram_html(self.text)
+        self._commit()
+        if self._open is None:
+            tail = "".join(self._lines) + self._line
+            return self._stable_html + self._render_compact(tail)[0] if tail else self._stable_html
+        if self._head_html is None:
+            head = "".join(self._lines) + self._open_prefix[:self._open_at]
+            self._head_html = self._render_compact(head)[0] if head else ""
+        body = "".join(self._open.html) + escape(self._line)
+        return f"{self._stable_html}{self._head_html}<pre>{body}</pre>"
+
+    def finish(self) -> str:
+        """Финальный HTML — ровно markdown_to_telegram_html(self.text)."""
+        self._consume()
+        if self._plain:
+            return markdown_to_telegram_html(self.text)
+        if self._open is None:
+            return self.render()
+        # Блок так и не закрылся: ``` остаётся текстом, тело — обычный markdown
+        tail = (
+            self._expand("".join(self._lines))
+            + self._expand(self._open_prefix)
+            + "".join(self._open.md)
+            + self._line
+        )
+        return self._stable_html + markdown_to_telegram_html(tail)
+
+    # ── Разбор по строкам ──
+    def _consume(self) -> None:
+        if not self._pending or self._plain:
+            return
+        data = "".join(self._pending)
+        if _STANDIN_OPEN in data or _STANDIN_CLOSE in data or _MARKS_RE.search(data):
+            self._plain = True
+            return
+        self._pending = []
+        pos = 0
+        while pos < len(data):
+            end = data.find("\n", pos)
+            end = len(data) if end == -1 else end + 1
+            if self._open is not None:
+                rest = self._feed_fence(self._line + data[pos:end])
+                if rest:
+                    # Блок закрылся посреди строки — остаток разбираем как текст
+                    data = rest + data[end:]
+                    pos = 0
+                    continue
+            else:
+                self._feed_line(self._line + data[pos:end])
+            pos = end
+
+    def _feed_fence(self, line: str) -> str:
+        """Строка тела открытого блока; возвращает текст после закрывающего ```."""
+        fence = self._open
+        close = line.find("```")
+        if close == -1:
+            if line.endswith("\n"):
+                fence.add(line)
+                self._line = ""
+            else:
+                self._line = line
+            return ""
+        fence.add(line[:close])
+        self._fences[fence.key] = fence
+        self._open = None
+        self._head_html = None
+        self._line = f"{self._open_prefix}{fence.key}```"
+        self._scan = len(self._line)
+        return line[close + 3:]
+
+    def _feed_line(self, line: str) -> None:
+        if not line.endswith("\n"):
+            self._line = line
+            return
+        # Целая строка вне блока: ищем ``` без закрытия на этой же строке
+        pos = self._scan
+        while True:
+            start = line.find("```", pos)
+            if start == -1:
+                self._push_line(line)
+                return
+            close = line.find("```", start + 3)
+            if close == -1:
+                break
+            pos = close + 3
+
+        self._keys += 1
+        fence = _Fence(f"{_STANDIN_OPEN}{self._keys}{_STANDIN_CLOSE}")
+        rest = line[start + 3:]
+        if _LANG_RE.fullmatch(rest):
+            self._open_prefix = line
+        else:
+            self._open_prefix = line[:start + 3]
+            fence.add(rest)
+        self._open = fence
+        self._open_at = start
+        self._head_html = None
+        self._line = ""
+        self._scan = 0
+
+    def _push_line(self, line: str) -> None:
+        self._lines.append(line)
+        self._tail_len += len(line)
+        self._line = ""
+        self._scan = 0
+
+    # ── Коммит ──
+    def _commit(self) -> None:
+        """Коммитит самую дальнюю безопасную границу строки — один рендер."""
+        lines = self._lines
+        nxt = self._open_prefix[:1] if self._open is not None else self._line[:1]
+        last = len(lines)
+        if not nxt and lines:
+            # Границу перед недописанной строкой без её первого символа не проверить
+            last -= 1
+            nxt = lines[-1][:1]
+        if last <= self._checked or self._tail_len < self._retry_at:
+            return
+        cut = 0
+        for i in range(last, self._checked, -1):
+            if _is_cut(lines, i, nxt):
+                cut = i
+                break
+            nxt = lines[i - 1][:1]
+        self._checked = last
+        if not cut:
+            return
+
+        chunk = "".join(lines[:cut])
+        html, clean = self._render_compact(chunk)
+        if not clean:
+            # Незакрытый ** и т.п. — пробуем снова, когда хвост вырастет вдвое:
+            # суммарно такие попытки линейны по длине ответа
+            self._retry_at = 2 * self._tail_len
+            return
+        self._stable_md.append(self._expand(chunk, drop=True))
+        self._stable_html += html
+        del lines[:cut]
+        self._checked -= cut
+        self._tail_len -= len(chunk)
+        self._retry_at = 0
+        self._head_html = None
+
+    # ── Метки ```-блоков ──
+    def _expand(self, text: str, drop: bool = False) -> str:
+        if _STANDIN_OPEN not in text:
+            return text
+        fences = self._fences.pop if drop else self._fences.__getitem__
+        return _STANDIN_RE.sub(lambda m: "".join(fences(m.group()).md), text)
+
+    def _render_compact(self, text: str) -> tuple[str, bool]:
+        """_render хвоста с метками; HTML тел подставляется в их <pre>."""
+        html, clean, _rich = _render(text)
+        if _STANDIN_OPEN not in text:
+            return html, clean
+        expected = len(_STANDIN_RE.findall(text))
+        html, found = _PRE_STANDIN_RE.subn(
+            lambda m: f"<pre>{''.join(self._fences[m.group(1)].html)}</pre>", html
+        )
+        if found != expected or _STANDIN_OPEN in html:
+            # Метка разобралась не как тело блока (экзотика вроде `x```) —
+            # рендерим настоящий текст
+            return _render(self._expand(text))[:2]
+        return html, clean
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Балансировка произвольного HTML
+# ────────────────────────────────────────────────────────────────────────────
+_TAG_SPLIT_RE = re.compile(r"(</?[^>]+>)")
+_OPEN_TAG_RE = re.compile(r"<(\w+)(?:\s[^>]*)?>$")
+_CLOSE_TAG_RE = re.compile(r"</(\w+)>$")
+
+
+def _validate_and_fix_html(html: str) -> str:
+    """
+    Балансирует теги: открытые без закрытия — закрывает, лишние закрывающие — выкидывает.
+    Рендер выше балансирует сам; это — для HTML, собранного не им.
+    """
+    stack: list[str] = []
+    result: list[str] = []
+
+    for part in _TAG_SPLIT_RE.split(html):
+        if not part:
+            continue
+
+        if open_match := _OPEN_TAG_RE.match(part):
+            tag = open_match.group(1).lower()
+            if tag in _ALLOWED_TAGS:
+                stack.append(tag)
+                result.append(part)
+            # неизвестные теги — игнорируем (могут прийти из бредового вывода модели)
+
+        elif close_match := _CLOSE_TAG_RE.match(part):
+            tag = close_match.group(1).lower()
+            if tag not in _ALLOWED_TAGS:
+                continue
+            if stack and stack[-1] == tag:
+                stack.pop()
+                result.append(part)
+            elif tag in stack:
+                # закрываем «через голову» — закрываем всё что выше по стеку
+                while stack and stack[-1] != tag:
+                    result.append(f"</{stack.pop()}>")
+                if stack:
+                    stack.pop()
+                    result.append(part)
+            # лишний закрывающий — игнор
+        else:
+            result.append(part)
+
+    while stack:
+        result.append(f"</{stack.pop()}>")
+    return "".join(result)
@@ -0,0 +1,175 @@
+"""
+Медиа из Telegram — в памяти, а не во временных файлах.
+
+Раньше фото, голосовые и документы скачивались в DOCUMENTS_DIR, потом
+читались обратно через aiofiles (по переходу в thread pool на операцию)
+и удалялись в finally. После падения процесса файлы оставались на диске.
+
+MediaBuffer держит байты в памяти. Лимит Bot API на getFile — 20 MB, так
+что почти всё помещается. На диск уходит только то, что больше
+MEDIA_SPILL_BYTES. Потребители (нормализация картинок, извлечение текста,
+ffmpeg) получают один и тот же буфер без копий: BytesIO(bytes) в CPython
+не копирует данные, memoryview — тем более.
+
+    async with download_media(file_id, size=msg.document.file_size) as media:
+        doc = await extract_text(media, ".pdf")
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from io import BytesIO
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Optional, Sequence
+
+from config.config import bot, MEDIA_SPILL_BYTES, MEDIA_SPILL_DIR
+from utils.logging_helpers import log_timing
+
+logger = logging.getLogger(__name__)
+
+_SPILL_DIR = Path(MEDIA_SPILL_DIR)
+
+
+class MediaBuffer:
+    """Байты одного файла: в памяти или (если большой) во временном файле."""
+
+    __slots__ = ("name", "_data", "_path")
+
+    def __init__(
+        self,
+        name: str = "",
+        *,
+        data: Optional[bytes] = None,
+        path: Optional[Path] = None,
+    ) -> None:
+        self.name = name
+        self._data = data
+        self._path = path
+
+    @property
+    def in_memory(self) -> bool:
+        return self._data is not None
+
+    @property
+    def path(self) -> Optional[Path]:
+        """Файл на диске, если буфер сброшен туда; для буфера в памяти — None."""
+        return self._path
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return self._path.stat().st_size if self._path else 0
+
+    def view(self) -> memoryview:
+        """Zero-copy доступ к байтам. Только для буфера в памяти."""
+        if self._data is None:
+            raise ValueError("MediaBuffer is spilled to disk; use open() or read()")
+        return memoryview(self._data)
+
+    async def read(self) -> bytes:
+        """Все байты. Для буфера в памяти — без копирования и без thread hop."""
+        if self._data is not None:
+            return self._data
+        return await asyncio.to_thread(self._path.read_bytes)
+
+    def open(self) -> BinaryIO:
+        """Синхронный file-like — для PdfReader, Document и т.п. в воркерах."""
+        if self._data is not None:
+            return BytesIO(self._data)
+        return open(self._path, "rb")
+
+    def close(self) -> None:
+        self._data = None
+        if self._path is not None:
+            try:
+                self._path.unlink()
+            except OSError:
+                pass
+            self._path = None
+
+
+@asynccontextmanager
+async def download_media(
+    file_id: str,
+    *,
+    size: Optional[int] = None,
+    name: str = "",
+) -> AsyncIterator[MediaBuffer]:
+    """
+    Скачивает файл из Telegram в MediaBuffer и гарантированно освобождает его.
+    size — file_size из сообщения, если известен: по нему решаем, в память или на диск.
+    """
+    media = await _download(file_id, size=size, name=name)
+    try:
+        yield media
+    finally:
+        media.close()
+
+
+@asynccontextmanager
+async def download_media_group(
+    files: Sequence[tuple[str, Optional[int]]],
+    *,
+    name: str = "",
+) -> AsyncIterator[list[MediaBuffer]]:
+    """
+    Параллельно скачивает несколько файлов (file_id, file_size) — для альбомов.
+    Если хоть один не скачался, уже скачанные освобождаются, ошибка пробрасывается.
+    """
+    results = await asyncio.gather(
+        *(_download(file_id, size=size, name=name) for file_id, size in files),
+        return_exceptions=True,
+    )
+    media = [r for r in results if isinstance(r, MediaBuffer)]
+    try:
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+        yield media
+    finally:
+        for m in media:
+            m.close()
+
+
+async def _download(file_id: str, *, size: Optional[int], name: str) -> MediaBuffer:
+    file = await bot.get_file(file_id)
+    size = size or file.file_size or 0
+    spill = size > MEDIA_SPILL_BYTES
+
+    async with log_timing("telegram.download", kb=size // 1024, spill=spill, name=name):
+        if spill:
+            _SPILL_DIR.mkdir(exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=_SPILL_DIR, suffix=Path(file.file_path or "").suffix)
+            os.close(fd)
+            try:
+                await bot.download_file(file.file_path, tmp)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+            return MediaBuffer(name, path=Path(tmp))
+
+        buf = BytesIO()
+        await bot.download_file(file.file_path, buf)
+        return MediaBuffer(name, data=buf.getvalue())
+
+
+def cleanup_spill_dir(max_age: float = 3600) -> None:
+    """Удаляет файлы, оставшиеся от упавших процессов. Вызывается на старте."""
+    if not _SPILL_DIR.is_dir():
+        return
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in _SPILL_DIR.iterdir():
+        try:
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"Removed {removed} stale media files from {_SPILL_DIR}")
@@ -0,0 +1,247 @@
+"""
+Кэш извлечённого текста документов и транскрипций голосовых.
+
+Одни и те же PDF, домашки и голосовые пересылают снова и снова, и каждый
+раз файл заново качался, парсился (utils/documents.py) или уходил на
+транскрипцию. Теперь результат лежит в Redis, сжатый zlib, и ищется:
+
+1. По file_unique_id — он одинаков у пересланных копий файла, поэтому
+   попадание пропускает всё: скачивание, парсинг, транскрипцию.
+2. По хэшу содержимого (blake2b) — тот же файл, загруженный заново,
+   получает новый file_unique_id. Скачать его придётся, но парсинг и
+   транскрипция не нужны; file_unique_id запоминается как алиас хэша.
+
+Объём ограничен MEDIA_CACHE_MAX_BYTES (сжатых байт): записи живут в
+LRU-индексе (sorted set по времени доступа), и при превышении бюджета
+самые давно не читанные вытесняются. TTL скользящий — продлевается на
+каждом попадании. Чтение и запись — по одному Lua-скрипту, атомарно.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import time
+import zlib
+from collections import Counter
+from typing import TYPE_CHECKING, Optional
+
+from config.config import MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_TTL, USE_MEDIA_CACHE, redis
+from utils.logging_helpers import log_event
+
+if TYPE_CHECKING:
+    from utils.media import MediaBuffer
+
+logger = logging.getLogger(__name__)
+
+# Версия формата/моделей: смена модели транскрипции или экстрактора —
+# повод поднять, чтобы не отдавать результаты старой
+_PREFIX = "mcache:v1:"
+_LRU_KEY = _PREFIX + "lru"
+_SIZES_KEY = _PREFIX + "sizes"
+_BYTES_KEY = _PREFIX + "bytes"
+
+# Файлы крупнее хэшируем в thread pool: hashlib отпускает GIL
+_HASH_INLINE_BYTES = 1024 * 1024
+
+# KEYS: 1 — запись или алиас, 2 — LRU zset
+# ARGV: 1 — now_ms, 2 — ttl_s, 3 — префикс записи, если KEYS[1] — алиас, иначе ''
+_GET_LUA = """
+local key = KEYS[1]
+if ARGV[3] ~= '' then
+  local digest = redis.call('GET', key)
+  if not digest then return false end
+  redis.call('EXPIRE', key, ARGV[2])
+  key = ARGV[3] .. digest
+end
+local v = redis.call('HMGET', key, 'data', 'src')
+if not v[1] then return false end
+redis.call('EXPIRE', key, ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[1], key)
+return v
+"""
+
+# KEYS: 1 — запись, 2 — LRU zset, 3 — размеры записей (hash), 4 — суммарный объём
+# ARGV: 1 — сжатые данные, 2 — размер исходника, 3 — now_ms, 4 — ttl_s, 5 — бюджет
+# Возвращает {объём после вытеснения, сколько записей вытеснено}
+_PUT_LUA = """
+local key = KEYS[1]
+local size = string.len(ARGV[1])
+local old = tonumber(redis.call('HGET', KEYS[3], key) or '0')
+redis.call('HSET', key, 'data', ARGV[1], 'src', ARGV[2])
+redis.call('EXPIRE', key, ARGV[4])
+redis.call('ZADD', KEYS[2], ARGV[3], key)
+redis.call('HSET', KEYS[3], key, size)
+local total = redis.call('INCRBY', KEYS[4], size - old)
+local evicted = 0
+
+local function drop(victim)
+  total = total - tonumber(redis.call('HGET', KEYS[3], victim) or '0')
+  redis.call('HDEL', KEYS[3], victim)
+  redis.call('ZREM', KEYS[2], victim)
+  redis.call('DEL', victim)
+  evicted = evicted + 1
+end
+
+-- Истёкшие по TTL: ключа уже нет, но объём ещё числится
+local cutoff = tonumber(ARGV[3]) - tonumber(ARGV[4]) * 1000
+for _, victim in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', cutoff)) do
+  drop(victim)
+end
+-- LRU: самые давно не читанные, пока не влезем в бюджет
+while total > tonumber(ARGV[5]) do
+  local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+  if #oldest == 0 or oldest[1] == key then break end
+  drop(oldest[1])
+end
+redis.call('SET', KEYS[4], total)
+return {total, evicted}
+"""
+
+_get_script = redis.register_script(_GET_LUA)
+_put_script = redis.register_script(_PUT_LUA)
+
+
+def _entry_key(kind: str, digest: str) -> str:
+    return f"{_PREFIX}{kind}:{digest}"
+
+
+def _alias_key(kind: str, file_unique_id: str) -> str:
+    return f"{_PREFIX}{kind}:id:{file_unique_id}"
+
+
+def _digest_sync(media: MediaBuffer) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    if media.in_memory:
+        h.update(media.view())
+    else:
+        with media.open() as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+async def content_digest(media: MediaBuffer) -> str:
+    """Хэш содержимого буфера — ключ кэша, если file_unique_id ещё не встречался."""
+    if media.in_memory and media.size <= _HASH_INLINE_BYTES:
+        return _digest_sync(media)
+    return await asyncio.to_thread(_digest_sync, media)
+
+
+class MediaCache:
+    """
+    kind — пространство ключей: "doc" (текст документа), "voice" (транскрипт).
+    Ошибки Redis не пробрасываются: кэш недоступен — значит промах.
+    """
+
+    # Счётчики процесса по kind; наружу — bot_media_cache в /metrics (main.py)
+    STATS = ("hits_id", "hits_content", "misses", "bytes_saved", "evicted")
+
+    def __init__(self) -> None:
+        # kind → stat → значение; bytes_saved — исходных байт, которые не
+        # пришлось качать, evicted — вытеснено записью этого kind
+        self._stats: dict[str, Counter[str]] = {}
+
+    def _count(self, kind: str, stat: str, value: int = 1) -> None:
+        self._stats.setdefault(kind, Counter())[stat] += value
+
+    async def get(self, kind: str, file_unique_id: str) -> Optional[str]:
+        """Поиск по file_unique_id. Попадание — файл можно не скачивать."""
+        found = await self._get(
+            _alias_key(kind, file_unique_id), f"{_PREFIX}{kind}:"
+        )
+        if found is None:
+            return None
+        text, src_size = found
+        self._count(kind, "hits_id")
+        self._count(kind, "bytes_saved", src_size)
+        log_event("media_cache.hit", kind=kind, by="id", src_kb=src_size // 1024)
+        return text
+
+    async def get_content(
+        self, kind: str, digest: str, *, file_unique_id: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Поиск по хэшу уже скачанного файла. При попадании file_unique_id
+        становится алиасом — следующая пересылка найдётся без скачивания.
+        """
+        found = await self._get(_entry_key(kind, digest), "")
+        if found is None:
+            self._count(kind, "misses")
+            log_event("media_cache.miss", kind=kind)
+            return None
+        text, src_size = found
+        self._count(kind, "hits_content")
+        log_event("media_cache.hit", kind=kind, by="content", src_kb=src_size // 1024)
+        if file_unique_id:
+            await self._link(kind, file_unique_id, digest)
+        return text
+
+    async def put(
+        self,
+        kind: str,
+        digest: str,
+        text: str,
+        *,
+        file_unique_id: Optional[str] = None,
+        source_size: int = 0,
+    ) -> None:
+        if not USE_MEDIA_CACHE or not text.strip():
+            return
+        data = zlib.compress(text.encode("utf-8"), 6)
+        try:
+            total, evicted = await _put_script(
+                keys=[_entry_key(kind, digest), _LRU_KEY, _SIZES_KEY, _BYTES_KEY],
+                args=[data, source_size, int(time.time() * 1000), MEDIA_CACHE_TTL, MEDIA_CACHE_MAX_BYTES],
+            )
+        except Exception as e:
+            logger.debug(f"Media cache write failed: {e}")
+            return
+        if file_unique_id:
+            await self._link(kind, file_unique_id, digest)
+        self._count(kind, "evicted", int(evicted))
+        log_event(
+            "media_cache.stored",
+            kind=kind,
+            chars=len(text),
+            kb=len(data) // 1024,
+            src_kb=source_size // 1024,
+            total_kb=int(total) // 1024,
+            evicted=int(evicted),
+        )
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """kind → {stat: значение} по всем STATS, с момента старта процесса."""
+        return {
+            kind: {stat: counts[stat] for stat in self.STATS}
+            for kind, counts in self._stats.items()
+        }
+
+    async def _get(self, key: str, entry_prefix: str) -> Optional[tuple[str, int]]:
+        if not USE_MEDIA_CACHE:
+            return None
+        try:
+            found = await _get_script(
+                keys=[key, _LRU_KEY],
+                args=[int(time.time() * 1000), MEDIA_CACHE_TTL, entry_prefix],
+            )
+        except Exception as e:
+            logger.debug(f"Media cache read failed: {e}")
+            return None
+        if not found:
+            return None
+        data, src = found
+        try:
+            return zlib.decompress(data).decode("utf-8"), int(src or 0)
+        except (zlib.error, UnicodeDecodeError, ValueError) as e:
+            logger.warning(f"Corrupted media cache entry {key}: {e}")
+            return None
+
+    async def _link(self, kind: str, file_unique_id: str, digest: str) -> None:
+        try:
+            await redis.set(_alias_key(kind, file_unique_id), digest, ex=MEDIA_CACHE_TTL)
+        except Exception as e:
+            logger.debug(f"Media cache alias write failed: {e}")
+
+
+media_cache = MediaCache()
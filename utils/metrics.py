@@ -0,0 +1,277 @@
+"""
+Метрики процесса в формате Prometheus (text exposition 0.0.4).
+
+До этого про задержки мы узнавали только из логов — grep по «✓ … OK (…ms)»
+и ручной подсчёт. Теперь:
+
+- log_timing пишет длительность каждой операции в гистограмму
+  bot_operation_seconds{op, status} — перцентили по стадиям считает
+  Prometheus (histogram_quantile);
+- log_event увеличивает bot_events_total{event}, а числовые поля из
+  EVENT_SUM_FIELDS (chunks, edits, chars) суммируются в
+  bot_event_field_total{event, field};
+- gauge'и (активные задачи, пулы httpx и Redis) не хранятся, а
+  вычисляются колбэками в момент scrape'а — регистрирует их main.py.
+
+Реестр свой, без prometheus_client: нам нужны три типа метрик, а
+однопоточный asyncio избавляет от блокировок. Модуль без зависимостей от
+config — его импортирует logging_helpers.
+"""
+from __future__ import annotations
+
+import logging
+import math
+from bisect import bisect_left
+from typing import Any, Callable, Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Покрывают и Redis (~мс), и ответы модели (десятки секунд)
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0,
+)
+
+# Поля log_event, которые имеет смысл суммировать (user=… и т.п. — нет)
+EVENT_SUM_FIELDS = frozenset({"chunks", "edits", "chars"})
+
+_LE_INF = 'le="+Inf"'
+
+Labels = tuple[str, ...]
+GaugeValue = Union[float, dict[Labels, float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Labels = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+
+    def _key(self, labels: dict[str, Any]) -> Labels:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Labels = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        # key → [счётчики по bucket'ам (не кумулятивные) + переполнение, сумма]
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _LE_INF)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """Значение считается при каждом scrape'е: число или {метки: значение}."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        fn: Callable[[], GaugeValue],
+        labelnames: Labels = (),
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def samples(self) -> list[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} failed: {e}")
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(float(v))}"
+            for key, v in value.items()
+        ]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"metric {metric.name} already registered as {existing.kind}")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Labels = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help_text: str,
+        fn: Callable[[], GaugeValue],
+        labelnames: Labels = (),
+    ) -> CallbackGauge:
+        """Повторная регистрация с тем же именем заменяет колбэк."""
+        metric = CallbackGauge(name, help_text, fn, labelnames)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            samples = metric.samples()
+            if samples:
+                lines.extend(metric.header())
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+operation_seconds = registry.histogram(
+    "bot_operation_seconds",
+    "Duration of operations wrapped in log_timing",
+    ("op", "status"),
+)
+events_total = registry.counter(
+    "bot_events_total",
+    "Events reported via log_event",
+    ("event",),
+)
+event_field_total = registry.counter(
+    "bot_event_field_total",
+    "Sum of numeric log_event fields (chunks, edits, chars)",
+    ("event", "field"),
+)
+
+
+def record_event(name: str, fields: dict[str, Any]) -> None:
+    events_total.inc(event=name)
+    for field in EVENT_SUM_FIELDS.intersection(fields):
+        value = fields[field]
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            event_field_total.inc(value, event=name, field=field)
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Пулы соединений — внутренности httpx/httpcore и redis-py читаем через
+# getattr: это не публичный API, и при его смене gauge просто пропадёт.
+# ────────────────────────────────────────────────────────────────────────────
+def httpx_pool_usage(client: Any) -> Optional[dict[str, int]]:
+    """
+    {"in_use", "idle", "queued"} для httpx.AsyncClient или None.
+
+    С proxy= запросы идут не через client._transport, а через транспорт
+    из client._mounts (там свой пул) — суммируем по всем транспортам.
+    """
+    transports = [getattr(client, "_transport", None)]
+    transports.extend((getattr(client, "_mounts", None) or {}).values())
+    usage: Optional[dict[str, int]] = None
+    seen: set[int] = set()
+    for transport in transports:
+        pool = getattr(transport, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None or id(pool) in seen:
+            continue
+        seen.add(id(pool))
+        in_use = sum(1 for c in connections if not c.is_idle())
+        if usage is None:
+            usage = {"in_use": 0, "idle": 0, "queued": 0}
+        usage["in_use"] += in_use
+        usage["idle"] += len(connections) - in_use
+        usage["queued"] += max(0, len(getattr(pool, "_requests", ())) - in_use)
+    return usage
+
+
+def redis_pool_usage(redis: Any) -> Optional[dict[str, int]]:
+    """{"in_use", "idle", "max"} для redis.asyncio.Redis или None."""
+    pool = getattr(redis, "connection_pool", None)
+    in_use = getattr(pool, "_in_use_connections", None)
+    available = getattr(pool, "_available_connections", None)
+    if in_use is None or available is None:
+        return None
+    return {"in_use": len(in_use), "idle": len(available), "max": pool.max_connections}
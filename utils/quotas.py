@@ -0,0 +1,281 @@
+"""
+Квоты на пользователя: запросы, токены и секунды голосовых.
+
+user_lock пускает один запрос пользователя за раз, но не ограничивает
+их число: один аккаунт может часами слать запросы подряд и забирать
+заметную долю upstream'а — остальные ждут в очереди admission control.
+
+Теперь перед работой запрос списывает стоимость из квот:
+
+- requests      — 1 за запрос (process_content);
+- tokens        — сразу оценка (текст запроса + QUOTA_TOKEN_RESERVE), после
+                  стрима разница с usage из финального чанка досписывается
+                  или возвращается (settle);
+- media_seconds — длительность голосового, до транскрипции.
+
+Модель так и не вызывалась (анализ упал, очередь полна, ответ из кэша,
+отмена до открытия стрима, Whisper не ответил) — release() возвращает
+оценку токенов и секунды голосового целиком. Счётчик requests остаётся:
+это число попыток, а не работы модели.
+
+Лимиты — по tier'у пользователя (QUOTA_TIERS), несколько окон на ресурс
+(минута/час/сутки) и, опционально, общие окна на весь tier
+(QUOTA_TIER_TOTALS).
+
+Окна скользящие, в приближении двух корзин: счётчик текущей корзины
+фиксированного окна плюс счётчик предыдущей с весом «какая её доля ещё
+внутри окна». Память — два ключа на окно, сколько бы запросов ни было.
+Проверка всех правил и списание — один Lua-скрипт: либо списано всё,
+либо ничего, и две реплики не спишут последний остаток квоты дважды.
+Время берётся из Redis (TIME), поэтому часы реплик на окна не влияют.
+
+Ошибки Redis не пробрасываются: квоты недоступны — запрос пропускается.
+"""
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from config.config import (
+    QUOTA_TIER_TOTALS,
+    QUOTA_TIER_USERS,
+    QUOTA_TIERS,
+    QUOTA_TOKEN_RESERVE,
+    USE_QUOTAS,
+    redis,
+)
+from utils.logging_helpers import log_event
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = "quota:v1:"
+_DEFAULT_TIER = "free"
+
+# KEYS[i] — база ключей правила i (корзины — base:номер)
+# ARGV[1] — 1: проверять лимиты, 0: только списать (settle)
+# ARGV[3i-1], ARGV[3i], ARGV[3i+1] — окно (мс), лимит, списание правила i
+# Возвращает {0, 0} — списано; {i, мс до освобождения} — правило i не пускает
+# (-1 — не пустит никогда: списание больше лимита)
+_CHARGE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local check = ARGV[1] == '1'
+local charged = {}
+for i, base in ipairs(KEYS) do
+  local window = tonumber(ARGV[3 * i - 1])
+  local limit = tonumber(ARGV[3 * i])
+  local cost = tonumber(ARGV[3 * i + 1])
+  local bucket = math.floor(now / window)
+  local elapsed = (now - bucket * window) / window
+  local key = base .. ':' .. bucket
+  if check then
+    local cur = tonumber(redis.call('GET', key) or '0')
+    local prev = tonumber(redis.call('GET', base .. ':' .. (bucket - 1)) or '0')
+    if prev * (1 - elapsed) + cur + cost > limit then
+      if cost > limit then return {i, -1} end
+      local room = limit - cost - cur
+      local wait
+      if room >= 0 then
+        -- Хватит, когда предыдущая корзина уйдёт из окна настолько, чтобы влезть
+        wait = (1 - room / prev - elapsed) * window
+      else
+        -- Не влезаем даже в текущую корзину — ждём, пока она станет предыдущей
+        wait = (1 - elapsed) * window + math.max(0, 1 - (limit - cost) / cur) * window
+      end
+      return {i, math.ceil(wait)}
+    end
+  end
+  charged[i] = {key, cost, window}
+end
+for _, c in ipairs(charged) do
+  if c[2] ~= 0 then
+    if redis.call('INCRBY', c[1], c[2]) < 0 then
+      redis.call('SET', c[1], 0)
+    end
+    redis.call('PEXPIRE', c[1], 2 * c[3])
+  end
+end
+return {0, 0}
+"""
+
+_charge_script = redis.register_script(_CHARGE_LUA)
+
+
+@dataclass(frozen=True)
+class _Rule:
+    scope: str  # "user" или "tier"
+    resource: str
+    window: int  # сек
+    limit: int
+
+
+def _rules(table: dict[str, dict[Any, int]], scope: str) -> list[_Rule]:
+    # Окна из env.json приходят строками
+    return [
+        _Rule(scope, resource, int(window), int(limit))
+        for resource, windows in table.items()
+        for window, limit in windows.items()
+    ]
+
+
+class QuotaExceeded(Exception):
+    """Запрос не влезает в квоту; retry_after — через сколько сек влезет (None — никогда)."""
+
+    def __init__(self, rule: _Rule, retry_after: Optional[float]) -> None:
+        super().__init__(f"{rule.scope} quota {rule.resource}/{rule.window}s exceeded")
+        self.scope = rule.scope
+        self.resource = rule.resource
+        self.window = rule.window
+        self.retry_after = retry_after
+
+
+@dataclass
+class Charge:
+    """Что списано за запрос — для settle() по usage или release()."""
+
+    user_id: int
+    tier: str
+    tokens: int
+    media_seconds: int = 0
+    settled: bool = False  # settle/release уже были — второй раз не трогаем
+
+
+class Quotas:
+    def __init__(self) -> None:
+        self._tier_of: dict[int, str] = {}
+        for tier, user_ids in QUOTA_TIER_USERS.items():
+            if tier not in QUOTA_TIERS:
+                logger.warning(f"QUOTA_TIER_USERS: unknown tier {tier!r}, users stay on {_DEFAULT_TIER}")
+                continue
+            for user_id in user_ids:
+                self._tier_of[int(user_id)] = tier
+        self._user_rules = {tier: _rules(table, "user") for tier, table in QUOTA_TIERS.items()}
+        self._tier_rules = {tier: _rules(table, "tier") for tier, table in QUOTA_TIER_TOTALS.items()}
+        self.denied = 0
+
+    def tier(self, user_id: int) -> str:
+        return self._tier_of.get(user_id, _DEFAULT_TIER)
+
+    def _key(self, rule: _Rule, user_id: int, tier: str) -> str:
+        owner = f"u:{user_id}" if rule.scope == "user" else f"t:{tier}"
+        return f"{_PREFIX}{owner}:{rule.resource}:{rule.window}"
+
+    async def _run(self, user_id: int, tier: str, costs: dict[str, int], check: bool) -> None:
+        rules = [
+            rule
+            for rule in self._user_rules.get(tier, []) + self._tier_rules.get(tier, [])
+            if costs.get(rule.resource)
+        ]
+        if not rules:
+            return
+        args: list[Any] = [1 if check else 0]
+        for rule in rules:
+            args += [rule.window * 1000, rule.limit, costs[rule.resource]]
+        try:
+            index, wait_ms = await _charge_script(
+                keys=[self._key(rule, user_id, tier) for rule in rules], args=args
+            )
+        except Exception as e:
+            logger.warning(f"Quota check failed for {user_id}, allowing: {e}")
+            return
+        if not index:
+            return
+
+        rule = rules[int(index) - 1]
+        self.denied += 1
+        log_event(
+            "quota.denied",
+            user=user_id,
+            tier=tier,
+            scope=rule.scope,
+            resource=rule.resource,
+            window=rule.window,
+            retry_s=int(wait_ms) // 1000 if int(wait_ms) >= 0 else None,
+        )
+        raise QuotaExceeded(rule, int(wait_ms) / 1000 if int(wait_ms) >= 0 else None)
+
+    async def charge(
+        self, user_id: int, *, content: Optional[str] = None, media_seconds: int = 0
+    ) -> Optional[Charge]:
+        """
+        Проверяет и списывает одним вызовом скрипта. content — запрос к
+        модели (1 запрос + оценка токенов), media_seconds — голосовое.
+        QuotaExceeded — ничего не списано.
+        """
+        if not USE_QUOTAS:
+            return None
+        tier = self.tier(user_id)
+        costs = {"media_seconds": media_seconds}
+        tokens = 0
+        if content is not None:
+            tokens = count_tokens(content) + QUOTA_TOKEN_RESERVE
+            costs.update(requests=1, tokens=tokens)
+        await self._run(user_id, tier, costs, check=True)
+        return Charge(user_id, tier, tokens, media_seconds)
+
+    async def settle(self, charge: Optional[Charge], usage: Any) -> None:
+        """
+        Досписывает разницу между оценкой и usage.total_tokens. Нет usage
+        (обрыв стрима, провайдер его не прислал) — остаётся оценка.
+        """
+        if charge is None or charge.settled:
+            return
+        charge.settled = True
+        total = getattr(usage, "total_tokens", None)
+        if total is None:
+            return
+        delta = int(total) - charge.tokens
+        if delta:
+            await self._run(charge.user_id, charge.tier, {"tokens": delta}, check=False)
+        log_event("quota.settled", user=charge.user_id, estimate=charge.tokens, actual=total)
+
+    async def release(self, charge: Optional[Charge]) -> None:
+        """Модель/Whisper не вызывались — списанные токены и секунды возвращаются."""
+        if charge is None or charge.settled:
+            return
+        charge.settled = True
+        costs = {"tokens": -charge.tokens, "media_seconds": -charge.media_seconds}
+        if any(costs.values()):
+            await self._run(charge.user_id, charge.tier, costs, check=False)
+            log_event(
+                "quota.released",
+                user=charge.user_id,
+                tokens=charge.tokens,
+                media_seconds=charge.media_seconds,
+            )
+
+
+class MeteredStream:
+    """Стрим модели как есть + usage из финального чанка (include_usage)."""
+
+    def __init__(self, stream) -> None:
+        self._stream = stream
+        self._usage = None
+
+    @property
+    def usage(self) -> Any:
+        # Подписчик singleflight (utils/response_cache.py) отдаёт usage сам
+        return self._usage or getattr(self._stream, "usage", None)
+
+    @property
+    def billable(self) -> bool:
+        """False — ответ не от модели за наш счёт (кэш, чужой singleflight-стрим)."""
+        return getattr(self._stream, "billable", True)
+
+    def __aiter__(self) -> MeteredStream:
+        return self
+
+    async def __anext__(self):
+        chunk = await self._stream.__anext__()
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            self._usage = usage
+        return chunk
+
+    async def close(self) -> None:
+        await self._stream.close()
+
+
+quotas = Quotas()
@@ -0,0 +1,235 @@
+"""
+Проактивный планировщик исходящих вызовов Telegram Bot API.
+
+Раньше safe_* обёртки узнавали о флуд-лимите только по факту 429 и спали
+Retry-After секунд — на пике это целые секунды на каждый запрос. Теперь
+каждый вызов сначала проходит через tg_scheduler.acquire():
+
+1. Token bucket'ы: глобальный (~30 сообщений/с на бота), на чат (~1 edit/с
+   в личке) и отдельный, более строгий, для групп (~20 сообщений/мин).
+   Вызов ждёт, пока во всех нужных bucket'ах есть токен.
+2. Вытеснение edit'ов: если для того же сообщения уже ждёт edit, а пришёл
+   новый — старый не отправляется вовсе (acquire() вернёт False). При
+   стриминге так уходит только самый свежий текст, а не очередь устаревших.
+3. Retry-After, если 429 всё же случился, публикуется в Redis-канал
+   tg:retry_after — каждая реплика держит подписку (start() в
+   main.on_startup) и кладёт дедлайн в локальный кэш. Сам acquire() в Redis
+   не ходит: задержка считается и токен берётся без await между ними,
+   иначе две корутины видели один и тот же токен свободным.
+
+Bucket'ы in-memory, на процесс: точное
+распределение квоты между репликами не нужно, общий у них только Retry-After.
+Пока подписка переподключается, чужие 429 до реплики не доходят — она
+узнает о лимите из собственного 429, как и без Redis.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from typing import Hashable, Optional
+
+from config.config import (
+    TG_CHAT_BURST,
+    TG_CHAT_RATE,
+    TG_GLOBAL_RATE,
+    TG_GROUP_RATE,
+    redis,
+)
+from utils.logging_helpers import log_event
+
+logger = logging.getLogger(__name__)
+
+_RETRY_AFTER_CHANNEL = "tg:retry_after"
+
+# Сколько bucket'ов чатов держим, прежде чем выкинуть полностью восстановившиеся
+_MAX_IDLE_BUCKETS = 10_000
+# Сколько помним время последнего 429 чата (дольше оно на темп стрима не влияет)
+_RETRY_MEMORY = 600.0
+
+
+class _TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до появления токена. 0 — можно прямо сейчас."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class TelegramScheduler:
+    """Общая точка троттлинга для всех safe_* обёрток из telegram_helpers."""
+
+    def __init__(self) -> None:
+        self._global = _TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: dict[int, _TokenBucket] = {}
+        # edit_key → поколение последнего ждущего edit'а. Счётчик общий и
+        # монотонный, чтобы проснувшийся старый edit не спутал себя с новым.
+        self._edit_gen: dict[Hashable, int] = {}
+        self._gen = itertools.count(1)
+        # chat_id → monotonic-дедлайн Retry-After, полученного этой репликой
+        self._retry_until: dict[int, float] = {}
+        # chat_id → monotonic-время последнего 429 (для адаптивного flush стрима)
+        self._last_retry_after: dict[int, float] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    async def acquire(self, chat_id: int, *, edit_key: Optional[Hashable] = None) -> bool:
+        """
+        Ждёт, пока вызов для chat_id можно отправить, не нарываясь на 429.
+
+        edit_key — ключ редактируемого сообщения (chat_id, message_id). Если
+        пока мы ждали, для того же ключа пришёл более свежий edit, возвращает
+        False: отправлять этот текст больше не нужно.
+        """
+        gen = None
+        if edit_key is not None:
+            gen = next(self._gen)
+            self._edit_gen[edit_key] = gen
+
+        buckets = (self._global, self._chat_bucket(chat_id))
+        waited = 0.0
+        try:
+            while True:
+                if gen is not None and self._edit_gen.get(edit_key) != gen:
+                    log_event("tg.edit_superseded", chat_id=chat_id, waited_ms=int(waited * 1000))
+                    return False
+
+                # Без await от подсчёта до take(): иначе токен заберёт соседняя корутина
+                now = time.monotonic()
+                delay = max(b.wait_time(now) for b in buckets)
+                delay = max(delay, self._retry_after_left(chat_id, now))
+                if delay <= 0:
+                    for b in buckets:
+                        b.take(now)
+                    if waited:
+                        log_event("tg.throttled", chat_id=chat_id, waited_ms=int(waited * 1000))
+                    return True
+
+                await asyncio.sleep(delay)
+                waited += delay
+        finally:
+            if gen is not None and self._edit_gen.get(edit_key) == gen:
+                del self._edit_gen[edit_key]
+
+    async def report_retry_after(self, chat_id: int, retry_after: float) -> None:
+        """Запоминает 429 для чата локально и рассылает его остальным репликам."""
+        wait = retry_after + random.uniform(0.1, 0.5)
+        now = time.monotonic()
+        self._retry_until[chat_id] = now + wait
+        self._last_retry_after[chat_id] = now
+        logger.warning(f"Telegram flood control for chat {chat_id}: backing off {wait:.1f}s")
+        # Остаток в мс, а не абсолютный дедлайн — не зависим от рассинхрона часов реплик
+        message = json.dumps({"chat": chat_id, "ms": int(wait * 1000)})
+        try:
+            await redis.publish(_RETRY_AFTER_CHANNEL, message)
+        except Exception as e:
+            logger.debug(f"Failed to share Retry-After via redis: {e}")
+
+    def _retry_after_left(self, chat_id: int, now: float) -> float:
+        until = self._retry_until.get(chat_id)
+        if until is None:
+            return 0.0
+        if until > now:
+            return until - now
+        del self._retry_until[chat_id]
+        return 0.0
+
+    # ── Retry-After других реплик ──
+    def start(self) -> None:
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen(), name="tg-retry-after")
+
+    async def stop(self) -> None:
+        if self._listener is None:
+            return
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+        self._listener = None
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(_RETRY_AFTER_CHANNEL)
+                async for message in pubsub.listen():
+                    self._on_shared_retry_after(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Retry-After subscription error, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _on_shared_retry_after(self, data: bytes) -> None:
+        try:
+            message = json.loads(data)
+            chat_id, wait_ms = int(message["chat"]), int(message["ms"])
+        except (ValueError, KeyError, TypeError):
+            logger.debug(f"Malformed Retry-After message {data!r}")
+            return
+        # Своё же сообщение тоже придёт сюда — max() делает его no-op
+        until = time.monotonic() + wait_ms / 1000
+        if until > self._retry_until.get(chat_id, 0.0):
+            self._retry_until[chat_id] = until
+
+    def last_retry_after(self, chat_id: int) -> Optional[float]:
+        """monotonic-время последнего 429 в этом чате (только локальные) или None."""
+        return self._last_retry_after.get(chat_id)
+
+    @staticmethod
+    def chat_interval(chat_id: int) -> float:
+        """Устойчивый интервал между сообщениями в чат, который мы сами себе разрешаем."""
+        return 1 / (TG_GROUP_RATE if chat_id < 0 else TG_CHAT_RATE)
+
+    def _chat_bucket(self, chat_id: int) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_IDLE_BUCKETS:
+                self._prune(time.monotonic())
+            # Отрицательный id — группа/супергруппа/канал: там лимит строже
+            bucket = self._chats[chat_id] = _TokenBucket(1 / self.chat_interval(chat_id), TG_CHAT_BURST)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        """Полный bucket ничем не отличается от нового — его можно забыть."""
+        for chat_id in [cid for cid, b in self._chats.items() if b.is_full(now)]:
+            del self._chats[chat_id]
+        for chat_id in [cid for cid, t in self._last_retry_after.items() if now - t > _RETRY_MEMORY]:
+            del self._last_retry_after[chat_id]
+        for chat_id in [cid for cid, t in self._retry_until.items() if t <= now]:
+            del self._retry_until[chat_id]
+
+
+tg_scheduler = TelegramScheduler()
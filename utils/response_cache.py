@@ -0,0 +1,275 @@
+"""
+Кэш ответов основной модели на запросы без контекста + singleflight.
+
+Популярные первые вопросы (вирусные задачки, одинаковые домашки с фото,
+которые анализатор превратил в один и тот же текст) по многу раз в минуту
+уходили в модель целиком. Теперь, если контекста нет (ни пар, ни
+пересказа) — ответ зависит только от (системный промпт, модель, текст):
+
+1. Готовый ответ лежит в Redis (rcache:v2:{sha256}, zlib, TTL) —
+   отдаём его как стрим из одного чанка. Дальше он идёт обычным путём
+   стриминга/rich-сообщений, UX не меняется.
+2. Такой же запрос прямо сейчас стримится в этом процессе — подписываемся
+   на него (singleflight): один upstream-стрим, каждый ждущий получает те
+   же дельты с самого начала.
+3. Иначе открываем стрим сами. Дельты читает отдельная задача-насос;
+   по завершении без ошибок ответ кладётся в Redis.
+
+Отмена сохраняется: подписчик, чья задача отменена или чей стрим закрыт
+(_close_stream при промахе спекуляции), отписывается; ушёл последний —
+насос отменяется и upstream закрывается.
+
+Объекты, которые возвращает cached_stream(), повторяют ту часть интерфейса
+AsyncStream из openai, которой пользуются хендлеры: async for по чанкам
+с choices[0].delta.content и close().
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import zlib
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from config.config import RESPONSE_CACHE_TTL, USE_RESPONSE_CACHE, redis
+from utils.logging_helpers import log_event
+
+logger = logging.getLogger(__name__)
+
+# v2: ключ больше не схлопывает переводы строк и отступы (см. cache_key)
+_PREFIX = "rcache:v2:"
+
+
+class _Delta(NamedTuple):
+    content: Optional[str]
+
+
+class _Choice(NamedTuple):
+    delta: _Delta
+
+
+class _Chunk(NamedTuple):
+    choices: list[_Choice]
+
+
+def _chunk(text: str) -> _Chunk:
+    return _Chunk([_Choice(_Delta(text))])
+
+
+def _normalize(content: str) -> str:
+    """
+    Нормализация запроса для ключа: только пробелы в конце строк, окончания
+    строк (\r\n → \n) и пустые строки в начале и конце. Переводы строк,
+    отступы и пробелы внутри строки сохраняются — от них зависит смысл кода,
+    таблиц и списков (тот же код с другими отступами — другая программа).
+    """
+    return "\n".join(line.rstrip() for line in content.splitlines()).strip("\n")
+
+
+def cache_key(system_prompt: str, model: str, content: str) -> str:
+    """Ключ по (модель, системный промпт, запрос); запрос — после _normalize."""
+    normalized = _normalize(content)
+    digest = hashlib.sha256(
+        "\x00".join((model, system_prompt, normalized)).encode("utf-8")
+    ).hexdigest()
+    return _PREFIX + digest
+
+
+class _ReplayStream:
+    """Ответ из кэша одним чанком."""
+
+    billable = False  # модель не вызывалась — квота токенов возвращается
+
+    def __init__(self, text: str) -> None:
+        self._text: Optional[str] = text
+
+    def __aiter__(self) -> _ReplayStream:
+        return self
+
+    async def __anext__(self) -> _Chunk:
+        if self._text is None:
+            raise StopAsyncIteration
+        text, self._text = self._text, None
+        return _chunk(text)
+
+    async def close(self) -> None:
+        self._text = None
+
+
+class _Flight:
+    """Один upstream-стрим и накопленные из него дельты."""
+
+    def __init__(self, key: str, open_stream: Callable[[], Awaitable[Any]]) -> None:
+        self.key = key
+        self.deltas: list[str] = []
+        self.usage: Any = None  # из финального чанка upstream'а (include_usage)
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.opened = asyncio.Event()
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(open_stream), name=f"singleflight-{key[-12:]}")
+
+    async def wait_changed(self) -> None:
+        await self._changed.wait()
+
+    def _notify(self) -> None:
+        # Ждущие держат ссылку на старый Event — будим их и заводим новый
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def leave(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done:
+            log_event("response_cache.abandoned", chars=sum(map(len, self.deltas)))
+            self._task.cancel()
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+
+    async def _pump(self, open_stream: Callable[[], Awaitable[Any]]) -> None:
+        upstream = None
+        try:
+            upstream = await open_stream()
+            self.opened.set()
+            async for chunk in upstream:
+                if getattr(chunk, "usage", None) is not None:
+                    self.usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self.deltas.append(chunk.choices[0].delta.content)
+                    self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.opened.set()
+            self._notify()
+            if upstream is not None:
+                with suppress(Exception):
+                    await upstream.close()
+            if self.error is not None and _flights.get(self.key) is self:
+                del _flights[self.key]
+        if self.error is not None:
+            return  # оборванный ответ не кэшируем
+
+        text = "".join(self.deltas)
+        if text.strip():
+            try:
+                await redis.set(self.key, zlib.compress(text.encode("utf-8"), 6), ex=RESPONSE_CACHE_TTL)
+                log_event("response_cache.stored", chars=len(text), subscribers=self.subscribers)
+            except Exception as e:
+                logger.debug(f"Response cache write failed: {e}")
+        # Удаляем после записи в Redis — новые запросы сразу найдут готовый ответ
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+
+
+class _FlightStream:
+    """Подписчик на _Flight: отдаёт дельты с начала, сколько бы их ни накопилось."""
+
+    def __init__(self, flight: _Flight) -> None:
+        self._flight = flight
+        self._pos = 0
+        self._left = False
+        # usage upstream'а — только тому, кто его открыл: квоту за общий
+        # стрим не списываем с каждого подписчика (utils/quotas.py)
+        self._owner = flight.subscribers == 0
+        flight.subscribers += 1
+
+    @property
+    def usage(self) -> Any:
+        return self._flight.usage if self._owner else None
+
+    @property
+    def billable(self) -> bool:
+        return self._owner
+
+    def __aiter__(self) -> _FlightStream:
+        return self
+
+    async def __anext__(self) -> _Chunk:
+        flight = self._flight
+        if self._left:
+            raise StopAsyncIteration
+        try:
+            while self._pos >= len(flight.deltas) and not flight.done:
+                await flight.wait_changed()
+        except asyncio.CancelledError:
+            self._leave()
+            raise
+
+        if self._pos < len(flight.deltas):
+            # Всё, что накопилось с прошлого раза, — одним чанком
+            text = "".join(flight.deltas[self._pos:])
+            self._pos = len(flight.deltas)
+            return _chunk(text)
+
+        self._leave()
+        if flight.error is not None:
+            raise flight.error
+        raise StopAsyncIteration
+
+    async def wait_opened(self) -> None:
+        """Как await create(...): возвращается, когда upstream ответил; ошибку открытия пробрасывает."""
+        try:
+            await self._flight.opened.wait()
+        except asyncio.CancelledError:
+            self._leave()
+            raise
+        if self._flight.error is not None and not self._flight.deltas:
+            self._leave()
+            raise self._flight.error
+
+    async def close(self) -> None:
+        self._leave()
+
+    def _leave(self) -> None:
+        if not self._left:
+            self._left = True
+            self._flight.leave()
+
+
+_flights: dict[str, _Flight] = {}
+
+
+async def cached_stream(
+    system_prompt: str,
+    model: str,
+    content: str,
+    open_stream: Callable[[], Awaitable[Any]],
+):
+    """
+    Стрим ответа для запроса без контекста: из кэша, из уже идущего
+    такого же запроса или новый (open_stream открывает upstream).
+    """
+    if not USE_RESPONSE_CACHE:
+        return await open_stream()
+
+    key = cache_key(system_prompt, model, content)
+    try:
+        raw = await redis.get(key)
+    except Exception as e:
+        logger.debug(f"Response cache read failed: {e}")
+        raw = None
+    if raw is not None:
+        try:
+            text = zlib.decompress(raw).decode("utf-8")
+        except (zlib.error, UnicodeDecodeError) as e:
+            logger.warning(f"Corrupted response cache entry {key}: {e}")
+        else:
+            log_event("response_cache.hit", chars=len(text))
+            return _ReplayStream(text)
+
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = _Flight(key, open_stream)
+        log_event("response_cache.miss", input_chars=len(content))
+    else:
+        log_event("response_cache.joined", subscribers=flight.subscribers + 1)
+
+    subscriber = _FlightStream(flight)
+    await subscriber.wait_opened()
+    return subscriber
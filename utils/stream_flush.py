@@ -0,0 +1,221 @@
+"""
+Когда обновлять стрим-сообщение.
+
+Раньше правило было одно: не чаще TIME_STREAM_UPDATE (в draft-режиме —
+0.5 с) и не меньше STREAM_MIN_CHUNK_SIZE символов за раз. Первый текст
+ждал и интервала, и 50 символов — а воспринимаемая задержка это прежде
+всего время до первого видимого текста.
+
+Политика решает, пора ли обновлять сообщение (ready), и узнаёт, чем
+закончилось каждое обновление (on_flush) — сколько оно заняло и удалось ли.
+
+AdaptiveFlushPolicy:
+- первое обновление — сразу, как только есть хоть какой-то текст;
+- дальше период между обновлениями — наибольшее из:
+    * интервала, который планировщик разрешает этому чату (личка/группа);
+    * времени, за которое при текущей скорости токенов набирается
+      STREAM_FLUSH_TARGET_CHARS новых символов;
+    * STREAM_FLUSH_SEC_PER_KCHAR на каждую 1000 символов сообщения
+      (edit длинного HTML дорог и для Telegram, и для клиента);
+  умноженное на штраф за 429 в этом чате (×2 за каждый новый, тает с каждым
+  успешным обновлением) и зажатое в STREAM_FLUSH_MIN..MAX_INTERVAL;
+- отсчёт идёт от конца прошлого обновления, поэтому из периода вычитается
+  измеренная задержка edit'а (EWMA по процессу, включая ожидание в
+  tg_scheduler) — медленный edit уже «отработал» часть периода.
+
+FixedFlushPolicy — прежнее правило, оставлено для A/B.
+
+make_flush_policy(chat_id) выбирает политику: STREAM_FLUSH_POLICY или, для
+доли STREAM_FLUSH_B_SHARE чатов (стабильно по хэшу chat_id),
+STREAM_FLUSH_POLICY_B. Имя политики пишется в stream.done.
+"""
+from __future__ import annotations
+
+import logging
+import time
+import zlib
+from typing import Optional
+
+from config.config import (
+    STREAM_FLUSH_B_SHARE,
+    STREAM_FLUSH_MAX_INTERVAL,
+    STREAM_FLUSH_MIN_INTERVAL,
+    STREAM_FLUSH_POLICY,
+    STREAM_FLUSH_POLICY_B,
+    STREAM_FLUSH_SEC_PER_KCHAR,
+    STREAM_FLUSH_TARGET_CHARS,
+    STREAM_MAX_CHUNK_SIZE,
+    STREAM_MIN_CHUNK_SIZE,
+    TIME_STREAM_UPDATE,
+)
+from utils.rate_limiter import tg_scheduler
+
+logger = logging.getLogger(__name__)
+
+_LATENCY_ALPHA = 0.2
+# 429 в чате за это время до начала стрима — стартуем уже со штрафом
+_RECENT_RETRY_AFTER = 60.0
+_BACKOFF_MAX = 8.0
+_BACKOFF_DECAY = 0.8
+# Скорость токенов не оцениваем по первым долям секунды — там один чанк
+_RATE_MIN_WINDOW = 0.2
+# Прежний интервал draft-режима для FixedFlushPolicy
+_FIXED_DRAFT_INTERVAL = 0.5
+
+
+class FlushPolicy:
+    """Базовая политика: учёт пришедших символов и прошедших обновлений."""
+
+    name = "base"
+
+    def __init__(self, chat_id: int, *, draft: bool = False) -> None:
+        self.chat_id = chat_id
+        self.draft = draft
+        self.pending_chars = 0  # пришло с последнего обновления
+        self.total_chars = 0
+        self.flushes = 0
+        self.last_flush: Optional[float] = None  # monotonic конца последнего обновления
+        self.first_delta: Optional[float] = None
+
+    def on_delta(self, chars: int) -> None:
+        if self.first_delta is None:
+            self.first_delta = time.monotonic()
+        self.pending_chars += chars
+        self.total_chars += chars
+
+    def ready(self) -> bool:
+        raise NotImplementedError
+
+    def delay(self) -> Optional[float]:
+        """Через сколько ready() станет True без новых дельт; None — только с новыми."""
+        raise NotImplementedError
+
+    def on_flush(self, latency: float, ok: bool) -> None:
+        """Обновление отправлено (ok) или не удалось; latency — сколько заняло."""
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        if ok:
+            self.flushes += 1
+
+    def on_skip(self) -> None:
+        """Показывать нечего (HTML не изменился) — ждём следующих символов."""
+        self.pending_chars = 0
+
+    def _since_flush(self) -> float:
+        if self.last_flush is None:
+            return float("inf")
+        return time.monotonic() - self.last_flush
+
+
+class FixedFlushPolicy(FlushPolicy):
+    """Прежнее правило: STREAM_MAX_CHUNK_SIZE символов или интервал + STREAM_MIN_CHUNK_SIZE."""
+
+    name = "fixed"
+
+    def _interval(self) -> float:
+        return _FIXED_DRAFT_INTERVAL if self.draft else TIME_STREAM_UPDATE
+
+    def ready(self) -> bool:
+        return self.pending_chars >= STREAM_MAX_CHUNK_SIZE or (
+            self._since_flush() >= self._interval() and self.pending_chars >= STREAM_MIN_CHUNK_SIZE
+        )
+
+    def delay(self) -> Optional[float]:
+        if self.pending_chars < STREAM_MIN_CHUNK_SIZE:
+            return None
+        return max(0.0, self._interval() - self._since_flush())
+
+
+class AdaptiveFlushPolicy(FlushPolicy):
+    name = "adaptive"
+
+    # Задержка edit'а — общая для всех стримов процесса: у нового стрима
+    # своих замеров ещё нет, а путь до Telegram у всех один.
+    _latency_ewma: Optional[float] = None
+
+    def __init__(self, chat_id: int, *, draft: bool = False) -> None:
+        super().__init__(chat_id, draft=draft)
+        self._seen_retry_after = tg_scheduler.last_retry_after(chat_id)
+        recent = (
+            self._seen_retry_after is not None
+            and time.monotonic() - self._seen_retry_after < _RECENT_RETRY_AFTER
+        )
+        self.backoff = 2.0 if recent else 1.0
+
+    @classmethod
+    def _record_latency(cls, latency: float) -> None:
+        if cls._latency_ewma is None:
+            cls._latency_ewma = latency
+        else:
+            cls._latency_ewma += _LATENCY_ALPHA * (latency - cls._latency_ewma)
+
+    def _check_retry_after(self) -> None:
+        last = tg_scheduler.last_retry_after(self.chat_id)
+        if last is not None and last != self._seen_retry_after:
+            self._seen_retry_after = last
+            self.backoff = min(_BACKOFF_MAX, self.backoff * 2)
+
+    def _arrival_rate(self) -> Optional[float]:
+        """Символов в секунду с начала стрима."""
+        if self.first_delta is None:
+            return None
+        window = time.monotonic() - self.first_delta
+        if window < _RATE_MIN_WINDOW:
+            return None
+        return self.total_chars / window
+
+    def interval(self) -> float:
+        """Сколько ждать после конца прошлого обновления."""
+        period = tg_scheduler.chat_interval(self.chat_id)
+        rate = self._arrival_rate()
+        if rate:
+            period = max(period, STREAM_FLUSH_TARGET_CHARS / rate)
+        period = max(period, STREAM_FLUSH_SEC_PER_KCHAR * self.total_chars / 1000)
+        period = min(STREAM_FLUSH_MAX_INTERVAL, period * self.backoff)
+        return max(STREAM_FLUSH_MIN_INTERVAL, period - (self._latency_ewma or 0.0))
+
+    def ready(self) -> bool:
+        if self.pending_chars <= 0:
+            return False
+        if self.last_flush is None:
+            return True  # первый текст — сразу
+        self._check_retry_after()
+        return self._since_flush() >= self.interval()
+
+    def delay(self) -> Optional[float]:
+        if self.pending_chars <= 0:
+            return None
+        if self.last_flush is None:
+            return 0.0
+        return max(0.0, self.interval() - self._since_flush())
+
+    def on_flush(self, latency: float, ok: bool) -> None:
+        super().on_flush(latency, ok)
+        self._record_latency(latency)
+        seen = self._seen_retry_after
+        self._check_retry_after()
+        if ok and self._seen_retry_after == seen:
+            self.backoff = max(1.0, self.backoff * _BACKOFF_DECAY)
+
+
+POLICIES: dict[str, type[FlushPolicy]] = {
+    FixedFlushPolicy.name: FixedFlushPolicy,
+    AdaptiveFlushPolicy.name: AdaptiveFlushPolicy,
+}
+
+
+def _in_b_group(chat_id: int) -> bool:
+    if STREAM_FLUSH_B_SHARE <= 0:
+        return False
+    bucket = zlib.crc32(str(chat_id).encode()) % 10_000
+    return bucket < STREAM_FLUSH_B_SHARE * 10_000
+
+
+def make_flush_policy(chat_id: int, *, draft: bool = False) -> FlushPolicy:
+    """Политика обновлений для стрима в chat_id (с учётом A/B-группы чата)."""
+    name = STREAM_FLUSH_POLICY_B if _in_b_group(chat_id) else STREAM_FLUSH_POLICY
+    policy_cls = POLICIES.get(name)
+    if policy_cls is None:
+        logger.warning(f"Unknown stream flush policy {name!r}, using adaptive")
+        policy_cls = AdaptiveFlushPolicy
+    return policy_cls(chat_id, draft=draft)
@@ -0,0 +1,84 @@
+"""
+Чтение стрима модели отдельно от обновления сообщения в Telegram.
+
+Раньше edit_text ждали прямо внутри `async for chunk in stream_response`:
+пока Telegram медленный (а на 429 safe_edit_text спит Retry-After),
+SSE-стрим никто не читал — HTTP-соединение стояло, и провайдер в итоге
+обрывал его по таймауту.
+
+Теперь стрим читает отдельная задача (StreamPump): дельты сразу уходят
+в StreamingMarkdownRenderer и политику flush, а наружу — только «версия»
+накопленного текста. Это канал «последнее значение»: отрисовщик
+просыпается, когда есть что-то новее показанного, и рендерит текущее
+состояние целиком — промежуточные снимки, пришедшие за время edit'а,
+просто пропускаются. Читатель не ждёт отрисовщика никогда.
+
+Отмена: задачу _do_processing отменяет register_task/cancel_task; она
+ждёт внутри отрисовщика, и его finally через aclose() отменяет и
+задачу-читателя, которая закрывает upstream-стрим.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Optional
+
+from utils.markdown import StreamingMarkdownRenderer
+from utils.stream_flush import FlushPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class StreamPump:
+    """Задача-читатель стрима + канал «последнее значение» для отрисовщика."""
+
+    def __init__(self, stream, renderer: StreamingMarkdownRenderer, flush: FlushPolicy) -> None:
+        self.chunks = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._version = 0
+        self._seen = 0
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(
+            self._read(stream, renderer, flush), name="stream-reader"
+        )
+
+    async def _read(self, stream, renderer: StreamingMarkdownRenderer, flush: FlushPolicy) -> None:
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                self.chunks += 1
+                renderer.feed(delta)
+                flush.on_delta(len(delta))
+                self._version += 1
+                self._changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Stream interrupted mid-flight: {e}")
+            self.error = e
+        finally:
+            self.done = True
+            self._changed.set()
+            with suppress(Exception):
+                await stream.close()
+
+    async def wait(self, timeout: Optional[float] = None) -> None:
+        """Ждёт текста новее последнего wait() или конца стрима — не дольше timeout."""
+        if self._version == self._seen and not self.done:
+            self._changed.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._changed.wait(), timeout)
+        self._seen = self._version
+
+    async def aclose(self) -> None:
+        """Останавливает чтение (если ещё идёт) и дожидается закрытия стрима."""
+        if not self._task.done():
+            self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
@@ -0,0 +1,107 @@
+"""
+Кэш статуса подписки на канал.
+
+is_subscribed() раньше делал getChatMember на каждый запрос — лишний
+round-trip в Telegram и лишний токен из rate-limit бюджета чата ещё до
+начала работы. Теперь два уровня:
+
+1. In-process LRU (OrderedDict) с коротким TTL — без сети вообще.
+2. Redis-ключ user:{id}:subscribed (b"1"/b"0") с TTL — общий для реплик.
+
+Кэшируются и «подписан», и «не подписан»; у отрицательного ответа TTL
+короткий, чтобы только что подписавшийся не ждал. Актуальность держат
+chat_member-апдейты канала (handlers/text_file_audio.py) и кнопка
+«Проверить подписку», которая перечитывает статус мимо кэша.
+
+Локальный TTL — это и есть окно, в котором другая реплика может отдать
+устаревший статус после chat_member-апдейта, поэтому он маленький.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config.config import (
+    SUBSCRIPTION_CACHE_LOCAL_SIZE,
+    SUBSCRIPTION_CACHE_LOCAL_TTL,
+    SUBSCRIPTION_CACHE_TTL_NEGATIVE,
+    SUBSCRIPTION_CACHE_TTL_POSITIVE,
+    redis,
+)
+
+logger = logging.getLogger(__name__)
+
+_KEY = "user:{user_id}:subscribed"
+
+
+class SubscriptionCache:
+    """LRU в памяти + Redis TTL. Значения — bool, промах — None."""
+
+    def __init__(self) -> None:
+        # user_id → (subscribed, monotonic-дедлайн)
+        self._local: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+        self.checks = 0
+        self.check_ms_total = 0.0
+
+    async def get(self, user_id: int) -> Optional[bool]:
+        entry = self._local.get(user_id)
+        if entry is not None:
+            subscribed, expires = entry
+            if expires > time.monotonic():
+                self._local.move_to_end(user_id)
+                self.hits_local += 1
+                return subscribed
+            del self._local[user_id]
+
+        try:
+            raw = await redis.get(_KEY.format(user_id=user_id))
+        except Exception as e:
+            logger.debug(f"Subscription cache redis read failed: {e}")
+            raw = None
+        if raw is None:
+            self.misses += 1
+            return None
+
+        self.hits_redis += 1
+        subscribed = raw == b"1"
+        self._remember(user_id, subscribed)
+        return subscribed
+
+    async def set(self, user_id: int, subscribed: bool) -> None:
+        self._remember(user_id, subscribed)
+        ttl = SUBSCRIPTION_CACHE_TTL_POSITIVE if subscribed else SUBSCRIPTION_CACHE_TTL_NEGATIVE
+        try:
+            await redis.set(_KEY.format(user_id=user_id), b"1" if subscribed else b"0", ex=ttl)
+        except Exception as e:
+            logger.debug(f"Subscription cache redis write failed: {e}")
+
+    def record_check(self, elapsed_ms: float) -> None:
+        """Учитывает время реального getChatMember (промах или принудительный refresh)."""
+        self.checks += 1
+        self.check_ms_total += elapsed_ms
+
+    def stats(self) -> dict[str, float]:
+        hits = self.hits_local + self.hits_redis
+        lookups = hits + self.misses
+        return {
+            "hits_local": self.hits_local,
+            "hits_redis": self.hits_redis,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "checks": self.checks,
+            "check_ms_avg": self.check_ms_total / self.checks if self.checks else 0.0,
+        }
+
+    def _remember(self, user_id: int, subscribed: bool) -> None:
+        self._local[user_id] = (subscribed, time.monotonic() + SUBSCRIPTION_CACHE_LOCAL_TTL)
+        self._local.move_to_end(user_id)
+        while len(self._local) > SUBSCRIPTION_CACHE_LOCAL_SIZE:
+            self._local.popitem(last=False)
+
+
+subscription_cache = SubscriptionCache()
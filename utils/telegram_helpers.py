@@ -3,7 +3,9 @@
 
 Главное здесь — обработка двух классов ошибок:
 
-1. TelegramRetryAfter (429 flood control) — ждём и ретраим.
+1. TelegramRetryAfter (429 flood control) — сообщаем планировщику
+   (utils/rate_limiter.py) и ретраим. Сам планировщик не даёт до 429
+   доходить: каждый вызов сперва ждёт токен в tg_scheduler.acquire().
 2. TelegramBadRequest "message is not modified" — нормальная ситуация в конце
    стриминга, игнорируется.
 
@@ -15,7 +17,6 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import random
 from typing import Optional
 
 from aiogram import Bot
@@ -28,6 +29,8 @@ from aiogram.methods import SendMessageDraft
 from aiogram.types import InlineKeyboardMarkup, InputRichMessage, Message
 
 from config.config import MAX_RICH_MESSAGE_LENGTH, MAX_TELEGRAM_MESSAGE_LENGTH
+from utils.markdown import markdown_to_telegram_html
+from utils.rate_limiter import tg_scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -49,18 +52,21 @@ async def safe_edit_text(
 
     reply_markup нужно передавать на КАЖДОМ edit, иначе Telegram удалит кнопку.
     Если reply_markup=None — кнопка будет снята (используется на финальном edit).
+    Если пока этот edit ждал очереди, пришёл более свежий для того же
+    сообщения — этот не отправляется (True: текст доставит следующий).
     """
+    chat_id = message.chat.id
+    edit_key = (chat_id, message.message_id)
     for attempt in range(_MAX_RETRIES):
+        if not await tg_scheduler.acquire(chat_id, edit_key=edit_key):
+            return True
         try:
             await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
             return True
 
         except TelegramRetryAfter as e:
-            wait = e.retry_after + random.uniform(0.1, 0.5)
-            logger.warning(
-                f"edit_text rate limited, sleeping {wait:.1f}s (attempt {attempt + 1})"
-            )
-            await asyncio.sleep(wait)
+            logger.warning(f"edit_text rate limited (attempt {attempt + 1})")
+            await tg_scheduler.report_retry_after(chat_id, e.retry_after)
             continue
 
         except TelegramBadRequest as e:
@@ -93,6 +99,66 @@ async def safe_edit_text(
     return False
 
 
+async def _edit_with_retry(message: Message, what: str, call) -> bool:
+    """
+    Общий цикл для safe_edit_reply_markup / safe_delete: токен планировщика
+    с edit_key сообщения (вытесняет ждущие edit'ы того же сообщения), 429 и
+    сетевые ошибки — retry, BadRequest — False без исключения.
+    """
+    chat_id = message.chat.id
+    edit_key = (chat_id, message.message_id)
+    for attempt in range(_MAX_RETRIES):
+        if not await tg_scheduler.acquire(chat_id, edit_key=edit_key):
+            return True
+        try:
+            await call()
+            return True
+
+        except TelegramRetryAfter as e:
+            logger.warning(f"{what} rate limited (attempt {attempt + 1})")
+            await tg_scheduler.report_retry_after(chat_id, e.retry_after)
+            continue
+
+        except TelegramBadRequest as e:
+            if _NOT_MODIFIED_FRAGMENT in str(e).lower():
+                return True
+            logger.warning(f"{what} BadRequest: {e}")
+            return False
+
+        except TelegramNetworkError as e:
+            logger.warning(f"{what} network error (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(0.5 * (attempt + 1))
+            continue
+
+        except Exception as e:
+            logger.exception(f"{what} unexpected error: {e}")
+            return False
+
+    logger.error(f"{what} failed after {_MAX_RETRIES} attempts")
+    return False
+
+
+async def safe_edit_reply_markup(
+    message: Message,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> bool:
+    """
+    Меняет только клавиатуру (по умолчанию снимает) — через планировщик,
+    как и edit_text: сразу за последним edit'ом стрима это тот же всплеск
+    в чат, и 429 здесь оставил бы [Отменить] под готовым ответом.
+    """
+    return await _edit_with_retry(
+        message,
+        "edit_reply_markup",
+        lambda: message.edit_reply_markup(reply_markup=reply_markup),
+    )
+
+
+async def safe_delete(message: Message) -> bool:
+    """Удаляет сообщение через планировщик; ждущие edit'ы этого сообщения отменяются."""
+    return await _edit_with_retry(message, "delete", message.delete)
+
+
 async def safe_answer(
     message: Message,
     text: str,
@@ -102,16 +168,17 @@ async def safe_answer(
     **kwargs,
 ) -> Optional[Message]:
     """Отправляет ответ с retry. None если не получилось."""
+    chat_id = message.chat.id
     for attempt in range(_MAX_RETRIES):
+        await tg_scheduler.acquire(chat_id)
         try:
             return await message.answer(
                 text, parse_mode=parse_mode, reply_markup=reply_markup, **kwargs
             )
 
         except TelegramRetryAfter as e:
-            wait = e.retry_after + random.uniform(0.1, 0.5)
-            logger.warning(f"answer rate limited, sleeping {wait:.1f}s")
-            await asyncio.sleep(wait)
+            logger.warning(f"answer rate limited (attempt {attempt + 1})")
+            await tg_scheduler.report_retry_after(chat_id, e.retry_after)
             continue
 
         except TelegramBadRequest as e:
@@ -189,6 +256,9 @@ async def send_message_draft(
     parse_mode: Optional[str] = "HTML",
 ) -> bool:
     """Стримит частичное сообщение через sendMessageDraft. False — fallback нужен."""
+    edit_key = ("draft", chat_id, draft_id)
+    if not await tg_scheduler.acquire(chat_id, edit_key=edit_key):
+        return True  # черновик обновит более свежий вызов
     try:
         await bot(SendMessageDraft(
             chat_id=chat_id,
@@ -198,7 +268,9 @@ async def send_message_draft(
         ))
         return True
     except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after + 0.2)
+        await tg_scheduler.report_retry_after(chat_id, e.retry_after)
+        if not await tg_scheduler.acquire(chat_id, edit_key=edit_key):
+            return True
         try:
             await bot(SendMessageDraft(
                 chat_id=chat_id,
@@ -232,15 +304,17 @@ async def safe_answer_rich(
     reply_markup: Optional[InlineKeyboardMarkup] = None,
 ) -> Optional[Message]:
     """Отправляет ответ как Rich Message. При неудаче — fallback на HTML."""
+    chat_id = message.chat.id
+    await tg_scheduler.acquire(chat_id)
     try:
         return await message.answer_rich(
             InputRichMessage(markdown=markdown_text),
             reply_markup=reply_markup,
         )
     except TelegramRetryAfter as e:
-        wait = e.retry_after + random.uniform(0.1, 0.5)
-        logger.warning(f"answer_rich rate limited, sleeping {wait:.1f}s")
-        await asyncio.sleep(wait)
+        logger.warning("answer_rich rate limited")
+        await tg_scheduler.report_retry_after(chat_id, e.retry_after)
+        await tg_scheduler.acquire(chat_id)
         try:
             return await message.answer_rich(
                 InputRichMessage(markdown=markdown_text),
@@ -260,14 +334,21 @@ async def safe_edit_text_rich(
     reply_markup: Optional[InlineKeyboardMarkup] = None,
 ) -> bool:
     """Редактирует сообщение как Rich Message. При неудаче — fallback на HTML edit."""
+    chat_id = message.chat.id
+    if not await tg_scheduler.acquire(chat_id, edit_key=(chat_id, message.message_id)):
+        return True
     try:
         await message.bot.edit_message_text(
-            chat_id=message.chat.id,
+            chat_id=chat_id,
             message_id=message.message_id,
             rich_message=InputRichMessage(markdown=markdown_text),
             reply_markup=reply_markup,
         )
         return True
+    except TelegramRetryAfter as e:
+        # HTML-fallback пройдёт через планировщик и дождётся окончания бана
+        await tg_scheduler.report_retry_after(chat_id, e.retry_after)
+        return await _fallback_html_edit(message, markdown_text, reply_markup)
     except TelegramBadRequest as e:
         msg = str(e).lower()
         if _NOT_MODIFIED_FRAGMENT in msg:
@@ -304,8 +385,6 @@ async def _fallback_html_answer(
     markdown_text: str,
     reply_markup: Optional[InlineKeyboardMarkup],
 ) -> Optional[Message]:
-    from utils.functions import markdown_to_telegram_html  # локальный импорт — избегаем цикла
-
     html = markdown_to_telegram_html(markdown_text)
     return await send_long_text(message, html, parse_mode="HTML", reply_markup=reply_markup)
 
@@ -315,7 +394,5 @@ async def _fallback_html_edit(
     markdown_text: str,
     reply_markup: Optional[InlineKeyboardMarkup],
 ) -> bool:
-    from utils.functions import markdown_to_telegram_html
-
     html = markdown_to_telegram_html(markdown_text)
     return await safe_edit_text(message, html, parse_mode="HTML", reply_markup=reply_markup)
@@ -0,0 +1,63 @@
+"""
+Подсчёт токенов для лимитов входа и бюджета контекста.
+
+Лимиты раньше считались в словах (len(text.split())), а платим мы и ждём
+первого токена — за токены промпта. Русский текст, код и таблицы дают
+очень разное число токенов на слово, так что слова — плохая мера.
+
+Считает tiktoken с кодировкой o200k_base (семейство GPT-4o/GPT-5). Файл
+кодировки скачивается при первом использовании — в Docker-образе он
+загружается на этапе сборки (TIKTOKEN_CACHE_DIR). Если загрузить не
+удалось, работаем на грубой оценке «3 символа на токен» с предупреждением
+в логе — лимиты станут приблизительными, но бот не упадёт.
+
+Модуль без config: им пользуются и воркеры пула документов.
+"""
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+_ENCODING_NAME = "o200k_base"
+_CHARS_PER_TOKEN_FALLBACK = 3
+
+# Длинный текст в exceeds() кодируем кусками, чтобы остановиться на лимите
+_EXCEEDS_SLICE_CHARS = 32 * 1024
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(_ENCODING_NAME)
+    except Exception as e:
+        logger.warning(f"tiktoken encoding {_ENCODING_NAME} unavailable, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _encoding()
+    if enc is None:
+        return -(-len(text) // _CHARS_PER_TOKEN_FALLBACK)
+    return len(enc.encode_ordinary(text))
+
+
+def exceeds(text: str, limit: int) -> bool:
+    """
+    count_tokens(text) > limit, но без кодирования всего текста: токен —
+    минимум один символ, поэтому короткие тексты проверяются по длине,
+    а длинные кодируются кусками до превышения.
+    """
+    if len(text) <= limit:
+        return False
+    total = 0
+    for start in range(0, len(text), _EXCEEDS_SLICE_CHARS):
+        total += count_tokens(text[start:start + _EXCEEDS_SLICE_CHARS])
+        if total > limit:
+            return True
+    return False
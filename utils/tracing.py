@@ -0,0 +1,352 @@
+"""
+Трейсинг запросов: trace_id, вложенные span'ы, JSON-вывод и OTLP.
+
+log_timing-строки анализатора, OpenAI, Whisper, скачиваний и парсинга
+документов ничем не связаны между собой — по логам не понять, какие из
+них относятся к одному апдейту и какая стадия сделала запрос медленным.
+
+Теперь:
+
+- GeneralMiddleware открывает корневой span "update" (start_trace) — новый
+  trace_id кладётся в contextvars. asyncio.create_task копирует контекст,
+  поэтому задача _do_processing (и всё, что она запускает) продолжает тот
+  же trace;
+- каждый log_timing — span с родителем (текущий span из contextvars),
+  log_event — событие внутри текущего span'а;
+- set_stage() помечает стадию пайплайна (analyze / stream / save) — она
+  пишется в span'ы и в обычные строки лога (TraceLogFilter);
+- span'ы выводятся JSON-строкой в логгер "trace" и, если задан
+  OTLP-эндпоинт, пачками уходят в коллектор по OTLP/HTTP (JSON-кодировка,
+  /v1/traces) — отдельный SDK для этого не нужен.
+
+Сэмплирование хвостовое: span'ы trace'а копятся в нём, пока не закроется
+корень, и тогда trace выводится или выбрасывается целиком. Выводится, если
+он попал в sample_rate или хоть один span упал или длился дольше slow_ms, —
+ради таких запросов трейсинг и нужен, и без соседних span'ов упавший мало
+что объясняет. Span'ы фоновых задач, закрывшиеся после корня (пересказ
+контекста и т.п.), идут по уже принятому решению; у выброшенного trace'а
+выводится только сам упавший/медленный поздний span.
+
+Модуль без зависимостей от config (его импортирует logging_helpers, а её —
+воркеры пулов): параметры передаёт main.py через configure().
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager, suppress
+from typing import Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+span_logger = logging.getLogger("trace")
+
+_MAX_EVENTS_PER_SPAN = 32
+# Столько span'ов trace'а держим до решения; остальные не выводятся
+_MAX_SPANS_PER_TRACE = 256
+_OTLP_BATCH = 512
+_OTLP_FLUSH_INTERVAL = 2.0
+# Коллектор недоступен — не копим span'ы в памяти бесконечно
+_OTLP_MAX_QUEUE = 10_000
+
+_sample_rate = 0.0
+_slow_ms = float("inf")
+_service = "simple_boompi"
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_stage: contextvars.ContextVar[str] = contextvars.ContextVar("stage", default="")
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "keep", "closed", "spans", "overflow")
+
+    def __init__(self, sampled: bool) -> None:
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled  # попал в sample_rate
+        self.keep = False  # есть упавший или медленный span
+        self.closed = False  # корень закрыт, решение принято
+        self.spans: list[Span] = []  # закрытые span'ы до решения
+        self.overflow = 0
+
+
+class Span:
+    __slots__ = (
+        "trace", "span_id", "parent_id", "name", "attrs", "stage",
+        "start_ns", "_start", "duration_ms", "status", "error", "events",
+    )
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attrs: dict[str, Any]) -> None:
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.stage = _stage.get()
+        self.start_ns = time.time_ns()
+        self._start = time.monotonic()
+        self.duration_ms = 0.0
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.events: list[tuple[int, str, dict[str, Any]]] = []
+
+    def add_event(self, name: str, attrs: dict[str, Any]) -> None:
+        if len(self.events) < _MAX_EVENTS_PER_SPAN:
+            self.events.append((time.time_ns(), name, attrs))
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "stage": self.stage or None,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 1),
+            "status": self.status,
+            "error": self.error,
+            "sampled": self.trace.sampled,
+            "attrs": {k: _plain(v) for k, v in self.attrs.items()},
+            "events": [
+                {"t": t / 1e9, "name": n, "attrs": {k: _plain(v) for k, v in a.items()}}
+                for t, n, a in self.events
+            ],
+        }
+
+
+def _plain(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def configure(*, sample_rate: float, slow_ms: float, service: str = "simple_boompi") -> None:
+    global _sample_rate, _slow_ms, _service
+    _sample_rate = sample_rate
+    _slow_ms = slow_ms
+    _service = service
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Span'ы
+# ────────────────────────────────────────────────────────────────────────────
+@contextmanager
+def _open(span: Span) -> Iterator[Span]:
+    token = _current_span.set(span)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        span.status = "cancelled"
+        raise
+    except BaseException as e:
+        span.status = "fail"
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        with suppress(ValueError):  # генератор закрыли из чужого контекста (GC)
+            _current_span.reset(token)
+        span.duration_ms = (time.monotonic() - span._start) * 1000
+        _finish(span)
+
+
+def start_trace(name: str, **attrs: Any):
+    """Корневой span нового trace'а (на каждый апдейт)."""
+    trace = Trace(sampled=random.random() < _sample_rate)
+    return _open(Span(trace, name, None, attrs))
+
+
+def span(name: str, **attrs: Any):
+    """Дочерний span текущего; вне trace'а — корень нового."""
+    parent = _current_span.get()
+    if parent is None:
+        return start_trace(name, **attrs)
+    return _open(Span(parent.trace, name, parent.span_id, attrs))
+
+
+def add_event(name: str, attrs: dict[str, Any]) -> None:
+    current = _current_span.get()
+    if current is not None:
+        current.add_event(name, attrs)
+
+
+def set_stage(stage: str) -> None:
+    """Стадия пайплайна для этой задачи и всего, что она дальше запускает."""
+    _stage.set(stage)
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current_span.get()
+    return current.trace.trace_id if current else None
+
+
+class TraceLogFilter(logging.Filter):
+    """Добавляет в записи лога trace_id и stage (для формата %(trace_id)s)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        current = _current_span.get()
+        record.trace_id = current.trace.trace_id[:16] if current else "-"
+        record.stage = _stage.get() or "-"
+        return True
+
+
+def _finish(span: Span) -> None:
+    trace = span.trace
+    notable = span.status == "fail" or span.duration_ms >= _slow_ms
+    if trace.closed:
+        if trace.sampled or trace.keep or notable:
+            _emit(span)
+        return
+    trace.keep |= notable
+    if span.parent_id is not None:
+        if len(trace.spans) < _MAX_SPANS_PER_TRACE:
+            trace.spans.append(span)
+        else:
+            trace.overflow += 1
+        return
+
+    # Закрылся корень — весь trace выводим или выбрасываем
+    trace.closed = True
+    spans, trace.spans = trace.spans, []
+    if not (trace.sampled or trace.keep):
+        return
+    if trace.overflow:
+        span.attrs["spans_dropped"] = trace.overflow
+    for child in spans:
+        _emit(child)
+    _emit(span)
+
+
+def _emit(span: Span) -> None:
+    data = span.to_dict()
+    if span_logger.isEnabledFor(logging.INFO):
+        span_logger.info(json.dumps(data, ensure_ascii=False))
+    if _exporter is not None:
+        _exporter.enqueue(data)
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# OTLP/HTTP (JSON)
+# ────────────────────────────────────────────────────────────────────────────
+_OTLP_STATUS = {"ok": 1, "fail": 2, "cancelled": 0}
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attrs(attrs: dict[str, Any]) -> list[dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attrs.items() if v is not None]
+
+
+def _otlp_span(data: dict[str, Any]) -> dict[str, Any]:
+    start_ns = int(data["start"] * 1e9)
+    attrs = dict(data["attrs"])
+    if data["stage"]:
+        attrs["stage"] = data["stage"]
+    otlp = {
+        "traceId": data["trace_id"],
+        "spanId": data["span_id"],
+        "name": data["name"],
+        "kind": 2 if data["parent_id"] is None else 1,  # SERVER для корня, иначе INTERNAL
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(start_ns + int(data["duration_ms"] * 1e6)),
+        "attributes": _otlp_attrs(attrs),
+        "events": [
+            {"timeUnixNano": str(int(e["t"] * 1e9)), "name": e["name"], "attributes": _otlp_attrs(e["attrs"])}
+            for e in data["events"]
+        ],
+        "status": {"code": _OTLP_STATUS[data["status"]], "message": data["error"] or ""},
+    }
+    if data["parent_id"]:
+        otlp["parentSpanId"] = data["parent_id"]
+    return otlp
+
+
+class _OtlpExporter:
+    def __init__(self, endpoint: str) -> None:
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self._queue: list[dict[str, Any]] = []
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._client = None
+        self.dropped = 0
+
+    def enqueue(self, data: dict[str, Any]) -> None:
+        if len(self._queue) >= _OTLP_MAX_QUEUE:
+            self.dropped += 1
+            return
+        self._queue.append(data)
+        if len(self._queue) >= _OTLP_BATCH:
+            self._wake.set()
+
+    def start(self) -> None:
+        import httpx  # только здесь: воркерам пулов он не нужен
+
+        self._client = httpx.AsyncClient(timeout=5.0)
+        self._task = asyncio.create_task(self._run(), name="otlp-exporter")
+
+    async def _run(self) -> None:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), _OTLP_FLUSH_INTERVAL)
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        while self._queue:
+            batch, self._queue = self._queue[:_OTLP_BATCH], self._queue[_OTLP_BATCH:]
+            payload = {
+                "resourceSpans": [{
+                    "resource": {"attributes": _otlp_attrs({"service.name": _service})},
+                    "scopeSpans": [{
+                        "scope": {"name": "boompi.tracing"},
+                        "spans": [_otlp_span(d) for d in batch],
+                    }],
+                }]
+            }
+            try:
+                response = await self._client.post(self.url, json=payload)
+                response.raise_for_status()
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.debug(f"OTLP export failed ({len(batch)} spans): {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        with suppress(Exception):
+            await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+
+
+_exporter: Optional[_OtlpExporter] = None
+
+
+def start_otlp_exporter(endpoint: str) -> None:
+    """Вызывается из main.on_startup, когда задан OTLP_ENDPOINT."""
+    global _exporter
+    if endpoint and _exporter is None:
+        _exporter = _OtlpExporter(endpoint)
+        _exporter.start()
+        logger.info(f"OTLP trace export → {_exporter.url}")
+
+
+async def shutdown_otlp_exporter() -> None:
+    global _exporter
+    if _exporter is not None:
+        await _exporter.stop()
+        _exporter = None
@@ -2,29 +2,44 @@
 from __future__ import annotations
 
 import asyncio
-import base64
+import json
 import logging
-import os
+import random
 import re
-from io import BytesIO
 from typing import Optional, Tuple, List
 
-import aiofiles
-from PIL import Image
 from openai import AsyncOpenAI
 
 from config.config import (
+    redis,
+    INTENT_AUDIT_RATE,
+    INTENT_CONFIDENCE,
+    INTENT_DECISIONS_MAX,
+    INTENT_MODEL_PATH,
     MAX_IMAGES_PER_REQUEST,
-    MAX_IMAGE_SIZE_MB,
-    MAX_IMAGE_RESOLUTION_MP,
 )
-from utils.logging_helpers import log_timing
+from utils.admission import Overloaded, admission
+from utils.images import normalize_image
+from utils.intent_classifier import DECISIONS_KEY, IntentClassifier
+from utils.logging_helpers import log_event, log_timing
+from utils.media import MediaBuffer
 
 logger = logging.getLogger(__name__)
 
 
 _INTENT_TAG_RE = re.compile(r"<intent>\s*(CODE|TEXT)\s*</intent>", re.IGNORECASE)
 
+_CODE_KEYWORDS = (
+    "напиши код", "write code", "напиши скрипт", "напиши программу",
+    "напиши функцию", "напиши класс", "напиши метод",
+    "сделай сайт", "сделай бота", "сделай приложение",
+    "создай сайт", "создай бота", "создай приложение", "создай скрипт",
+    "на python", "на javascript", "на java", "на c++",
+    "на c#", "на php", "на golang", "на rust", "на typescript",
+    "html код", "css код", "исправь код", "отладь код",
+    "debug", "рефакторинг",
+)
+
 
 class UniversalAnalyzer:
     """Один запрос к Groq: text + images → (wants_code, processed_content)."""
@@ -68,40 +83,30 @@ class UniversalAnalyzer:
 
     def __init__(self, groq_client: AsyncOpenAI):
         self.client = groq_client
-
-    async def _validate_image(self, image_path: str) -> Tuple[bool, str]:
+        # Локальная модель намерения; None — модели нет, всё решает Groq
+        self.classifier = IntentClassifier.load(INTENT_MODEL_PATH, INTENT_CONFIDENCE)
+
+    async def _prepare_image(self, media: MediaBuffer) -> str:
+        """Байты берутся из буфера как есть; decode/resize/encode — в пуле процессов."""
+        data = await media.read()
+        async with log_timing("image.normalize", in_kb=len(data) // 1024):
+            url = await normalize_image(data)
+        log_event("image.normalized", in_kb=len(data) // 1024, out_kb=len(url) // 1024)
+        return url
+
+    async def _record_decision(self, user_text: str, wants_code: bool) -> None:
+        """Решение Groq по тексту → Redis-список, обучающие данные классификатора."""
+        entry = json.dumps(
+            {"text": user_text[:2000], "intent": "CODE" if wants_code else "TEXT"},
+            ensure_ascii=False,
+        )
         try:
-            file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
-            if file_size_mb > MAX_IMAGE_SIZE_MB:
-                return False, f"Размер ({file_size_mb:.1f} MB) превышает {MAX_IMAGE_SIZE_MB} MB"
-
-            async with aiofiles.open(image_path, "rb") as f:
-                data = await f.read()
-
-            def _mp() -> float:
-                with Image.open(BytesIO(data)) as img:
-                    w, h = img.size
-                    return (w * h) / 1_000_000
-
-            megapixels = await asyncio.to_thread(_mp)
-            if megapixels > MAX_IMAGE_RESOLUTION_MP:
-                return False, f"Разрешение ({megapixels:.1f} MP) превышает {MAX_IMAGE_RESOLUTION_MP} MP"
-
-            return True, ""
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.lpush(DECISIONS_KEY, entry)
+                pipe.ltrim(DECISIONS_KEY, 0, INTENT_DECISIONS_MAX - 1)
+                await pipe.execute()
         except Exception as e:
-            logger.error(f"Ошибка валидации {image_path}: {e}")
-            return False, f"Не удалось проверить изображение: {e}"
-
-    async def _encode_image(self, image_path: str) -> str:
-        async with aiofiles.open(image_path, "rb") as f:
-            data = await f.read()
-        b64 = base64.b64encode(data).decode("utf-8")
-        ext = image_path.lower().rsplit(".", 1)[-1]
-        mime = {
-            "jpg": "image/jpeg", "jpeg": "image/jpeg",
-            "png": "image/png", "webp": "image/webp", "gif": "image/gif",
-        }.get(ext, "image/jpeg")
-        return f"data:{mime};base64,{b64}"
+            logger.debug(f"Failed to record analyzer decision: {e}")
 
     def _parse_intent(self, result: str) -> Tuple[Optional[bool], str]:
         """Ищет тег в начале ответа; единый regex для обоих вариантов."""
@@ -117,20 +122,20 @@ class UniversalAnalyzer:
         processed = (result[:match.start()] + result[match.end():]).strip()
         return wants_code, processed
 
+    def guess_intent(self, user_text: str) -> bool:
+        """
+        Дешёвая локальная догадка CODE/TEXT без сети — для спекулятивного
+        старта генерации, пока Groq ещё думает.
+        """
+        if self.classifier is not None:
+            return self.classifier.predict_proba(user_text) >= 0.5
+        text_lower = user_text.lower()
+        return any(kw in text_lower for kw in _CODE_KEYWORDS)
+
     def _fallback_intent(self, user_text: str) -> bool:
         """Безопасный fallback по ключевым словам в запросе пользователя."""
         text_lower = user_text.lower()
-        keywords = [
-            "напиши код", "write code", "напиши скрипт", "напиши программу",
-            "напиши функцию", "напиши класс", "напиши метод",
-            "сделай сайт", "сделай бота", "сделай приложение",
-            "создай сайт", "создай бота", "создай приложение", "создай скрипт",
-            "на python", "на javascript", "на java", "на c++",
-            "на c#", "на php", "на golang", "на rust", "на typescript",
-            "html код", "css код", "исправь код", "отладь код",
-            "debug", "рефакторинг",
-        ]
-        for kw in keywords:
+        for kw in _CODE_KEYWORDS:
             if kw in text_lower:
                 logger.info(f"Fallback: CODE detected by '{kw}'")
                 return True
@@ -140,37 +145,44 @@ class UniversalAnalyzer:
     async def analyze(
         self,
         user_text: str,
-        image_paths: Optional[List[str]] = None,
+        images: Optional[List[MediaBuffer]] = None,
     ) -> Tuple[bool, str]:
-        """Один запрос к Groq → (wants_code, processed_content)."""
+        """
+        Один запрос к Groq → (wants_code, processed_content).
+
+        Текст без картинок сначала пробует локальный классификатор: если он
+        уверен, Groq не нужен вовсе (processed_content для текста и так
+        не используется). Небольшая доля уверенных запросов всё равно идёт
+        в Groq — чтобы для переобучения копилась свежая разметка.
+        """
+        if not images and self.classifier is not None:
+            local = self.classifier.classify(user_text)
+            if local is not None and random.random() >= INTENT_AUDIT_RATE:
+                log_event(
+                    "analyzer.local",
+                    intent="CODE" if local else "TEXT",
+                    text_chars=len(user_text),
+                )
+                return local, user_text
+
         try:
-            if image_paths:
-                if len(image_paths) > MAX_IMAGES_PER_REQUEST:
+            if images:
+                if len(images) > MAX_IMAGES_PER_REQUEST:
                     raise ValueError(f"Максимум {MAX_IMAGES_PER_REQUEST} изображений за раз")
 
-                # Валидируем параллельно — экономит секунды на больших альбомах
-                results = await asyncio.gather(
-                    *(self._validate_image(p) for p in image_paths),
-                    return_exceptions=True,
-                )
-                for ok, err in results:
-                    if isinstance(ok, Exception):
-                        raise ValueError(f"Ошибка проверки изображения: {ok}")
-                    if not ok:
-                        raise ValueError(err)
-
             # Формируем мультимодальный контент
             content: list[dict] = [{"type": "text", "text": user_text}]
-            if image_paths:
-                # Кодируем параллельно
-                urls = await asyncio.gather(*(self._encode_image(p) for p in image_paths))
+            if images:
+                # Параллельно, каждая картинка в своём процессе пула. ValueError
+                # (размер/разрешение/битый файл) пробрасывается пользователю как есть
+                urls = await asyncio.gather(*(self._prepare_image(m) for m in images))
                 for url in urls:
                     content.append({"type": "image_url", "image_url": {"url": url}})
 
             response = None
-            async with log_timing(
+            async with admission.slot("groq"), log_timing(
                 "groq.analyze",
-                images=len(image_paths) if image_paths else 0,
+                images=len(images) if images else 0,
                 text_chars=len(user_text),
                 model="llama-4-scout",
             ):
@@ -192,12 +204,21 @@ class UniversalAnalyzer:
                 logger.warning(f"Intent tag not found, fallback. Head: {result[:100]!r}")
                 wants_code = self._fallback_intent(user_text)
                 processed = result or user_text
+            elif not images:
+                await self._record_decision(user_text, wants_code)
 
             logger.info(f"Analysis: wants_code={wants_code}, processed_len={len(processed)}")
             return wants_code, processed
 
         except ValueError:
             raise
+        except Overloaded:
+            # Без Groq картинки некому описать — такой запрос не принимаем.
+            # Текст обойдётся намерением по ключевым словам
+            if images:
+                raise
+            log_event("analyzer.shed", text_chars=len(user_text))
+            return self._fallback_intent(user_text), user_text
         except Exception as e:
             logger.error(f"Analyzer error: {e}")
             return self._fallback_intent(user_text), user_text